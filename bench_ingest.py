@@ -0,0 +1,179 @@
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from typing import Any, Callable, Iterator, Optional
+
+import clean_case_data as ccd
+from synth_seer_export import write_synthetic_export
+
+"""
+Ingest benchmark on synthetic SEER exports (synth_seer_export.py).
+For each size, reports rows/sec & total seconds of each decoder, and peak RSS.
+Each size runs in a fresh process so decoder caches and peak RSS don't carry over.
+Each decoder is timed over the whole file starting from empty decoder caches, as in 
+a real run. memoised decoders are then timed again with warm caches ('<name> (warm)').
+
+    python bench_ingest.py --rows 10000 1000000 10000000 --out bench.json
+    python bench_ingest.py --rows 10000 --compare bench.json
+"""
+
+DEFAULT_ROWS = [10_000, 1_000_000, 10_000_000]
+BENCH_BLOCK_LINES = 10_000
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark ingest decoders on synthetic SEER exports.')
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS, help='export sizes to benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--datadir', default=None, help='where synthetic exports are written & reused (default: a temp dir)')
+    parser.add_argument('--out', default=None, help='write results to this json file')
+    parser.add_argument('--compare', default=None, help='json results of a previous run to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        datadir = args.datadir or tmpdir
+        results = []
+        for nrows in args.rows:
+            path = os.path.join(datadir, f'synthetic_{nrows}_{args.seed}.txt')
+            if not os.path.exists(path):
+                print(f'Generating {nrows} rows -> {path}')
+                write_synthetic_export(path, nrows, args.seed)
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(bench_file, path).result()
+            print_result(result)
+            results.append(result)
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.out is not None:
+        with open(args.out, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as fp:
+            print_comparison(json.load(fp), report)
+
+def bench_file(path: str) -> dict[str, Any]:
+    """times each decoder over every row of path, block by block. one pass per decoder (two if memoised)."""
+    timers: dict[str, float] = {}
+    nrows = 0
+    cache = None
+    for name, func in BENCHMARKS.items():
+        ccd.clear_decoder_caches()
+        for label in [name, f'{name} (warm)'] if name in MEMOISED_BENCHMARKS else [name]:
+            timers[label] = 0.0
+            nrows = 0
+            for lines in _iter_blocks(path):
+                nrows += len(lines)
+                lsplits = [line.strip().split('\t') for line in lines]
+                # untimed, & warms the caches: tostr has none
+                records = [ccd.gen_record(line) for line in lines] if name == 'SeerRecord.tostr' else None
+                start = time.perf_counter()
+                func(lines, lsplits, records)
+                timers[label] += time.perf_counter() - start
+            if label == 'gen_record':
+                cache = ccd.cache_stats()
+    return {
+        'rows': nrows,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'decoders': {
+            name: {'seconds': secs, 'rows_per_sec': nrows / secs if secs > 0 else None}
+            for name, secs in timers.items()
+        },
+        # after the cold gen_record pass, ie a real run
+        'cache': cache,
+    }
+
+def _iter_blocks(path: str) -> Iterator[list[str]]:
+    with open(path, 'r') as fp:
+        while True:
+            lines = list(islice(fp, BENCH_BLOCK_LINES))
+            if not lines:
+                break
+            yield lines
+
+def _bench_gen_record(lines: list[str], lsplits: list[list[str]], records: Any) -> list[ccd.SeerRecord]:
+    return [ccd.gen_record(line) for line in lines]
+
+def _bench_stage_ajcc(lines: list[str], lsplits: list[list[str]], records: Any) -> None:
+    for lsplit in lsplits:
+        ccd.get_t_stage(lsplit)
+        ccd.get_n_stage(lsplit)
+        ccd.get_g_stage(lsplit)
+
+def _bench_grade(lines: list[str], lsplits: list[list[str]], records: Any) -> None:
+    for lsplit in lsplits:
+        ccd.get_grade(lsplit)
+
+def _bench_primary_type(lines: list[str], lsplits: list[list[str]], records: Any) -> None:
+    for lsplit in lsplits:
+        ccd.get_primary_type(lsplit)
+
+def _bench_tostr(lines: list[str], lsplits: list[list[str]], records: list[ccd.SeerRecord]) -> None:
+    for record in records:
+        record.tostr()
+
+# name -> func(lines, lsplits, records). records is only given to tostr.
+# get_stage_ajcc is timed as the t, n & g stage of each row.
+BENCHMARKS: dict[str, Callable] = {
+    'gen_record': _bench_gen_record,
+    'get_stage_ajcc': _bench_stage_ajcc,
+    'get_grade': _bench_grade,
+    'get_primary_type': _bench_primary_type,
+    'SeerRecord.tostr': _bench_tostr,
+}
+# benchmarks which go through the decoder caches, also timed warm
+MEMOISED_BENCHMARKS = {'gen_record', 'get_stage_ajcc', 'get_grade', 'get_primary_type'}
+
+def print_result(result: dict[str, Any]) -> None:
+    print(f"\n{result['rows']} rows, peak RSS {result['peak_rss_mb']:.1f} MB")
+    for name, timing in result['decoders'].items():
+        rate = f"{timing['rows_per_sec']:>14,.0f}" if timing['rows_per_sec'] else f"{'-':>14}"
+        print(f"- {name:<28} {timing['seconds']:>9.3f} s {rate} rows/s")
+
+def print_comparison(before: dict[str, Any], after: dict[str, Any]) -> None:
+    """rows/sec of this run relative to a previous one, for the sizes in both."""
+    print(f"\nCompared to {before.get('timestamp')} ({before.get('commit')})")
+    previous = {res['rows']: res for res in before['results']}
+    for result in after['results']:
+        if result['rows'] not in previous:
+            continue
+        prev = previous[result['rows']]
+        print(f"{result['rows']} rows, peak RSS {prev['peak_rss_mb']:.1f} -> {result['peak_rss_mb']:.1f} MB")
+        for name, timing in result['decoders'].items():
+            if name not in prev['decoders']:
+                continue
+            # None: too fast to time at this size
+            rate, prev_rate = timing['rows_per_sec'], prev['decoders'][name]['rows_per_sec']
+            if not rate or not prev_rate:
+                print(f"- {name:<28} {'-':>6}")
+                continue
+            print(f"- {name:<28} {rate / prev_rate:>6.2f}x")
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+if __name__ == '__main__':
+    main()
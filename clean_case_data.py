@@ -1,10 +1,30 @@
 
 from __future__ import annotations
-from typing import Optional, Tuple
-from dataclasses import fields
+from typing import Optional, Tuple, Callable, Iterable, Iterator, Any
+from dataclasses import dataclass, fields, replace
+from functools import lru_cache, partial
+from operator import itemgetter
+from itertools import islice
+from collections import deque, Counter
+from multiprocessing import Pool
+import argparse
+import csv
+import io
+import json
+import traceback
+import os
+import platform
 import re
-
-from util_classes import SeerRecord
+import shutil
+import time
+import numpy as np
+import pandas as pd
+
+from util_classes import SeerRecord, make_serializer
+from util_writers import WRITERS, CODES_SUFFIX, PARTITION_FIELDS, PartitionedWriter, RejectWriter, records_to_block, blocks_to_frame, concat_frames
+from util_io import ThreadedLineReader, is_compressed, open_text, read_dic_variables
+from util_profile import DecoderProfiler
+from util_consts import SEP_CHAR
 from util_enums import Grade, Behavior, RegionalNodes, Source
 from util_maps import (
     TSTAGE_AJCC,
@@ -24,13 +44,17 @@ from util_maps import (
     PRIMARYCODE_PRIMARYSITE_RANGES,
 )
 
-PRIMARYCODE_PRIMARYSITE_RANGES.sort()
-
 # INFILE = '/home/grace/work/brainmets/SEER/BrainMetsQueryFull.sample.txt'
 # OUTFILE = '/home/grace/work/brainmets/SEER/BrainMetsQueryFull.sample.fmt.tsv'
-import sys
-INFILE = sys.argv[1]
-OUTFILE = sys.argv[2]
+
+# approx size of each input byte range handed to a worker process (--workers)
+CHUNK_BYTES = 16 * 1024 * 1024
+# number of lines decoded together by the columnar decoder (--columnar)
+BLOCK_LINES = 100_000
+# max distinct inputs memoised per cached decoder (stage, grade, primary type)
+DECODER_CACHE_SIZE = 4096
+# decoder profile written next to the output (--profile)
+PROFILE_SUFFIX = '.profile.json'
  
 ############
 ### MAPS ###
@@ -41,20 +65,510 @@ OUTFILE = sys.argv[2]
 ############
 
 def main() -> None:
-    infp = open(INFILE, 'r')
-    outfp = open(OUTFILE, 'w')
-    i = 0
-    outfp.write('\t'.join([f.name for f in fields(SeerRecord)]) + '\n')
-    line = infp.readline()
-    while line:
-        if i % 100000 == 0:
-            print(f'Processed {i} records', end='\r')
-        record = gen_record(line)
-        outfp.write(record.tostr() + '\n')
-        line = infp.readline()
-        i += 1
-    infp.close()
-    outfp.close()
+    args = parse_args()
+    plan = None
+    if args.fields is not None or args.dic is not None:
+        select = args.fields.split(',') if args.fields is not None else None
+        if select is not None and args.partition:
+            select += [field for field in PARTITION_FIELDS if field not in select]
+        variables = read_dic_variables(args.dic) if args.dic is not None else None
+        plan = build_field_plan(select, variables)
+    if args.preflight:
+        unmapped, truncated = preflight_scan(args.infile, plan, args.workers, PREFLIGHT_MAX_DISTINCT)
+        print_preflight_report(unmapped, truncated, PREFLIGHT_MAX_DISTINCT)
+        if unmapped:
+            raise SystemExit(1)
+    profiler = None
+    if args.profile:
+        profiler = DecoderProfiler()
+        # gen_record() calls the decoders directly, so a profiled run decodes through a plan
+        plan = profiled_plan(plan or FULL_PLAN, profiler)
+    start = time.perf_counter()
+    convert(args.infile, args.outfile, args.workers, args.columnar, args.format, args.resume, args.rejects, plan, args.partition, args.shard)
+    if profiler is not None:
+        profiler.wall = time.perf_counter() - start
+        profiler.print_table()
+        profiler.save(args.outfile + PROFILE_SUFFIX)
+    if args.workers == 1:
+        # worker process caches aren't visible here, so only reported for serial runs
+        print_cache_stats()
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Clean a SEER*Stat case listing export into a table of SeerRecords.')
+    parser.add_argument('infile', help='SEER*Stat case listing export (tab separated, no header). .gz/.bz2/.xz/.zst are decompressed on the fly.')
+    parser.add_argument('outfile', help='path to write the cleaned table. tsv output ending in .gz/.bz2/.xz/.zst is compressed.')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes. 1 runs serially.')
+    parser.add_argument('--columnar', action='store_true', help='decode blocks of rows column-wise instead of per-line gen_record.')
+    parser.add_argument('--format', choices=list(WRITERS.keys()), default='tsv', help=f'output format. parquet writes one row group per block and requires pyarrow. coded writes str & enum fields as integer codes, with a code table per field in OUTFILE{CODES_SUFFIX}/.')
+    parser.add_argument('--resume', action='store_true', help=f'continue from the checkpoint (OUTFILE{CHECKPOINT_SUFFIX}) left by a failed run.')
+    parser.add_argument('--rejects', default=None, help='quarantine mode. rows which fail to convert are written to this file (with the failing field & exception) instead of aborting the run.')
+    parser.add_argument('--fields', default=None, help='comma separated SeerRecord fields to output. only the decoders (and input columns) these need are run.')
+    parser.add_argument('--dic', default=None, help='SEER*Stat .dic file for infile. input columns are located by variable name rather than by position.')
+    parser.add_argument('--partition', action='store_true', help=f"write a hive style dataset to the OUTFILE directory, one file per {' & '.join(PARTITION_FIELDS)}. read with util_writers.read_partitioned().")
+    parser.add_argument('--shard', type=parse_shard, default=None, metavar='I/N', help='convert only shard I (0-based) of N line-aligned byte ranges of infile, eg on one of N machines. output, rejects & a status file are written next to OUTFILE with a shard-I-of-N. prefix. combine them with merge_shards.py.')
+    parser.add_argument('--preflight', action='store_true', help='first scan the distinct raw values of every input column the decoders read, and stop before converting if any fail to convert (eg codes missing from util_maps).')
+    parser.add_argument('--profile', action='store_true', help=f'count calls & time spent in each decoder. printed at the end and written to OUTFILE{PROFILE_SUFFIX}. serial runs only.')
+    args = parser.parse_args()
+    if args.profile and args.workers > 1:
+        parser.error('--profile requires --workers 1')
+    if args.shard is not None and args.format not in SHARD_FORMATS:
+        parser.error(f"--shard supports {' & '.join(SHARD_FORMATS)} output")
+    if args.shard is not None and (args.partition or is_compressed(args.infile)):
+        parser.error('--shard needs uncompressed input and unpartitioned output')
+    if args.resume and args.partition:
+        parser.error('--resume is not supported for --partition output')
+    if args.partition and args.format == 'coded':
+        parser.error('--partition is not supported for coded output')
+    if args.resume and not WRITERS[args.format].resumable(args.outfile):
+        parser.error(f'--resume is not supported for {args.format} output {args.outfile}')
+    return args
+
+def convert(
+    infile: str, 
+    outfile: str, 
+    workers: int=1, 
+    columnar: bool=False, 
+    fmt: str='tsv', 
+    resume: bool=False, 
+    rejectfile: Optional[str]=None,
+    plan: Optional[FieldPlan]=None,
+    partition: bool=False,
+    shard: Optional[Tuple[int, int]]=None,
+    ) -> None:
+    """
+    Converts infile in blocks, serially or in a process pool. Results are written in 
+    input order, so the output is the same for any number of workers. 
+    
+    After each block a checkpoint (input offset, output offset, record count) is saved
+    to OUTFILE.ckpt if the output format can be resumed. The checkpoint is removed 
+    once the conversion completes.
+
+    If rejectfile is given, rows which fail to convert are written there and counted 
+    by reason rather than aborting the run. 
+
+    If plan is given, only plan.fields are written (see build_field_plan()).
+
+    If partition, outfile is a directory with a file per cancer_group & diagnosis_year
+    (see util_writers.PartitionedWriter). Partitioned output can't be resumed.
+
+    If shard is (index, count), only that shard_range() of infile is converted, to 
+    shard_path(outfile) & shard_path(rejectfile). Progress and reject counts are kept 
+    in a status file (see save_shard_status()) for merge_shards().
+    """
+    if partition and resume:
+        raise ValueError('partitioned output cannot be resumed')
+    if resume and not WRITERS[fmt].resumable(outfile):
+        raise ValueError(f'{fmt} output {outfile} cannot be resumed')
+    start, stop = 0, None
+    if shard is not None:
+        start, stop = shard_range(infile, *shard)
+        outfile = shard_path(outfile, *shard)
+        rejectfile = shard_path(rejectfile, *shard) if rejectfile is not None else None
+    opts = ConvertOptions(columnar, fmt, rejectfile is not None, plan, partition)
+    outfields = plan.fields if plan is not None else None
+    state = load_checkpoint(infile, outfile, fmt, outfields) if resume else None
+    skip = state['records'] if state else 0
+    in_offset = state['in_offset'] if state else start
+    if state:
+        print(f'Resuming from record {skip}')
+
+    if partition:
+        writer = PartitionedWriter(outfile, fmt, outfields)
+    else:
+        writer = WRITERS[fmt](outfile, state['out_offset'] if state else None, outfields)
+    checkpointing = not partition and WRITERS[fmt].resumable(outfile)
+    rejecter = None
+    reasons: Counter = Counter()
+    if rejectfile is not None:
+        rejecter = RejectWriter(rejectfile, state.get('reject_offset') if state else None)
+        reasons.update(state.get('reject_reasons', {}) if state else {})
+
+    i = skip
+    status = None
+    if shard is not None:
+        status = {
+            'infile': os.path.abspath(infile),
+            'format': fmt,
+            'fields': outfields,
+            'shard': list(shard),
+            'start': start,
+            'end': stop,
+            'in_offset': in_offset,
+            'records': i,
+            'reject_reasons': dict(reasons),
+            'host': platform.node(),
+            'done': False,
+        }
+        save_shard_status(outfile, status)
+    for payload, nrecords, rejects, end in iter_results(iter_jobs(infile, opts, in_offset, skip, stop), workers):
+        writer.write(payload)
+        i += nrecords
+        if rejecter is not None:
+            rejecter.write(rejects)
+            reasons.update([reject_reason(field, error) for field, error, _, _ in rejects])
+        if checkpointing:
+            ckpt = {
+                'infile': os.path.abspath(infile),
+                'format': fmt,
+                'fields': outfields,
+                'in_offset': end,
+                'out_offset': writer.tell(),
+                'records': i,
+            }
+            if rejecter is not None:
+                ckpt['reject_offset'] = rejecter.tell()
+                ckpt['reject_reasons'] = dict(reasons)
+            save_checkpoint(outfile, ckpt)
+        if status is not None:
+            status.update(in_offset=end, records=i, reject_reasons=dict(reasons))
+            save_shard_status(outfile, status)
+        print(f'Processed {i} records', end='\r')
+
+    writer.close()
+    if rejecter is not None:
+        rejecter.close()
+        print_reject_summary(i, reasons, rejectfile)
+    if checkpointing:
+        remove_checkpoint(outfile)
+    if status is not None:
+        status.update(in_offset=stop, done=True)
+        save_shard_status(outfile, status)
+
+def ingest(
+    infile: str, 
+    fields: Optional[list[str]]=None, 
+    workers: int=1, 
+    columnar: bool=True, 
+    dic: Optional[str]=None
+    ) -> pd.DataFrame:
+    """
+    Decodes a SEER*Stat export straight to a typed DataFrame of SeerRecord fields, 
+    without writing the cleaned tsv. Same values as clean_case_data.py output read with
+    util_writers.table_dtypes(). See build_field_plan() for fields & dic.
+
+    Each block is typed as it arrives, rather than concatenating the python objects
+    of every block first.
+
+    The frame has the SeerRecord schema, as util_funcs' filtering & formatting stages 
+    (do_basic_filtering(), remove_identical_primary_secondary_cases(), ...) expect. 
+    It isn't the analysis table helpers.load_seer_data() reads, which rejects it.
+    """
+    plan = build_field_plan(fields, read_dic_variables(dic) if dic is not None else None)
+    opts = ConvertOptions(columnar, None, False, plan)
+    frames = [blocks_to_frame([block], plan.fields) for block, _, _, _ in iter_results(iter_jobs(infile, opts), workers)]
+    if not frames:
+        return blocks_to_frame([], plan.fields)
+    return concat_frames(frames, plan.fields).reset_index(drop=True)
+
+def iter_results(jobs: Iterable[tuple], workers: int=1, func: Optional[Callable[[tuple], Any]]=None) -> Iterator[Any]:
+    """
+    runs func (default _convert_job()) over jobs, in a process pool if workers > 1. 
+    yields results in job order.
+    """
+    func = func or _convert_job
+    if workers <= 1:
+        yield from map(func, jobs)
+        return
+    pool = Pool(workers)
+    try:
+        yield from imap_bounded(pool, func, jobs, 2 * workers)
+    finally:
+        pool.terminate()
+
+@dataclass
+class ConvertOptions:
+    columnar: bool = False
+    fmt: Optional[str] = 'tsv'  # None: payloads are the decoded blocks
+    quarantine: bool = False
+    plan: Optional[FieldPlan] = None  # None: all fields, default export layout
+    partition: bool = False  # payloads are {partition dir: payload} for PartitionedWriter
+
+def iter_jobs(infile: str, opts: ConvertOptions, start: Optional[int]=0, skip: int=0, stop: Optional[int]=None) -> Iterator[tuple]:
+    """
+    yields (source, opts, in_offset) jobs for _convert_job().
+    uncompressed input is split into line-aligned byte ranges from start (to stop, default
+    the end of the file), which are read by the worker. in_offset is the byte offset the range ends at.
+    compressed input can't be split by byte offset, so it is decompressed here and 
+    blocks of lines are sent instead, skipping the first skip lines. in_offset is None.
+    """
+    if is_compressed(infile):
+        with ThreadedLineReader(infile) as infp:
+            for lines in iter_blocks(islice(infp, skip, None), BLOCK_LINES):
+                yield lines, opts, None
+    else:
+        for rstart, rend in line_aligned_ranges(infile, CHUNK_BYTES, start or 0, stop):
+            yield (infile, rstart, rend), opts, rend
+
+def imap_bounded(pool: Pool, func: Callable, jobs: Iterable, max_pending: int) -> Iterator[Any]:
+    """
+    like pool.imap(), but only pulls the next job once fewer than max_pending are 
+    in flight (pool.imap consumes the whole job iterator up front).
+    """
+    pending: deque = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(func, (job,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def convert_lines(lines: list[str], opts: ConvertOptions) -> Tuple[Any, int, list[Reject]]:
+    """
+    converts raw export lines to an encoded payload for the output writer. 
+    returns (payload, num lines, rejects). rejects is always empty unless opts.quarantine.
+    """
+    if opts.fmt is None:
+        encode = _identity
+    elif opts.partition:
+        encode = partial(PartitionedWriter.encode, fmt=opts.fmt)
+    else:
+        encode = WRITERS[opts.fmt].encode
+    if opts.columnar:
+        try:
+            return encode(decode_block(lines, opts.plan or FULL_PLAN)), len(lines), []
+        except Exception:
+            if not opts.quarantine:
+                raise
+            # a bad row fails the whole block, so redo it row by row to find it
+
+    rejects: list[Reject] = []
+    if opts.plan is not None:
+        decode = partial(decode_line, plan=opts.plan, remap=plan_remap(opts.plan))
+        rows = decode_quarantined(lines, rejects, decode, opts.plan.maxsplit) if opts.quarantine else [decode(line) for line in lines]
+        return encode(rows_to_block(rows, opts.plan.fields)), len(lines), rejects
+    
+    records = decode_quarantined(lines, rejects, gen_record, NUM_INPUT_COLUMNS) if opts.quarantine else [gen_record(line) for line in lines]
+    if opts.fmt == 'tsv' and not opts.partition:
+        serialize = make_serializer()
+        return ''.join([serialize(rec) + '\n' for rec in records]), len(lines), rejects
+    return encode(records_to_block(records)), len(lines), rejects
+
+def _identity(block: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    return block
+
+def _cached_decoders() -> dict[str, Any]:
+    return {
+        'get_stage_ajcc': get_stage_ajcc,
+        'get_grade': _get_grade_cached,
+        'get_primary_type': _get_primary_type_cached,
+    }
+
+def clear_decoder_caches() -> None:
+    for func in _cached_decoders().values():
+        func.cache_clear()
+
+def cache_stats() -> dict[str, dict[str, float]]:
+    """hits, misses, size & hit rate of each memoised decoder."""
+    stats = {}
+    for name, func in _cached_decoders().items():
+        info = func.cache_info()
+        calls = info.hits + info.misses
+        stats[name] = {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'maxsize': info.maxsize,
+            'hit_rate': info.hits / calls if calls > 0 else 0.0,
+        }
+    return stats
+
+def print_cache_stats() -> None:
+    print()
+    print('Decoder cache stats')
+    for name, st in cache_stats().items():
+        print(f"- {name}: {st['hit_rate']*100:.2f}% hit rate ({st['hits']} hits, {st['misses']} misses, {st['size']}/{st['maxsize']} entries)")
+
+def iter_blocks(lines: Iterable[str], size: int) -> Iterator[list[str]]:
+    it = iter(lines)
+    block = list(islice(it, size))
+    while block:
+        yield block
+        block = list(islice(it, size))
+
+def line_aligned_ranges(path: str, chunk_bytes: int, start: int=0, stop: Optional[int]=None) -> list[Tuple[int, int]]:
+    """
+    returns (start, end) byte offsets of roughly chunk_bytes each, split on line ends. 
+    start (and stop, default the file size) must be line starts.
+    """
+    size = os.path.getsize(path) if stop is None else stop
+    ranges = []
+    with open(path, 'rb') as fp:
+        while start < size:
+            fp.seek(min(start + chunk_bytes, size) - 1)
+            fp.readline()
+            end = min(fp.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def read_range_lines(path: str, start: int, end: int) -> io.TextIOWrapper:
+    """text lines between two line-aligned byte offsets, decoded as open(path, 'r') would."""
+    with open(path, 'rb') as fp:
+        fp.seek(start)
+        buf = fp.read(end - start)
+    return io.TextIOWrapper(io.BytesIO(buf))
+
+def _convert_job(job: tuple) -> Tuple[Any, int, list[Reject], Optional[int]]:
+    source, opts, in_offset = job
+    if isinstance(source, tuple):
+        lines = list(read_range_lines(*source))
+    else:
+        lines = source
+    payload, nrecords, rejects = convert_lines(lines, opts)
+    return payload, nrecords, rejects, in_offset
+
+##################
+### CHECKPOINT ###
+##################
+
+CHECKPOINT_SUFFIX = '.ckpt'
+
+def checkpoint_path(outfile: str) -> str:
+    return outfile + CHECKPOINT_SUFFIX
+
+def save_checkpoint(outfile: str, state: dict[str, Any]) -> None:
+    _save_json(checkpoint_path(outfile), state)
+
+def _save_json(path: str, state: dict[str, Any]) -> None:
+    # write then rename so a crash never leaves a partial file
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(state, fp)
+    os.replace(path + '.tmp', path)
+
+def load_checkpoint(infile: str, outfile: str, fmt: str, outfields: Optional[list[str]]=None) -> dict[str, Any]:
+    path = checkpoint_path(outfile)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'no checkpoint to resume from: {path}')
+    with open(path, 'r') as fp:
+        state = json.load(fp)
+    if state['infile'] != os.path.abspath(infile) or state['format'] != fmt:
+        raise ValueError(f"checkpoint {path} was written for {state['infile']} ({state['format']})")
+    if state.get('fields') != outfields:
+        raise ValueError(f"checkpoint {path} was written for fields {state.get('fields')}")
+    return state
+
+def remove_checkpoint(outfile: str) -> None:
+    path = checkpoint_path(outfile)
+    if os.path.exists(path):
+        os.remove(path)
+
+##############
+### SHARDS ###
+##############
+
+"""
+A run can be split over machines sharing a directory: each converts one shard 
+(--shard I/N) of the same export, then merge_shards() concatenates the shard 
+outputs in order. Shard boundaries depend only on the input file, so no other 
+coordination is needed. Each shard keeps a status file of its progress & reject counts.
+"""
+
+SHARD_FORMATS = ['tsv', 'parquet']
+SHARD_STATUS_SUFFIX = '.status.json'
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    """'I/N' -> (I, N). I is 0-based."""
+    try:
+        index, count = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected a shard as I/N, got {text}')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'shard index must be in [0, {count}), got {index}')
+    return index, count
+
+def shard_path(path: str, index: int, count: int) -> str:
+    """path with a shard-I-of-N. prefix on its file name (keeps its extension for compression)."""
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, f'shard-{index:05d}-of-{count:05d}.{basename}')
+
+def shard_range(path: str, index: int, count: int) -> Tuple[int, int]:
+    """(start, end) byte offsets of shard index of count. shards are line-aligned & cover the whole file."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fp:
+        def align(offset: int) -> int:
+            # the first line start at or after offset
+            if offset <= 0 or offset >= size:
+                return min(max(offset, 0), size)
+            fp.seek(offset - 1)
+            fp.readline()
+            return fp.tell()
+        return align(size * index // count), align(size * (index + 1) // count)
+
+def save_shard_status(outfile: str, status: dict[str, Any]) -> None:
+    """outfile is the shard's output path."""
+    _save_json(outfile + SHARD_STATUS_SUFFIX, dict(status, updated=time.time()))
+
+def load_shard_statuses(outfile: str, count: int) -> list[Optional[dict[str, Any]]]:
+    """status of each shard of outfile, None for shards which haven't started."""
+    statuses = []
+    for index in range(count):
+        path = shard_path(outfile, index, count) + SHARD_STATUS_SUFFIX
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                statuses.append(json.load(fp))
+        else:
+            statuses.append(None)
+    return statuses
+
+def print_shard_progress(statuses: list[Optional[dict[str, Any]]]) -> None:
+    count = len(statuses)
+    for index, st in enumerate(statuses):
+        if st is None:
+            print(f'- shard {index}/{count}: not started')
+            continue
+        span = max(st['end'] - st['start'], 1)
+        frac = (st['in_offset'] - st['start']) / span
+        state = 'done' if st['done'] else f'{frac*100:.1f}%'
+        nrejects = sum(st['reject_reasons'].values())
+        print(f"- shard {index}/{count}: {state}, {st['records']} records, {nrejects} rejected ({st['host']})")
+
+def merge_shards(outfile: str, count: int, rejectfile: Optional[str]=None) -> dict[str, Any]:
+    """
+    concatenates the outputs (and rejects) of all count shards of outfile in order, 
+    once every shard is done. returns the combined record count & reject reasons.
+    shard files are left in place.
+    """
+    statuses = load_shard_statuses(outfile, count)
+    pending = [str(index) for index, st in enumerate(statuses) if st is None or not st['done']]
+    if pending:
+        raise RuntimeError(f"shards {', '.join(pending)} of {count} are not done")
+    first = statuses[0]
+    for st in statuses:
+        if (st['infile'], st['format'], st['fields']) != (first['infile'], first['format'], first['fields']):  # type: ignore
+            raise ValueError(f"shard {st['shard'][0]} was written for a different input, format or fields")  # type: ignore
+
+    paths = [shard_path(outfile, index, count) for index in range(count)]
+    if first['format'] == 'parquet':  # type: ignore
+        _merge_parquet(paths, outfile)
+    else:
+        _merge_text(paths, outfile)
+    if rejectfile is not None:
+        _merge_text([shard_path(rejectfile, index, count) for index in range(count)], rejectfile)
+
+    reasons: Counter = Counter()
+    for st in statuses:
+        reasons.update(st['reject_reasons'])  # type: ignore
+    return {'records': sum(st['records'] for st in statuses), 'reject_reasons': reasons}  # type: ignore
+
+def _merge_text(paths: list[str], outfile: str) -> None:
+    """concatenates text files which each start with the same header line."""
+    with open_text(outfile, 'w') as outfp:
+        for i, path in enumerate(paths):
+            with open_text(path, 'r') as infp:
+                header = infp.readline()
+                if i == 0:
+                    outfp.write(header)
+                shutil.copyfileobj(infp, outfp)
+
+def _merge_parquet(paths: list[str], outfile: str) -> None:
+    import pyarrow.parquet as pq
+    schema = pq.read_schema(paths[0])
+    with pq.ParquetWriter(outfile, schema) as writer:
+        for path in paths:
+            pfile = pq.ParquetFile(path)
+            for group in range(pfile.num_row_groups):
+                writer.write_table(pfile.read_row_group(group))
+
 
 ###############
 ### PARSING ###
@@ -72,12 +586,12 @@ DATA_FIELDS:
 
 def gen_record(line: str) -> SeerRecord:
     lsplit = line.strip().split('\t')
-    t_stage, t_src = get_stage_ajcc(lsplit[8], lsplit[10], lsplit[12], lsplit[14], 't')
-    n_stage, n_src = get_stage_ajcc(lsplit[9], lsplit[11], lsplit[13], lsplit[15], 'n')
-    g_stage, g_src = get_stage_ajcc(lsplit[16], lsplit[17], lsplit[18], lsplit[19], 'g')
+    t_stage, t_src = get_t_stage(lsplit)
+    n_stage, n_src = get_n_stage(lsplit)
+    g_stage, g_src = get_g_stage(lsplit)
     grade, grade_src = get_grade(lsplit)
     return SeerRecord(
-        patient_id = int(lsplit[0]),
+        patient_id = get_patient_id(lsplit),
         patient_death_year = get_death_year(lsplit),
         diagnosis_agebin = get_age_bin(lsplit),
         diagnosis_year = get_diagnosis_year(lsplit),
@@ -112,6 +626,19 @@ def gen_record(line: str) -> SeerRecord:
         psa = get_psa(lsplit),
     )
 
+def get_patient_id(lsplit: list[str]) -> int:
+    return int(lsplit[0])
+
+# stage: get_stage_ajcc() unless profiling (see profiled_plan())
+def get_t_stage(lsplit: list[str], stage: Optional[Callable]=None) -> Tuple[str|None, Source]:
+    return (stage or get_stage_ajcc)(lsplit[8], lsplit[10], lsplit[12], lsplit[14], 't')
+
+def get_n_stage(lsplit: list[str], stage: Optional[Callable]=None) -> Tuple[str|None, Source]:
+    return (stage or get_stage_ajcc)(lsplit[9], lsplit[11], lsplit[13], lsplit[15], 'n')
+
+def get_g_stage(lsplit: list[str], stage: Optional[Callable]=None) -> Tuple[str|None, Source]:
+    return (stage or get_stage_ajcc)(lsplit[16], lsplit[17], lsplit[18], lsplit[19], 'g')
+
 def get_psa(lsplit: list[str]) -> Optional[float]:
     """
     0.1 or less nanograms/milliliter (ng/ml)
@@ -172,9 +699,8 @@ def get_primary_group(lsplit: list[str]) -> str:
     pgroups = set()
     for psite in primary.split('|'):
         psite = psite.strip()
-        if psite == 'Lymphatics':
-            for item in lsplit:
-                print(item)
+        if psite not in CANCERTYPE_CANCERGROUP_MAP:
+            raise KeyError(f'no cancer group for primary site {psite}')
         pgroups.add(CANCERTYPE_CANCERGROUP_MAP[psite])
     primary_group = ' | '.join(list(pgroups))
     return primary_group
@@ -206,30 +732,59 @@ MESOTHELIOMA_SITES = {
     'Peritoneum, Omentum and Mesentery',
 }
 
-def get_primary_type(lsplit: list[str]) -> str:
-    """
-    returns the site as per CANCER_TYPE. 
-    Miscellaneous <-> Tonsil | Lymphatics (99)
-    """
-    code = int(lsplit[28])
-    ctype = get_cancer_type(lsplit)
-    ptype = None
+PRIMARYCODE_MAX = 809
 
-    # map code to primary 
-    if code in PRIMARYCODE_PRIMARYSITE_MAP:  # must be first
-        ptype = PRIMARYCODE_PRIMARYSITE_MAP[code]
-    if ptype is None:
-        ptype = _binary_search_primary(code, PRIMARYCODE_PRIMARYSITE_RANGES)
+def _primary_site_fallback(code: int) -> str:
     """
     Multimapping cases
         Hodgkin - Extranodal: All other sites 
         NHL - Extranodal: All sites except C024, C098-C099, C111, C142, C379, C420-C422, C424, C770-C779
     """
-    if ptype is None:
-        if code in NHL_BLACKLIST_CODES:
-            ptype = 'Hodgkin - Extranodal'
-        else:
-            ptype = 'Hodgkin - Extranodal | NHL - Extranodal'
+    if code in NHL_BLACKLIST_CODES:
+        return 'Hodgkin - Extranodal'
+    return 'Hodgkin - Extranodal | NHL - Extranodal'
+
+def build_primary_site_table() -> np.ndarray:
+    """
+    direct-index array of primary site for codes 0..PRIMARYCODE_MAX.
+    explicit codes take precedence over ranges, then the Hodgkin/NHL fallback.
+    """
+    table = np.empty(PRIMARYCODE_MAX + 1, dtype=object)
+    for code in range(PRIMARYCODE_MAX + 1):
+        table[code] = _primary_site_fallback(code)
+    for lo, hi, site in PRIMARYCODE_PRIMARYSITE_RANGES:
+        table[lo:hi + 1] = site
+    for code, site in PRIMARYCODE_PRIMARYSITE_MAP.items():  # must be last
+        table[code] = site
+    return table
+
+PRIMARYCODE_PRIMARYSITE_TABLE = build_primary_site_table()
+
+def lookup_primary_site(code: int) -> str:
+    if 0 <= code <= PRIMARYCODE_MAX:
+        return PRIMARYCODE_PRIMARYSITE_TABLE[code]
+    return _primary_site_fallback(code)
+
+def lookup_primary_sites(codes: np.ndarray) -> np.ndarray:
+    """vectorised lookup_primary_site() over an int array of primary site codes."""
+    codes = np.asarray(codes, dtype=np.int64)
+    inrange = (codes >= 0) & (codes <= PRIMARYCODE_MAX)
+    sites = PRIMARYCODE_PRIMARYSITE_TABLE[np.where(inrange, codes, 0)]
+    for idx in np.flatnonzero(~inrange):
+        sites[idx] = _primary_site_fallback(int(codes[idx]))
+    return sites
+
+def get_primary_type(lsplit: list[str]) -> str:
+    """
+    returns the site as per CANCER_TYPE. 
+    Miscellaneous <-> Tonsil | Lymphatics (99)
+    """
+    return _get_primary_type_cached(lsplit[28], get_cancer_type(lsplit))
+
+@lru_cache(maxsize=DECODER_CACHE_SIZE)
+def _get_primary_type_cached(code_raw: str, ctype: str) -> str:
+    code = int(code_raw)
+    ptype = lookup_primary_site(code)
     assert ptype
 
     ### PRIMARY_TYPE == CANCER_TYPE ###
@@ -270,19 +825,6 @@ def _sites_match(site1: str, site2: str) -> bool:
 def _print_mismatch_primary(pid: str, site: str, primary: str) -> None:
     print(f'PRIMARY MISMATCH: pid={pid}, site={site}, primary={primary}')
 
-def _binary_search_primary(code: int, ranges: list) -> Optional[str]:
-    mid = len(ranges) // 2
-    if len(ranges) == 0:
-        return None
-    elif ranges[mid][0] <= code and code <= ranges[mid][1]:
-        return ranges[mid][2]
-    elif mid == 0:
-        return None
-    elif ranges[mid][0] < code:
-        return _binary_search_primary(code, ranges[mid:])
-    else:
-        return _binary_search_primary(code, ranges[:mid])
-    
 def get_t_stage_raw(lsplit: list[str]) -> Tuple[str|None, str]:
     # ajcc (2004-2015)
     ajcc_6th, ajcc_7th = lsplit[8], lsplit[10]
@@ -349,23 +891,31 @@ def _gstage_eod_to_ajcc6th(stage: str) -> str:
     stage = re.sub(r'^4', 'IV', stage)
     return stage if stage in GSTAGE_AJCC else GSTAGE_EOD_AJCC_MAP[stage]
 
+def stage_branch(ajcc_6th: str, ajcc_7th: str, seer: str, eod: str, category: str='') -> str:
+    """which staging system get_stage_ajcc() reads: 'ajcc', 'seer', 'eod' or 'none'."""
+    if ajcc_6th and ajcc_6th not in NA_STAGE_AJCC:
+        return 'ajcc'
+    if seer and seer not in NA_STAGE_SEER:
+        return 'seer'
+    if eod and eod not in NA_STAGE_EOD:
+        return 'eod'
+    return 'none'
+
+@lru_cache(maxsize=DECODER_CACHE_SIZE)
 def get_stage_ajcc(ajcc_6th: str, ajcc_7th: str, seer: str, eod: str, category: str) -> Tuple[str|None, Source]:
     """returns t-stage as ajcc 6th edition (2004-2015)"""
     assert category in ['t', 'n', 'g']
+    branch = stage_branch(ajcc_6th, ajcc_7th, seer, eod)
     
     # ajcc
-    ajcc_6th = None if ajcc_6th in NA_STAGE_AJCC else ajcc_6th     # type: ignore
-    ajcc_7th = None if ajcc_7th in NA_STAGE_AJCC else ajcc_7th     # type: ignore
-    
-    if ajcc_6th and ajcc_7th:
-        if ajcc_6th in BAD_STAGE_AJCC and ajcc_7th not in BAD_STAGE_AJCC:
+    if branch == 'ajcc':
+        ajcc_7th = None if ajcc_7th in NA_STAGE_AJCC else ajcc_7th     # type: ignore
+        if ajcc_7th and ajcc_6th in BAD_STAGE_AJCC and ajcc_7th not in BAD_STAGE_AJCC:
             return _tstage_ajcc7th_to_ajcc6th(ajcc_7th), Source.NA
-    if ajcc_6th:
         return ajcc_6th, Source.NA
     
     # seer
-    seer = None if seer in NA_STAGE_SEER else seer                 # type: ignore
-    if seer:
+    if branch == 'seer':
         if seer.startswith('c'):
             src = Source.CLINICAL
         elif seer.startswith('p'):
@@ -381,8 +931,7 @@ def get_stage_ajcc(ajcc_6th: str, ajcc_7th: str, seer: str, eod: str, category:
             return _gstage_seer_to_ajcc6th(seer), src
         
     # eod
-    eod = None if eod in NA_STAGE_EOD else eod                     # type: ignore
-    if eod:
+    if branch == 'eod':
         if category == 't':
             return _tstage_eod_to_ajcc6th(eod), Source.NA
         elif category == 'n':
@@ -424,18 +973,20 @@ def get_grade(lsplit: list[str]) -> Tuple[Grade, Source]:
     S       sarcomatous overgrowth  Undifferentiated; anaplastic; Grade IV      G4
     
     """
-    
+    return _get_grade_cached(lsplit[26], lsplit[27], lsplit[25], get_cancer_type(lsplit))
+
+@lru_cache(maxsize=DECODER_CACHE_SIZE)
+def _get_grade_cached(clin_raw: str, path_raw: str, seer_raw: str, site: str) -> Tuple[Grade, Source]:
     # NAACCR (priority)
-    site = get_cancer_type(lsplit)
-    g_naaccr_clin = None if lsplit[26] == 'Blank(s)' else lsplit[26]
-    g_naaccr_path = None if lsplit[27] == 'Blank(s)' else lsplit[27]
+    g_naaccr_clin = None if clin_raw == 'Blank(s)' else clin_raw
+    g_naaccr_path = None if path_raw == 'Blank(s)' else path_raw
     if g_naaccr_path:
         return _cast_naaccrGrade_to_std(g_naaccr_path, site), Source.PATHOLOGICAL
     if g_naaccr_clin:
         return _cast_naaccrGrade_to_std(g_naaccr_clin, site), Source.CLINICAL
     
     # SEER  
-    g_seer = None if lsplit[25] == 'Unknown' else lsplit[25]
+    g_seer = None if seer_raw == 'Unknown' else seer_raw
     if g_seer:
         return _cast_seerGrade_to_std(g_seer), Source.NA
 
@@ -590,6 +1141,442 @@ def get_benign_tumors_count(lsplit: list[str]) -> int:
     return 0 if lsplit[21] == 'Unknown' else int(lsplit[21]) 
 
 
+################
+### COLUMNAR ###
+################
+
+"""
+Columnar decoding: a block of lines is split into raw columns once, then each 
+decoder below runs once per distinct combination of its input columns rather than 
+once per row. The existing get_* functions are reused as-is by handing them a 
+{column index: raw value} dict in place of lsplit, so values match gen_record(). 
+"""
+
+# (output fields, decoder, input columns read by the decoder via lsplit[col])
+COLUMN_DECODERS: list[Tuple[Tuple[str, ...], Callable, Tuple[int, ...]]] = [
+    (('patient_id',), get_patient_id, (0,)),
+    (('patient_death_year',), get_death_year, (4,)),
+    (('diagnosis_year',), get_diagnosis_year, (3,)),
+    (('followup_year',), get_followup_year, (36,)),
+    (('diagnosis_agebin',), get_age_bin, (2,)),
+    (('cancer_type',), get_cancer_type, (5,)),
+    (('cancer_group',), get_cancer_group, (5,)),
+    (('primary_type',), get_primary_type, (5, 28)),
+    (('primary_group',), get_primary_group, (5, 28)),
+    (('t_stage_ajcc', 't_stage_src'), get_t_stage, (8, 10, 12, 14)),
+    (('n_stage_ajcc', 'n_stage_src'), get_n_stage, (9, 11, 13, 15)),
+    (('g_stage_ajcc', 'g_stage_src'), get_g_stage, (16, 17, 18, 19)),
+    (('grade', 'grade_src'), get_grade, (5, 25, 26, 27)),
+    (('regional_nodes',), get_regional_nodes_category, (24,)),
+    (('regional_nodes_examined',), get_regional_nodes_examined, (23,)),
+    (('regional_nodes_positive',), get_regional_nodes_positive, (24,)),
+    (('behavior',), get_behavior, (6,)),
+    (('num_malignant_tumors',), get_malignant_tumors_count, (20,)),
+    (('num_benign_tumors',), get_benign_tumors_count, (21,)),
+    (('psa',), get_psa, (30,)),
+    (('breast_subtype',), get_breast_subtype, (35,)),
+    (('hist_type',), get_hist_type, (22,)),
+    (('hist_cateogry',), get_hist_category, (29,)),
+    (('brain_met',), get_brain_met, (7,)),
+    (('bone_met',), get_bone_met, (31,)),
+    (('lung_met',), get_lung_met, (33,)),
+    (('liver_met',), get_liver_met, (32,)),
+    (('other_met',), get_other_met, (37,)),
+    (('distant_ln',), get_distant_ln, (34,)),
+]
+NUM_INPUT_COLUMNS = max(max(cols) for _, _, cols in COLUMN_DECODERS) + 1
+
+def decode_block(lines: list[str], plan: FieldPlan) -> dict[str, np.ndarray]:
+    """decodes a block of raw export lines to columns (object arrays) of plan.fields."""
+    if len(lines) == 0:
+        return {field: np.empty(0, dtype=object) for field in plan.fields}
+    raw = read_raw_columns(lines, plan)
+    # decoders index a split line: reuse one list, filling just the decoder's columns per key
+    lsplit = [None] * (max(c for _, _, cols in plan.decoders for c in cols) + 1)
+    decoded = {}
+    for outfields, func, cols in plan.decoders:
+        if len(cols) == 1:
+            codes, keys = raw[cols[0]].codes, raw[cols[0]].categories.to_numpy(dtype=object)
+            keys = [(value,) for value in keys]
+        else:
+            codes, keys = _factorize_columns([raw[c] for c in cols])
+        # profiling counts rows, not distinct keys
+        nrows = np.bincount(codes, minlength=len(keys)).tolist() if plan.profiler else None
+        results = []
+        for k, key in enumerate(keys):
+            for c, value in zip(cols, key):
+                lsplit[c] = value
+            if nrows is not None:
+                plan.profiler.weight = nrows[k]  # type: ignore
+            results.append(func(lsplit))
+        if plan.profiler is not None:
+            plan.profiler.weight = 1
+        if len(outfields) == 1:
+            results = [(res,) for res in results]
+        for i, field in enumerate(outfields):
+            uniques = np.empty(len(results), dtype=object)
+            uniques[:] = [res[i] for res in results]
+            decoded[field] = uniques[codes]
+    return {field: decoded[field] for field in plan.fields}
+
+def read_raw_columns(lines: list[str], plan: FieldPlan) -> dict[int, pd.Categorical]:
+    """
+    splits raw export lines into categorical columns using the pyarrow csv reader 
+    (the pandas C parser if pyarrow is not installed). 
+    returns {input column: raw strings (no NA parsing)} for the columns plan needs.
+    """
+    needed = sorted({c for _, _, cols in plan.decoders for c in cols})
+    positions = [plan.positions[c] for c in needed]
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.csv as pacsv
+    except ImportError:
+        return _read_raw_columns_pandas(lines, needed, positions)
+    if '\n' in lines or '\r\n' in lines:
+        # pyarrow reads a blank line as a row of empty fields
+        raise IndexError(f'expected {max(positions) + 1} columns in each line')
+    names = [f'f{pos}' for pos in positions]
+    try:
+        table = pacsv.read_csv(
+            pa.py_buffer(''.join(lines).encode()),
+            read_options=pacsv.ReadOptions(autogenerate_column_names=True),
+            parse_options=pacsv.ParseOptions(delimiter='\t', quote_char=False, ignore_empty_lines=False),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=names, 
+                column_types={name: pa.string() for name in names}, 
+                strings_can_be_null=False,
+            ),
+        )
+    except (pa.ArrowInvalid, KeyError) as exc:
+        # ragged or short rows
+        raise IndexError(f'expected {max(positions) + 1} columns in each line') from exc
+    columns = {}
+    for c, name in zip(needed, names):
+        encoded = pc.dictionary_encode(table[name]).combine_chunks()
+        columns[c] = pd.Categorical.from_codes(
+            encoded.indices.to_numpy(zero_copy_only=False), 
+            categories=pd.Index(encoded.dictionary.to_numpy(zero_copy_only=False), dtype=object),
+        )
+    return columns
+
+def _read_raw_columns_pandas(lines: list[str], needed: list[int], positions: list[int]) -> dict[int, pd.Categorical]:
+    table = pd.read_csv(
+        io.StringIO(''.join(lines)), 
+        sep='\t', 
+        header=None, 
+        usecols=positions,
+        dtype='category', 
+        na_filter=False, 
+        quoting=csv.QUOTE_NONE, 
+        skip_blank_lines=False,
+    )
+    columns = {c: table[pos].array for c, pos in zip(needed, positions)}
+    for col in columns.values():
+        if (col.codes == -1).any():
+            raise IndexError(f'expected {max(positions) + 1} columns in each line')
+    return columns
+
+def _factorize_columns(columns: list[pd.Categorical]) -> Tuple[np.ndarray, list[Tuple[str, ...]]]:
+    """
+    returns (codes, keys) where keys are the distinct value tuples across columns 
+    and codes[i] indexes the key of row i. 
+    """
+    combined = np.zeros(len(columns[0]), dtype=np.int64)
+    for col in columns:
+        combined = combined * len(col.categories) + col.codes
+    codes, ucombined = pd.factorize(combined)
+    first = np.empty(len(ucombined), dtype=np.int64)
+    first[codes] = np.arange(len(codes))
+    keys = list(zip(*[col.categories.to_numpy(dtype=object)[col.codes[first]] for col in columns]))
+    return codes, keys
+
+##################
+### FIELD PLAN ###
+##################
+
+# SEER*Stat variable name of each input column, in the default export layout (see DATA_FIELDS)
+INPUT_VARIABLES = [
+    'Patient ID',
+    'Record number recode',
+    'Age recode with <1 year olds and 90+',
+    'Year of diagnosis',
+    'Year of death recode',
+    'Site recode ICD-O-3/WHO 2008',
+    'Behavior code ICD-O-3',
+    'SEER Combined Mets at DX-brain (2010+)',
+    'Derived AJCC T, 6th ed (2004-2015)',
+    'Derived AJCC N, 6th ed (2004-2015)',
+    'Derived AJCC T, 7th ed (2010-2015)',
+    'Derived AJCC N, 7th ed (2010-2015)',
+    'Derived SEER Combined T (2016-2017)',
+    'Derived SEER Combined N (2016-2017)',
+    'Derived EOD 2018 T (2018+)',
+    'Derived EOD 2018 N (2018+)',
+    'Derived AJCC Stage Group, 6th ed (2004-2015)',
+    'Derived AJCC Stage Group, 7th ed (2010-2015)',
+    'Derived SEER Cmb Stg Grp (2016-2017)',
+    'Derived EOD 2018 Stage Group (2018+)',
+    'Total number of in situ/malignant tumors for patient',
+    'Total number of benign/borderline tumors for patient',
+    'Histologic Type ICD-O-3',
+    'Regional nodes examined (1988+)',
+    'Regional nodes positive (1988+)',
+    'Grade Recode (thru 2017)',
+    'Grade Clinical (2018+)',
+    'Grade Pathological (2018+)',
+    'Primary Site',
+    'Histology recode - broad groupings',
+    'PSA Lab Value Recode (2010+)',
+    'SEER Combined Mets at DX-bone (2010+)',
+    'SEER Combined Mets at DX-liver (2010+)',
+    'SEER Combined Mets at DX-lung (2010+)',
+    'Mets at DX-Distant LN (2016+)',
+    'Breast Subtype (2010+)',
+    'Year of follow-up recode',
+    'Mets at DX-Other (2016+)',
+]
+assert len(INPUT_VARIABLES) == NUM_INPUT_COLUMNS
+
+@dataclass
+class FieldPlan:
+    """
+    the decoders needed for a set of output fields, and where their input columns are.
+    positions[c] is the export column holding input column c (index into INPUT_VARIABLES).
+    """
+    fields: list[str]
+    decoders: list[Tuple[Tuple[str, ...], Callable, Tuple[int, ...]]]
+    positions: list[int]
+    maxsplit: int
+    # set by profiled_plan(): decode_block() gives it the row count of each distinct key
+    profiler: Optional[DecoderProfiler] = None
+
+def plan_remap(plan: FieldPlan) -> Optional[Callable]:
+    """None if plan uses the default layout, else a function taking split export columns to input columns."""
+    needed = {c for _, _, cols in plan.decoders for c in cols}
+    if all(plan.positions[c] == c for c in needed):
+        return None
+    if len(plan.positions) == 1:
+        pos = plan.positions[0]
+        return lambda raw: (raw[pos],)
+    return itemgetter(*plan.positions)
+
+def build_field_plan(select: Optional[list[str]]=None, variables: Optional[list[str]]=None) -> FieldPlan:
+    """
+    select: output fields (default all SeerRecord fields). output is always in SeerRecord field order.
+    variables: export column names from the .dic file (default INPUT_VARIABLES layout).
+    """
+    allfields = [f.name for f in fields(SeerRecord)]
+    select = allfields if select is None else select
+    for field in select:
+        if field not in allfields:
+            raise ValueError(f'unknown field: {field}')
+    outfields = [field for field in allfields if field in select]
+    decoders = [dec for dec in COLUMN_DECODERS if any(field in select for field in dec[0])]
+    needed = sorted({c for _, _, cols in decoders for c in cols})
+
+    positions = [0] * (needed[-1] + 1)
+    for c in needed:
+        if variables is None:
+            positions[c] = c
+        elif INPUT_VARIABLES[c] in variables:
+            positions[c] = variables.index(INPUT_VARIABLES[c])
+        else:
+            users = [f for outs, _, cols in decoders if c in cols for f in outs if f in select]
+            raise ValueError(f"export has no '{INPUT_VARIABLES[c]}' column (needed for {', '.join(users)})")
+    maxsplit = max(positions[c] for c in needed) + 1
+    return FieldPlan(outfields, decoders, positions, maxsplit)
+
+def decode_line(line: str, plan: FieldPlan, remap: Optional[Callable]=None) -> list[Any]:
+    """
+    values of plan.fields for a line. only splits up to the last input column needed 
+    and only runs the decoders for plan.fields. remap is plan_remap(plan).
+    """
+    lsplit = line.strip().split(SEP_CHAR, plan.maxsplit)
+    if remap is not None:
+        lsplit = remap(lsplit)
+    values = {}
+    for outfields, func, cols in plan.decoders:
+        if len(outfields) == 1:
+            values[outfields[0]] = func(lsplit)
+        else:
+            values.update(zip(outfields, func(lsplit)))
+    return [values[field] for field in plan.fields]
+
+def rows_to_block(rows: list[list[Any]], outfields: list[str]) -> dict[str, np.ndarray]:
+    block = {}
+    for i, field in enumerate(outfields):
+        values = np.empty(len(rows), dtype=object)
+        values[:] = [row[i] for row in rows]
+        block[field] = values
+    return block
+
+FULL_PLAN = build_field_plan()
+
+# decoders which call get_stage_ajcc()
+STAGE_DECODERS = {get_t_stage, get_n_stage, get_g_stage}
+
+def profiled_plan(plan: FieldPlan, profiler: DecoderProfiler) -> FieldPlan:
+    """
+    a copy of plan whose decoders are timed by profiler. the stage decoders call an 
+    uncached get_stage_ajcc(), timed per category & stage_branch() (eg get_stage_ajcc[t:seer]), 
+    so the branch times are decoding work rather than cache hits. the decoders themselves 
+    aren't modified, so plan & other plans stay untimed & cached.
+    """
+    stage = profiler.wrap(
+        get_stage_ajcc.__wrapped__,  # type: ignore
+        name='get_stage_ajcc', 
+        branch=lambda *args: f'{args[4]}:{stage_branch(*args)}',
+    )
+    decoders = []
+    for outfields, func, cols in plan.decoders:
+        if func in STAGE_DECODERS:
+            timed = profiler.wrap(partial(func, stage=stage), name=func.__name__)
+        else:
+            timed = profiler.wrap(func)
+        decoders.append((outfields, timed, cols))
+    return replace(plan, decoders=decoders, profiler=profiler)
+
+
+#################
+### PREFLIGHT ###
+#################
+
+"""
+A fast pass over the export before a full run: collects the distinct raw values of 
+each decoder's input columns (as the columnar decoder does), then runs each decoder 
+once per distinct value to find every value the util_maps tables (or the decoder 
+itself) can't handle. Reports them all at once rather than failing on the first.
+"""
+
+# max distinct raw values kept per decoder. values first seen after this aren't checked.
+PREFLIGHT_MAX_DISTINCT = 100_000
+# decoders not scanned: ids aren't mapped & are nearly all distinct
+PREFLIGHT_SKIP = {'get_patient_id'}
+
+@dataclass
+class Unmapped:
+    field: str                  # record field(s) of the decoder
+    values: dict[str, str]      # input variable -> raw value
+    rows: int                   # rows with these raw values
+    error: str                  # exception raised by the decoder
+    where: str                  # innermost function which raised
+
+def preflight_scan(
+    infile: str, 
+    plan: Optional[FieldPlan]=None, 
+    workers: int=1, 
+    max_distinct: int=PREFLIGHT_MAX_DISTINCT,
+    ) -> Tuple[list[Unmapped], list[str]]:
+    """
+    returns (unmapped values, fields with more than max_distinct distinct values, 
+    whose later values weren't checked). only plan's decoders are checked (default all).
+    """
+    plan = plan or FULL_PLAN
+    plan = replace(plan, decoders=[dec for dec in plan.decoders if dec[1].__name__ not in PREFLIGHT_SKIP])
+    opts = ConvertOptions(True, None, False, plan)
+    distinct: list[Counter] = [Counter() for _ in plan.decoders]
+    # whether a decoder had a distinct value which wasn't kept
+    refused = [False for _ in plan.decoders]
+    for counts in iter_results(iter_jobs(infile, opts), workers, _scan_job):
+        for i, (total, block) in enumerate(zip(distinct, counts)):
+            for key, n in block.items():
+                if key in total or len(total) < max_distinct:
+                    total[key] += n
+                else:
+                    refused[i] = True
+    
+    unmapped = []
+    truncated = []
+    for (outfields, func, cols), values, partial_scan in zip(plan.decoders, distinct, refused):
+        field = ','.join(outfields)
+        if partial_scan:
+            truncated.append(field)
+        for key, n in values.most_common():
+            try:
+                func(dict(zip(cols, key)))
+            except Exception as e:
+                where = traceback.extract_tb(e.__traceback__)[-1].name
+                raw = {INPUT_VARIABLES[c]: val for c, val in zip(cols, key)}
+                unmapped.append(Unmapped(field, raw, n, f'{type(e).__name__}: {e}', where))
+    return unmapped, truncated
+
+def _scan_job(job: tuple) -> list[dict[Tuple[str, ...], int]]:
+    """distinct raw value tuples (and their row counts) of each decoder's input columns in a block."""
+    source, opts, _ = job
+    lines = list(read_range_lines(*source)) if isinstance(source, tuple) else source
+    if len(lines) == 0:
+        return [{} for _ in opts.plan.decoders]
+    raw = read_raw_columns(lines, opts.plan)
+    out = []
+    for _, _, cols in opts.plan.decoders:
+        codes, keys = _factorize_columns([raw[c] for c in cols])
+        out.append(dict(zip(keys, np.bincount(codes, minlength=len(keys)).tolist())))
+    return out
+
+def print_preflight_report(unmapped: list[Unmapped], truncated: list[str], max_distinct: int=PREFLIGHT_MAX_DISTINCT) -> None:
+    """max_distinct: the limit preflight_scan() used."""
+    print()
+    if not unmapped:
+        print('Preflight: all raw values convert')
+    else:
+        print(f'Preflight: {len(unmapped)} raw values fail to convert')
+        for um in unmapped:
+            values = ', '.join([f"{var}='{val}'" for var, val in um.values.items()])
+            print(f'- {um.field} ({um.rows} rows): {um.error} in {um.where} [{values}]')
+    for field in truncated:
+        print(f'- {field}: more than {max_distinct} distinct values, only the first were checked')
+
+
+###############
+### REJECTS ###
+###############
+
+# (field, exception, message, raw line) of a row which failed to convert
+Reject = Tuple[str, str, str, str]
+
+# exception name of a rejected line with too few columns
+SHORT_ROW = 'short row'
+
+# decoder function name -> record field(s) it produces
+DECODER_FIELDS = {func.__name__: outfields for outfields, func, cols in COLUMN_DECODERS}
+
+def decode_quarantined(lines: list[str], rejects: list[Reject], decode: Callable[[str], Any], ncols: int) -> list[Any]:
+    """
+    decode(line) for each line. lines which raise are appended to rejects instead. 
+    lines with fewer than ncols columns are rejected as short rows before decoding, 
+    rather than charged to whichever decoder first reads past the end.
+    """
+    records = []
+    for line in lines:
+        found = line.strip().count(SEP_CHAR) + 1
+        if found < ncols:
+            rejects.append(('line', SHORT_ROW, f'expected {ncols} columns, found {found}', line.rstrip('\n')))
+            continue
+        try:
+            records.append(decode(line))
+        except Exception as e:
+            rejects.append((failed_field(e), type(e).__name__, str(e), line.rstrip('\n')))
+    return records
+
+def failed_field(exc: Exception) -> str:
+    """record field whose decoder raised exc within gen_record() / decode_line(). 'line' if not raised by a decoder."""
+    for frame in traceback.extract_tb(exc.__traceback__):  # outermost first
+        if frame.name in DECODER_FIELDS:
+            return ','.join(DECODER_FIELDS[frame.name])
+    return 'line'
+
+def reject_reason(field: str, error: str) -> str:
+    return f'{field}: {error}'
+
+def print_reject_summary(nrecords: int, reasons: Counter, rejectfile: str) -> None:
+    nrejects = sum(reasons.values())
+    print()
+    print(f'Rejected {nrejects}/{nrecords} rows -> {rejectfile}')
+    for reason, count in reasons.most_common():
+        print(f'- {reason}: {count}')
+
+
 if __name__ == '__main__':
     main()
 
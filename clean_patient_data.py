@@ -0,0 +1,37 @@
+
+import argparse
+
+from util_classes import iter_records, iter_patients, format_value
+from util_consts import SEP_CHAR
+from util_io import open_text
+
+"""
+Aggregates the cleaned case table (clean_case_data.py output) into one row per patient 
+(Patient.todict()), streaming in a single pass. Either file may be compressed.
+"""
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Aggregate a cleaned case table into a patient level table.')
+    parser.add_argument('infile', help='cleaned case table from clean_case_data.py (all fields)')
+    parser.add_argument('outfile', help='path to write the patient table')
+    parser.add_argument('--clean', action='store_true', help="drop each patient's records after their first brain met.")
+    args = parser.parse_args()
+    write_patient_table(args.infile, args.outfile, args.clean)
+
+def write_patient_table(infile: str, outfile: str, clean: bool=False) -> int:
+    """writes a row per patient, returns the number of patients."""
+    i = 0
+    with open_text(outfile, 'w') as outfp:
+        for patient in iter_patients(iter_records(infile), clean):
+            row = patient.todict()
+            if i == 0:
+                outfp.write(SEP_CHAR.join(row.keys()) + '\n')
+            outfp.write(SEP_CHAR.join([format_value(val) for val in row.values()]) + '\n')
+            i += 1
+            if i % 10000 == 0:
+                print(f'Processed {i} patients', end='\r')
+    print(f'Processed {i} patients')
+    return i
+
+if __name__ == '__main__':
+    main()
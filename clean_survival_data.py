@@ -1,12 +1,118 @@
+import argparse
+import bz2
+import gzip
+import lzma
+import os
+from multiprocessing import Pool
+from typing import IO, Optional, Tuple
+import pandas as pd
 
-import sys
+"""
+Extracts the Age-Standardized Life table rows from SEER*Stat survival exports
+into typed tsv tables (see LIFE_TABLE_COLUMNS), one output per input.
+Files are processed concurrently (--workers) and streamed line by line.
+Inputs and outputs may be compressed (.gz, .bz2, .xz).
+Self-contained (no imports from scripts/), so it runs from the repo root.
 
-INFILE = sys.argv[1]
-OUTFILE = sys.argv[2]
+    python clean_survival_data.py raw/a.txt raw/b.txt --outdir clean/ --workers 4
 
-with open(INFILE, 'r') as infp:
-    with open(OUTFILE, 'w') as outfp:
-        for line in infp.readlines():
-            if 'Age-Standardized Life' in line:
-                lsplit = line.split('\t')
-                outfp.write('\t'.join(lsplit[2:]))
+Load an output with read_life_table().
+"""
+
+SEP_CHAR = '\t'
+NA_CHAR = '.'
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+# (name, type) of each column after the first two (label) columns of a life table row
+LIFE_TABLE_COLUMNS: list[Tuple[str, type]] = [
+    ('month', int),
+    ('alive_at_start', int),
+    ('died', int),
+    ('lost_to_followup', int),
+    ('observed_int', float),
+    ('observed_cum', float),
+    ('expected_int', float),
+    ('expected_cum', float),
+    ('relative_int', float),
+    ('relative_cum', float),
+    ('SE_observed_int', float),
+    ('SE_observed_cum', float),
+    ('SE_relative_int', float),
+    ('SE_relative_cum', float),
+]
+LIFE_TABLE_MARKER = 'Age-Standardized Life'
+OUT_SUFFIX = '.clean.tsv'
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Extract typed life tables from SEER*Stat survival exports.')
+    parser.add_argument('infiles', nargs='+', help='survival exports. .gz/.bz2/.xz are decompressed on the fly.')
+    parser.add_argument('--outdir', default=None, help=f'where to write INFILE{OUT_SUFFIX} tables (default: next to each input).')
+    parser.add_argument('--workers', type=int, default=1, help='number of files processed at once.')
+    args = parser.parse_args()
+
+    jobs = [(infile, output_path(infile, args.outdir)) for infile in args.infiles]
+    for infile, outfile, nrows in clean_survival_files(jobs, args.workers):
+        print(f'{infile} -> {outfile} ({nrows} rows)')
+
+def output_path(infile: str, outdir: Optional[str]=None) -> str:
+    name = os.path.basename(infile)
+    for ext in [*OPENERS, '.txt']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return os.path.join(outdir or os.path.dirname(infile), name + OUT_SUFFIX)
+
+def clean_survival_files(jobs: list[Tuple[str, str]], workers: int=1) -> list[Tuple[str, str, int]]:
+    """runs clean_survival_file() over (infile, outfile) jobs, in a process pool if workers > 1."""
+    if workers <= 1 or len(jobs) <= 1:
+        return [clean_survival_file(job) for job in jobs]
+    with Pool(min(workers, len(jobs))) as pool:
+        return pool.map(clean_survival_file, jobs, chunksize=1)
+
+def clean_survival_file(job: Tuple[str, str]) -> Tuple[str, str, int]:
+    """streams the life table rows of infile to outfile. returns (infile, outfile, rows written)."""
+    infile, outfile = job
+    nrows = 0
+    with open_text(infile, 'r') as infp:
+        with open_text(outfile, 'w') as outfp:
+            outfp.write(SEP_CHAR.join([name for name, _ in LIFE_TABLE_COLUMNS]) + '\n')
+            for line in infp:
+                if LIFE_TABLE_MARKER not in line:
+                    continue
+                values = parse_life_row(line.rstrip('\n').split('\t')[2:])
+                if values is None:
+                    continue
+                outfp.write(SEP_CHAR.join([NA_CHAR if val is None else str(val) for val in values]) + '\n')
+                nrows += 1
+    return infile, outfile, nrows
+
+def open_text(path: str, mode: str='r') -> IO[str]:
+    """opens path in text mode, (de)compressing by file extension (see OPENERS)."""
+    opener = OPENERS.get(os.path.splitext(path)[1].lower())
+    return open(path, mode) if opener is None else opener(path, mode + 't')
+
+def parse_life_row(lsplit: list[str]) -> Optional[list[int | float | None]]:
+    """
+    typed values of a life table row. None for rows with no cumulative observed
+    survival ('+'), which were dropped by the survival notebooks.
+    """
+    if len(lsplit) < len(LIFE_TABLE_COLUMNS):
+        raise ValueError(f'expected {len(LIFE_TABLE_COLUMNS)} life table columns, got {len(lsplit)}')
+    if lsplit[5].strip() == '+':
+        return None
+    values: list[int | float | None] = [_parse_month(lsplit[0])]
+    for text, (_, ctype) in zip(lsplit[1:], LIFE_TABLE_COLUMNS[1:]):
+        text = text.strip().rstrip('%').replace(',', '')
+        values.append(None if text in ['', NA_CHAR] else ctype(text))
+    return values
+
+def _parse_month(text: str) -> int:
+    """end of the interval in months, eg '6 mo-<12 mo' -> 12"""
+    return int(text.split('<')[-1].replace('mo', '').strip())
+
+def read_life_table(path: str) -> pd.DataFrame:
+    """reads a table written by clean_survival_file(). ints are nullable."""
+    dtypes = {name: 'Int64' if ctype is int else 'float64' for name, ctype in LIFE_TABLE_COLUMNS}
+    return pd.read_csv(path, sep=SEP_CHAR, header=0, dtype=dtypes, na_values=[NA_CHAR], keep_default_na=False)
+
+if __name__ == '__main__':
+    main()
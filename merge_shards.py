@@ -0,0 +1,37 @@
+
+import argparse
+
+from clean_case_data import load_shard_statuses, merge_shards, print_shard_progress, print_reject_summary
+
+"""
+Combines the shards written by clean_case_data.py --shard I/N into one output.
+OUTFILE (and --rejects) are the paths given to each shard run.
+
+    python clean_case_data.py export.txt /shared/out.tsv --shard 0/4   # machine 0
+    ...
+    python clean_case_data.py export.txt /shared/out.tsv --shard 3/4   # machine 3
+    python merge_shards.py /shared/out.tsv 4 --status                 # progress so far
+    python merge_shards.py /shared/out.tsv 4                          # once all are done
+"""
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Merge the shard outputs of clean_case_data.py --shard.')
+    parser.add_argument('outfile', help='OUTFILE given to the shard runs. the merged output is written here.')
+    parser.add_argument('shards', type=int, help='number of shards (N)')
+    parser.add_argument('--rejects', default=None, help='--rejects path given to the shard runs. shard rejects are merged here.')
+    parser.add_argument('--status', action='store_true', help='print the progress of each shard and exit without merging.')
+    args = parser.parse_args()
+
+    print_shard_progress(load_shard_statuses(args.outfile, args.shards))
+    if args.status:
+        return
+    try:
+        merged = merge_shards(args.outfile, args.shards, args.rejects)
+    except RuntimeError as e:
+        parser.exit(1, f'{e}\n')
+    print(f"Merged {args.shards} shards: {merged['records']} records -> {args.outfile}")
+    if args.rejects is not None:
+        print_reject_summary(merged['records'], merged['reject_reasons'], args.rejects)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 
+import os
 import numpy as np
 import pandas as pd
-from typing import Tuple, Any
+from typing import Tuple, Any, Callable, Iterable
+
+from util_cache import FrameCache
+from util_filters import FilterPipeline, StepCounts, in_range, not_duplicated, not_in, not_met_to_own_tissue
+from util_writers import RowFilter, read_table
 
 
 
@@ -93,65 +98,139 @@ NAMELUT = {
     
 }
 
-def load_seer_data(filepath: str) -> pd.DataFrame:
-    df = pd.read_csv(filepath, sep='\t', header=0)
-    df = _load_seer_data_filtering(df)
+def load_seer_data(
+    source: str | pd.DataFrame, 
+    cancer_groups: Iterable[str] | None=None, 
+    years: Iterable[int] | None=None,
+    year_range: Tuple[int, int] | None=None,
+    exclude_cancer_groups: Iterable[str] | None=None,
+    exclude_hist_groups: Iterable[str] | None=None,
+    columns: Iterable[str] | None=None,
+    ) -> pd.DataFrame:
+    """
+    source: path to the cleaned analysis table (eg SEER_2010_2020_RICH.clean.tsv), 
+    or a frame with the same columns already in memory (skips the tsv round trip). 
+    directories written by clean_case_data.py --partition only hold SeerRecord 
+    fields, not the analysis columns, so they're rejected: use read_partitioned().
+    columns are read as pandas infers them: text stays str, so analysis code can 
+    assign new labels (eg DtableGenerator placeholders). typed columns of a frame 
+    source (categories, nullable ints & bools) are converted the same way.
+    cancer_groups, years: only keep these cancer_group / diagnosis_year values.
+    year_range, exclude_cancer_groups, exclude_hist_groups: filters applied while 
+    reading, so rejected rows are never loaded. pass **BASIC_FILTERS to push down 
+    the basic filtering below. the rows removed while reading are counted & 
+    printed with it, so the log is the same either way.
+    columns: only read these fields (plus LOAD_COLUMNS, which loading needs).
+    raises ValueError if source lacks any of LOAD_COLUMNS.
+    """
+    rows = RowFilter(
+        year_range=year_range,
+        years=set(years) if years is not None else None,
+        cancer_groups=set(cancer_groups) if cancer_groups is not None else None,
+        exclude_cancer_groups=set(exclude_cancer_groups or []),
+        exclude_hist_groups=set(exclude_hist_groups or []),
+    )
+    read_counts = rows.count_rows()
+    if columns is not None:
+        columns = list(columns) + [col for col in LOAD_COLUMNS if col not in columns]
+    if isinstance(source, pd.DataFrame):
+        keep = [col for col in source.columns if columns is None or col in columns]
+        df = _untyped_frame(source.loc[rows.mask(source), keep])
+    elif os.path.isdir(source):
+        raise ValueError(
+            f'{source} is a directory. partitioned output of clean_case_data.py has '
+            'SeerRecord fields, not the analysis table columns load_seer_data needs'
+        )
+    else:
+        df = read_table(source, columns, rows, typed=False)
+    missing = [col for col in LOAD_COLUMNS if col not in df.columns]
+    if missing:
+        raise ValueError(
+            f"not an analysis table, missing columns: {', '.join(missing)}. "
+            'frames of SeerRecord fields (eg clean_case_data.ingest()) go through '
+            'util_funcs.do_basic_filtering() etc instead'
+        )
+    df = _load_seer_data_filtering(df, read_counts.counts())
     df = _load_seer_data_redefine_fields(df)
     return df 
 
-def _load_seer_data_filtering(df: pd.DataFrame) -> pd.DataFrame:
-    cgroup_blacklist = ['Brain', 'Miscellaneous']
-    hgroup_blacklist = ['unspecified neoplasms']
-    
-    print(f"Basic filtering")
-    fpats, frecs = df['patient_id'].nunique(), df.shape[0]
-    print(f"- Beginning: {fpats} patients, {frecs} records.")
-    
-    # banned cancer groups
-    ipats, irecs = fpats, frecs
-    df = df[~df['cancer_group'].isin(cgroup_blacklist)]
-    fpats, frecs = df['patient_id'].nunique(), df.shape[0]
-    print(f"- Removed {ipats-fpats} patients, {irecs-frecs} records where 'cancer_group' in {cgroup_blacklist}.")
-
-    # banned histological groups
-    ipats, irecs = fpats, frecs
-    df = df[~df['hist_group'].isin(hgroup_blacklist)]
-    fpats, frecs = df['patient_id'].nunique(), df.shape[0]
-    print(f"- Removed {ipats-fpats} patients, {irecs-frecs} records where 'hist_group' in {hgroup_blacklist}.")
-
-    # record year range
-    ipats, irecs = fpats, frecs
-    df = df.loc[df['diagnosis_year'] >= 2010]
-    df = df.loc[df['diagnosis_year'] <= 2020]
-    fpats, frecs = df['patient_id'].nunique(), df.shape[0]
-    print(f"- Removed {ipats-fpats} patients, {irecs-frecs} records where 'diagnosis_year' not in range [2010, 2020].")
- 
-    # duplicate patient records 
-    ipats, irecs = fpats, frecs
-    df = df[~df.duplicated('patient_id', keep=False)]
-    fpats, frecs = df['patient_id'].nunique(), df.shape[0]
-    print(f"- Removed {ipats-fpats} patients, {irecs-frecs} records with duplicated patient_id.")
-    # ipats, irecs = fpats, frecs
-    # df = df[~df.duplicated(subset=['patient_id', 'cancer_type'])]
-    # fpats, frecs = df['patient_id'].nunique(), df.shape[0]
-    # print(f"- Removed {ipats-fpats} patients, {irecs-frecs} records with duplicated patient_id & cancer_type.")
-
-    # primary marked as metastasis
-    ipats, irecs = fpats, frecs
+def load_seer_data_cached(path: str, cache: FrameCache | None=None, **kwargs: Any) -> pd.DataFrame:
+    """
+    load_seer_data(path, **kwargs), cached (default FrameCache()) on the file, the 
+    arguments & the code, so a rerun reloads the frame instead of reading & filtering it.
+    """
+    cache = cache or FrameCache()
+    return cache.load(path, load_seer_data, **kwargs)
+
+def _untyped_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    df with the dtypes read_csv would infer for its columns: categories & nullable 
+    bools become object columns, nullable ints become int (float if any NA).
+    """
+    df = df.copy()
+    for col in df.columns:
+        dtype = df[col].dtype
+        if isinstance(dtype, (pd.CategoricalDtype, pd.BooleanDtype)):
+            df[col] = np.asarray(df[col].astype(object).where(df[col].notna(), np.nan), dtype=object)
+        elif isinstance(dtype, pd.api.extensions.ExtensionDtype) and pd.api.types.is_integer_dtype(dtype):
+            df[col] = df[col].astype('float64' if df[col].isna().any() else 'int64')
+    return df
+
+# fields used by _load_seer_data_filtering() & _load_seer_data_redefine_fields()
+LOAD_COLUMNS = [
+    'patient_id', 'cancer_group', 'cancer_type', 'hist_group', 'diagnosis_year', 'age',
+    'brain_met', 'bone_met', 'lung_met', 'liver_met', 'other_met', 
+    'NSTAGE_STD', 'regional_nodes', 'distant_ln_met',
+]
+CGROUP_BLACKLIST = ['Brain', 'Miscellaneous']
+HGROUP_BLACKLIST = ['unspecified neoplasms']
+YEAR_RANGE = (2010, 2020)
+
+# the basic filtering to push down into load_seer_data()'s read
+BASIC_FILTERS = dict(
+    year_range=YEAR_RANGE, 
+    exclude_cancer_groups=CGROUP_BLACKLIST, 
+    exclude_hist_groups=HGROUP_BLACKLIST,
+)
+
+def _load_seer_data_filtering(df: pd.DataFrame, read_counts: list[StepCounts]) -> pd.DataFrame:
+    """
+    read_counts: StepCounts of the rows load_seer_data() filtered while reading. 
+    they're printed first, and steps below which were already applied while 
+    reading (same name) are skipped.
+    """
+    cgroup_blacklist = sorted(CGROUP_BLACKLIST)
+    hgroup_blacklist = sorted(HGROUP_BLACKLIST)
     MET_MAP = {
         'brain_met': ['Brain'], 
         'bone_met': ['Bones and Joints'], 
         'lung_met': ['Lung and Bronchus'],
         'liver_met': ['Liver'], 
     }
-    for met, tissues in MET_MAP.items():
-        mask = (df[met]==True) & (df['cancer_type'].isin(tissues))
-        df = df[~mask]
-    fpats, frecs = df['patient_id'].nunique(), df.shape[0]
-    print(f"- Removed {ipats-fpats} patients, {irecs-frecs} records where primary cancer is marked as metastasis")
-    
-    print(f"- Final: {fpats} patients, {frecs} records.")
-    return df.copy()
+    steps = [
+        # banned cancer groups
+        (f"where 'cancer_group' in {cgroup_blacklist}.", not_in('cancer_group', cgroup_blacklist)),
+        # banned histological groups
+        (f"where 'hist_group' in {hgroup_blacklist}.", not_in('hist_group', hgroup_blacklist)),
+        # record year range
+        (f"where 'diagnosis_year' not in range [{YEAR_RANGE[0]}, {YEAR_RANGE[1]}].", in_range('diagnosis_year', *YEAR_RANGE)),
+        # duplicate patient records 
+        ("with duplicated patient_id.", not_duplicated(['patient_id'], keep=False)),
+        # ("with duplicated patient_id & cancer_type.", not_duplicated(['patient_id', 'cancer_type'])),
+        # primary marked as metastasis
+        ("where primary cancer is marked as metastasis", not_met_to_own_tissue(MET_MAP)),
+    ]
+    pushed = {step.name for step in read_counts[1:]}
+    pipeline = FilterPipeline([(name, func) for name, func in steps if name not in pushed])
+    df, counts = pipeline.run(df)
+    counts = read_counts + counts[1:]
+
+    print(f"Basic filtering")
+    print(f"- Beginning: {counts[0].patients} patients, {counts[0].records} records.")
+    for step in counts[1:]:
+        print(f"- Removed {step.removed_patients} patients, {step.removed_records} records {step.name}")
+    print(f"- Final: {counts[-1].patients} patients, {counts[-1].records} records.")
+    return df
 
 def _load_seer_data_redefine_fields(df: pd.DataFrame) -> pd.DataFrame:
     # redefine any_met
@@ -243,52 +322,80 @@ def format_predictors(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 def format_categorical_to_numeric(df: pd.DataFrame) -> pd.DataFrame:
-    # functions
-    funclut = {
+    # lookup tables / functions (applied once per distinct value)
+    castlut = {
         'TSTAGE_CAT': cast_tstage_to_float,
         'NSTAGE_CAT': cast_nstage_to_float,
-        'GSTAGE_CAT': cast_gstage_to_float,
+        'GSTAGE_CAT': GSTAGE_TO_FLOAT,
         'GRADE_CAT': cast_grade_to_float,
-        'hGC_elevation_post_orchiectomy_CAT': cast_hGC_to_float,
-        'LDH_elevation_post_orchiectomy_CAT': cast_LDH_to_float,
-        'HER2_status_CAT': cast_HER2_to_float,
-        'peripheral_blood_involvement_CAT': cast_peripheral_blood_to_float,
-        'peritoneal_cytology_CAT': cast_peritoneal_cytology_to_float,
-        'pleural_invasion_CAT': cast_pleural_invasion_to_float,
+        'hGC_elevation_post_orchiectomy_CAT': HGC_TO_FLOAT,
+        'LDH_elevation_post_orchiectomy_CAT': LDH_TO_FLOAT,
+        'HER2_status_CAT': HER2_TO_FLOAT,
+        'peripheral_blood_involvement_CAT': PERIPHERAL_BLOOD_TO_FLOAT,
+        'peritoneal_cytology_CAT': PERITONEAL_CYTOLOGY_TO_FLOAT,
+        'pleural_invasion_CAT': PLEURAL_INVASION_TO_FLOAT,
     }
 
     # apply
-    for field, func in funclut.items():
+    for field, lut in castlut.items():
         if field not in df.columns:
             continue 
         newfield = field.replace('_CAT', '_NUM')
+        values = df[field]
         if field == 'GRADE_CAT':
-            mask = df['GRADE_CAT'].isin(['G1', 'G2', 'G3', 'G4'])
-        else:
-            mask = df[field].notna()
-        df.loc[mask, newfield] = df.loc[mask, field].apply(func)
+            values = values.where(values.isin(['G1', 'G2', 'G3', 'G4']))
+        df[newfield] = cast_categorical(values, lut, field, dtype=float)
     
-    return df.copy()
+    return df
 
 def format_categorical_to_bool(df: pd.DataFrame) -> pd.DataFrame:
-    # functions
-    funclut = {
-        'LDH_elevated_pretreat_CAT': cast_2level_elevation_to_bool,
-        'CEA_elevated_pretreat_CAT': cast_2level_elevation_to_bool,
-        'AFP_elevated_pretreat_CAT': cast_2level_elevation_to_bool,
-        'CA125_elevated_CAT': cast_2level_elevation_to_bool,
-        'fibrosis_score_CAT': cast_fibrosis_to_bool,
+    # lookup tables
+    castlut = {
+        'LDH_elevated_pretreat_CAT': ELEVATION_TO_BOOL,
+        'CEA_elevated_pretreat_CAT': ELEVATION_TO_BOOL,
+        'AFP_elevated_pretreat_CAT': ELEVATION_TO_BOOL,
+        'CA125_elevated_CAT': ELEVATION_TO_BOOL,
+        'fibrosis_score_CAT': FIBROSIS_TO_BOOL,
     }
 
     # apply
-    for field, func in funclut.items():
+    for field, lut in castlut.items():
         if field not in df.columns:
             continue 
-        mask = df[field].notna()
         newfield = field.replace('_CAT', '_BOOL')
-        df.loc[mask, newfield] = df.loc[mask, field].apply(func)
+        df[newfield] = cast_categorical(df[field], lut, field)
     
-    return df.copy()
+    return df
+
+def cast_categorical(
+    values: pd.Series, 
+    lut: dict[Any, Any] | Callable[[Any], Any], 
+    field: str='', 
+    dtype: Any=object,
+    ) -> np.ndarray:
+    """
+    casts a low cardinality column via lut (value -> result, or a function of the 
+    value), evaluated once per distinct value then broadcast over the factorized codes. 
+    NA stays NaN. raises ValueError for a value not in lut.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # existing codes, without hashing the values. unused categories aren't cast
+        codes = values.cat.codes.to_numpy()
+        uniques = list(values.cat.categories)
+        present = np.bincount(codes + 1, minlength=len(uniques) + 1)[1:] > 0
+    else:
+        codes, uniques = pd.factorize(values)
+        present = np.ones(len(uniques), dtype=bool)
+    if not callable(lut):
+        unknown = [val for val, used in zip(uniques, present) if used and val not in lut]
+        if unknown:
+            raise ValueError(f"{field}: no cast for values {unknown}")
+    table = np.empty(len(uniques) + 1, dtype=dtype)
+    table[:] = np.nan  # code -1 (NA) & unused categories
+    for i, val in enumerate(uniques):
+        if present[i]:
+            table[i] = lut(val) if callable(lut) else lut[val]
+    return table[codes]
 
 def format_continuous_to_numeric_bool(df: pd.DataFrame) -> pd.DataFrame:
     # continuous (always mappable to CAT and BOOL)
@@ -333,7 +440,7 @@ def format_bool_to_numeric(df: pd.DataFrame) -> pd.DataFrame:
             continue 
         newfield = field.replace('_BOOL', '_NUM')
         mask = df[field].notna()
-        df.loc[mask, newfield] = df.loc[mask][field].map({True: 1.0, False: 0.0})
+        df.loc[mask, newfield] = df.loc[mask, field].map({True: 1.0, False: 0.0})
     return df.copy()
 
 def formatting_report_fields(df: pd.DataFrame) -> None:
@@ -412,108 +519,18 @@ def cast_nstage_to_float(stage: str) -> float:
 def cast_grade_to_float(grade: str) -> float:
     return float(grade[-1])
 
-def cast_gstage_to_float(stage: str) -> float:
-    match stage: 
-        case '0':
-            return 0.0
-        case 'I':
-            return 1.0
-        case 'II':
-            return 2.0
-        case 'III':
-            return 3.0
-        case 'IV':
-            return 4.0
-        case _:
-            raise ValueError
-
-def cast_hGC_to_float(text: str) -> float:
-    match text: 
-        case 'normal':
-            return 0.0
-        case 'low':
-            return 1.0
-        case 'medium':
-            return 2.0
-        case 'high':
-            return 3.0
-        case _:
-            raise ValueError
-
-def cast_LDH_to_float(text: str) -> float:
-    match text: 
-        case 'normal':
-            return 0.0
-        case 'low':
-            return 1.0
-        case 'high':
-            return 2.0
-        case _:
-            raise ValueError
-
-def cast_HER2_to_float(text: str) -> float:
-    match text: 
-        case 'Negative':
-            return 0.0
-        case 'Borderline/Unknown':
-            return 1.0
-        case 'Positive':
-            return 2.0
-        case _:
-            raise ValueError
-
-def cast_peripheral_blood_to_float(text: str) -> float:
-    match text: 
-        case 'no':
-            return 0.0
-        case 'low':
-            return 1.0
-        case 'high':
-            return 2.0
-        case _:
-            raise ValueError
-
-def cast_peritoneal_cytology_to_float(text: str) -> float:
-    match text: 
-        case 'negative':
-            return 0.0
-        case 'suspicious':
-            return 1.0
-        case 'malignant':
-            return 2.0
-        case _:
-            raise ValueError
-
-def cast_pleural_invasion_to_float(text: str) -> float:
-    match text: 
-        case 'PL0':
-            return 0.0
-        case 'PL1/PL2':
-            return 1.5
-        case 'PL3':
-            return 3.0
-        case _:
-            raise ValueError
-    
+# lookup tables for cast_categorical(). values not in a table raise ValueError.
+GSTAGE_TO_FLOAT = {'0': 0.0, 'I': 1.0, 'II': 2.0, 'III': 3.0, 'IV': 4.0}
+HGC_TO_FLOAT = {'normal': 0.0, 'low': 1.0, 'medium': 2.0, 'high': 3.0}
+LDH_TO_FLOAT = {'normal': 0.0, 'low': 1.0, 'high': 2.0}
+HER2_TO_FLOAT = {'Negative': 0.0, 'Borderline/Unknown': 1.0, 'Positive': 2.0}
+PERIPHERAL_BLOOD_TO_FLOAT = {'no': 0.0, 'low': 1.0, 'high': 2.0}
+PERITONEAL_CYTOLOGY_TO_FLOAT = {'negative': 0.0, 'suspicious': 1.0, 'malignant': 2.0}
+PLEURAL_INVASION_TO_FLOAT = {'PL0': 0.0, 'PL1/PL2': 1.5, 'PL3': 3.0}
 
 # TO BOOL
-def cast_2level_elevation_to_bool(text: str) -> bool:
-    match text: 
-        case 'normal':
-            return False
-        case 'elevated':
-            return True
-        case _:
-            raise ValueError
-
-def cast_fibrosis_to_bool(text: str) -> bool:
-    match text: 
-        case 'Ishak 0-4;':
-            return False
-        case 'Ishak 5-6':
-            return True
-        case _:
-            raise ValueError
+ELEVATION_TO_BOOL = {'normal': False, 'elevated': True}
+FIBROSIS_TO_BOOL = {'Ishak 0-4;': False, 'Ishak 5-6': True}
 
 
 
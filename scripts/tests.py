@@ -1,8 +1,54 @@
-
-# import numpy as np
+import contextlib
+from dataclasses import fields, replace
+import gc
+import io
+import os
+import subprocess
+import sys
+import numpy as np
 import pandas as pd
+import tempfile
 import unittest
+import warnings
+from unittest import mock
 import helpers
+import util_filters
+import util_funcs
+from util_cache import FrameCache, local_module_files
+from util_classes import SeerRecord, format_value, iter_patients, iter_records, make_serializer
+from util_consts import ISEP_CHAR, NA_CHAR
+from dtables import AllGroupsDtableGenerator
+from util_enums import Grade, Source
+from util_profile import DecoderProfiler
+import util_io
+from util_io import open_text
+import util_writers
+from util_writers import RowFilter, read_partitioned, read_table, tsv_header
+
+# clean_case_data.py & synth_seer_export.py are at the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bench_ingest
+import clean_case_data
+import clean_patient_data
+import clean_survival_data
+from synth_seer_export import gen_synthetic_lines, write_synthetic_export
+
+# a small synthetic case listing export: 200 rows, patients sorted & contiguous
+SAMPLE_EXPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'sample_export.txt')
+
+def sample_lines(nrows):
+    """nrows export lines, repeating SAMPLE_EXPORT with new patient ids each time round."""
+    with open(SAMPLE_EXPORT) as fp:
+        lines = fp.readlines()
+    out = []
+    for i in range(nrows):
+        pid, rest = lines[i % len(lines)].split('\t', 1)
+        out.append(f'{int(pid) + i // len(lines) * 1_000_000}\t{rest}')
+    return out
+
+def write_sample_export(path, nrows):
+    with open(path, 'w') as fp:
+        fp.writelines(sample_lines(nrows))
 
 class TestVariableEncoding(unittest.TestCase):
 
@@ -99,6 +145,877 @@ class TestVariableEncoding(unittest.TestCase):
         self.assertEqual(helpers.numeric2categorical(5, catranges), 'high (5-5)')
         self.assertRaises(ValueError, helpers.numeric2categorical, 1, catranges)
 
+
+class TestSeerRecord(unittest.TestCase):
+
+    LINE = '\t'.join([
+        '1001', '.', '2017', '2019', '01-04 years', 'Breast', 'Breast', 'Breast', 'Breast',
+        'T4', '.', 'IIB', 'P', '.', '.', 'B_CELL', '.', 'POS_ASPIRATION', '0', '.', 
+        'BORDERLINE', '1', '0', '98.0', '.', '9590', '814-838: adenomas and adenocarcinomas', 
+        'True', 'True', 'False', 'False', 'True', '.',
+    ])
+
+    def test_fromstr_roundtrip(self):
+        record = SeerRecord.fromstr(self.LINE + '\n')
+        self.assertEqual(record.tostr(), self.LINE)
+
+    def test_serializer(self):
+        names = [f.name for f in fields(SeerRecord)]
+        records = [clean_case_data.gen_record(line) for line in sample_lines(200)]
+        # NA members, and raw text in an enum field
+        records.append(replace(records[0], grade=Grade.NA, t_stage_src=None, psa=None, brain_met=False))
+        records.append(replace(records[0], grade='G9'))
+        for outfields in [None, ('grade', 'patient_id', 'brain_met')]:
+            serialize = make_serializer(outfields)
+            for rec in records:
+                expected = '\t'.join([format_value(getattr(rec, name)) for name in outfields or names])
+                self.assertEqual(serialize(rec), expected)
+        self.assertIs(make_serializer(), make_serializer())
+        self.assertFalse(hasattr(records[0], '__dict__'))
+
+    def test_fromstr_types(self):
+        record = SeerRecord.fromstr(self.LINE)
+        self.assertEqual(record.patient_id, 1001)
+        self.assertIsNone(record.patient_death_year)
+        self.assertEqual(record.t_stage_src, Source.PATHOLOGICAL)
+        self.assertEqual(record.n_stage_src, Source.NA)
+        self.assertEqual(record.psa, 98.0)
+        self.assertIs(record.brain_met, True)
+        self.assertIsNone(record.distant_ln)
+        self.assertRaises(ValueError, SeerRecord.fromstr, self.LINE.replace('BORDERLINE', 'MALIGN'))
+
+    def test_fromstr_invalid_enum_text(self):
+        # member names which aren't the tsv text, and an alias of another enum
+        for index, text in [(15, 'NA'), (12, 'PATHOLOGICAL'), (17, 'B_CELL'), (20, 'NA')]:
+            lsplit = self.LINE.split('\t')
+            lsplit[index] = text
+            self.assertRaises(ValueError, SeerRecord.fromstr, '\t'.join(lsplit))
+
+    def test_iter_records(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cases.tsv')
+            open(path, 'w').close()
+            self.assertEqual(list(iter_records(path)), [])
+            with open(path, 'w') as fp:
+                fp.write(tsv_header() + self.LINE + '\n')
+            self.assertEqual([rec.tostr() for rec in iter_records(path)], [self.LINE])
+
+    def test_iter_patients(self):
+        records = [SeerRecord.fromstr(self.LINE.replace('1001', pid, 1)) for pid in ['1001', '1001', '1002']]
+        patients = list(iter_patients(records))
+        self.assertEqual([len(patient.records) for patient in patients], [2, 1])
+        self.assertRaises(ValueError, list, iter_patients(records[::-1]))
+
+    def test_patient_update_order(self):
+        base = SeerRecord.fromstr(self.LINE)
+        records = [replace(base, diagnosis_year=year, hist_type=i) for i, year in enumerate([2015, 2012, 2015, 2010])]
+        records[1] = replace(records[1], grade=Grade.NA)
+        patient = next(iter_patients(records))
+        self.assertEqual([(rec.diagnosis_year, rec.hist_type) for rec in patient.records], [(2010, 3), (2012, 1), (2015, 0), (2015, 2)])
+        row = patient.todict()
+        self.assertEqual(row['grades'].split(ISEP_CHAR), ['B_CELL', NA_CHAR, 'B_CELL', 'B_CELL'])
+        self.assertEqual(row['diag_years'].split(ISEP_CHAR), ['2010', '2012', '2015', '2015'])
+
+    def test_write_patient_table(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            infile = os.path.join(tmpdir, 'export.txt')
+            cases = os.path.join(tmpdir, 'cases.tsv')
+            outfile = os.path.join(tmpdir, 'patients.tsv.gz')
+            write_sample_export(infile, 300)
+            convert_quietly(infile, cases)
+            with contextlib.redirect_stdout(io.StringIO()):
+                npatients = clean_patient_data.write_patient_table(cases, outfile)
+            patients = pd.read_csv(outfile, sep='\t')
+            self.assertEqual(npatients, read_table(cases)['patient_id'].nunique())
+            self.assertEqual(len(patients), npatients)
+            self.assertEqual(patients['num_records'].sum(), 300)
+
+
+ANALYSIS_HEADER = [
+    'patient_id', 'cancer_group', 'cancer_type', 'hist_group', 'diagnosis_year', 'age',
+    'brain_met', 'bone_met', 'lung_met', 'liver_met', 'other_met', 
+    'NSTAGE_STD', 'regional_nodes', 'distant_ln_met',
+]
+ANALYSIS_ROWS = [
+    ['1', 'Breast', 'Breast', 'adenomas and adenocarcinomas', '2015', '60-64 years', 
+     'True', 'False', 'False', 'False', 'False', 'N1', 'POS_NODES', 'False'],
+    ['2', 'Lung and Bronchus', 'Lung and Bronchus', 'squamous cell neoplasms', '2016', '70-74 years', 
+     'False', '', 'False', 'False', 'True', 'N0', 'NEG', ''],
+]
+
+def write_analysis_table(path, rows=ANALYSIS_ROWS):
+    with open(path, 'w') as fp:
+        fp.write('\t'.join(ANALYSIS_HEADER) + '\n')
+        for row in rows:
+            fp.write('\t'.join(row) + '\n')
+
+
+class TestLoadSeerData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'analysis.clean.tsv')
+        write_analysis_table(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _load(self, source, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return helpers.load_seer_data(source, **kwargs)
+
+    def test_reassign_cancer_groups(self):
+        df = self._load(self.path)
+        gen = AllGroupsDtableGenerator(df, ['Breast'], [], [], 'brain_met_BOOL')
+        df = gen._reassign_cancer_groups(df)
+        self.assertEqual(list(df['cancer_group_CAT']), ['Breast', gen.CANCER_PLACEHOLDER])
+
+    def test_typed_frame_source(self):
+        typed = read_table(self.path)
+        self.assertIsInstance(typed['cancer_group'].dtype, pd.CategoricalDtype)
+        df = self._load(typed)
+        self.assertFalse(isinstance(df['cancer_group_CAT'].dtype, pd.CategoricalDtype))
+        gen = AllGroupsDtableGenerator(df, ['Breast'], [], [], 'brain_met_BOOL')
+        gen._reassign_cancer_groups(df)
+
+    def test_pushdown(self):
+        # patients with records in & out of the filters, and a duplicate
+        groups = ['Breast', 'Brain', 'Lung and Bronchus']
+        hists = ['adenomas and adenocarcinomas', 'unspecified neoplasms']
+        rows = []
+        for i in range(60):
+            row = list(ANALYSIS_ROWS[i % 2])
+            row[:5] = [str(i // 3), groups[i % 3], groups[i % 3], hists[i % 5 == 0], str(2007 + i % 15)]
+            rows.append(row)
+        write_analysis_table(self.path, rows)
+        outputs = []
+        for kwargs, chunk_rows in [({}, 1000), (helpers.BASIC_FILTERS, 1000), (helpers.BASIC_FILTERS, 7)]:
+            with mock.patch.object(util_writers, 'READ_CHUNK_ROWS', chunk_rows):
+                log = io.StringIO()
+                with contextlib.redirect_stdout(log):
+                    df = helpers.load_seer_data(self.path, **kwargs)
+            outputs.append((df.reset_index(drop=True), log.getvalue()))
+        expected, expected_log = outputs[0]
+        self.assertGreater(len(expected), 0)
+        self.assertIn('Beginning: 20 patients, 60 records.', expected_log)
+        self.assertIn("20 records where 'cancer_group' in ['Brain', 'Miscellaneous'].", expected_log)
+        for df, log in outputs[1:]:
+            self.assertTrue(df.equals(expected))
+            self.assertEqual(log, expected_log)
+
+    def test_partitioned_dir_rejected(self):
+        self.assertRaises(ValueError, self._load, self.tmpdir.name)
+
+
+def convert_quietly(*args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        clean_case_data.convert(*args, **kwargs)
+
+def sorted_text(df):
+    """df's values as text, in a fixed row order, for comparing tables read differently."""
+    return df.astype(object).astype(str).sort_values(list(df.columns)).reset_index(drop=True)
+
+
+class TestConvert(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.infile = os.path.join(cls.tmpdir.name, 'export.txt')
+        cls.flat = os.path.join(cls.tmpdir.name, 'flat.tsv')
+        write_sample_export(cls.infile, 2000)
+        convert_quietly(cls.infile, cls.flat)
+        with open(cls.flat) as fp:
+            cls.expected = fp.read()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def _convert(self, name, **kwargs):
+        outfile = os.path.join(self.tmpdir.name, name)
+        convert_quietly(self.infile, outfile, **kwargs)
+        return outfile
+
+    def test_workers(self):
+        # several byte ranges, so the pool's results must come back in input order
+        with mock.patch.object(clean_case_data, 'CHUNK_BYTES', 50000):
+            outfile = self._convert('workers.tsv', workers=3)
+        with open(outfile) as fp:
+            self.assertEqual(fp.read(), self.expected)
+
+    def test_columnar(self):
+        for workers in [1, 2]:
+            outfile = self._convert('columnar.tsv', columnar=True, workers=workers)
+            with open(outfile) as fp:
+                self.assertEqual(fp.read(), self.expected)
+
+    def test_raw_columns(self):
+        with open(self.infile) as fp:
+            lines = fp.readlines()[:200]
+        plan = clean_case_data.FULL_PLAN
+        needed = sorted({c for _, _, cols in plan.decoders for c in cols})
+        positions = [plan.positions[c] for c in needed]
+        arrow = clean_case_data.read_raw_columns(lines, plan)
+        pandas = clean_case_data._read_raw_columns_pandas(lines, needed, positions)
+        for c in needed:
+            self.assertEqual(list(arrow[c].astype(object)), list(pandas[c].astype(object)))
+        for bad in ['\n', '1\t2\n']:
+            with self.assertRaises(IndexError):
+                clean_case_data.read_raw_columns(lines[:5] + [bad] + lines[5:10], plan)
+
+    def test_parquet(self):
+        import pyarrow.parquet as pq
+        outfile = self._convert('out.parquet', fmt='parquet', workers=2)
+        self.assertTrue(pq.read_schema(outfile).equals(util_writers.arrow_schema()))
+        flat = read_table(self.flat)
+        parquet = pd.read_parquet(outfile).astype(flat.dtypes.to_dict())
+        self.assertTrue(sorted_text(flat).equals(sorted_text(parquet)))
+
+
+class TestPrimarySiteTable(unittest.TestCase):
+
+    def _reference(self, code):
+        """the explicit map, then the code ranges, then the Hodgkin/NHL fallback."""
+        if code in clean_case_data.PRIMARYCODE_PRIMARYSITE_MAP:
+            return clean_case_data.PRIMARYCODE_PRIMARYSITE_MAP[code]
+        for lo, hi, site in clean_case_data.PRIMARYCODE_PRIMARYSITE_RANGES:
+            if lo <= code <= hi:
+                return site
+        if code in clean_case_data.NHL_BLACKLIST_CODES:
+            return 'Hodgkin - Extranodal'
+        return 'Hodgkin - Extranodal | NHL - Extranodal'
+
+    def test_lookup(self):
+        codes = np.arange(-5, clean_case_data.PRIMARYCODE_MAX + 50)
+        expected = [self._reference(int(code)) for code in codes]
+        self.assertEqual([clean_case_data.lookup_primary_site(int(code)) for code in codes], expected)
+        self.assertEqual(list(clean_case_data.lookup_primary_sites(codes)), expected)
+
+
+class TestDecoderCache(unittest.TestCase):
+
+    CACHED = ['get_stage_ajcc', '_get_grade_cached', '_get_primary_type_cached']
+
+    def test_same_records_as_uncached(self):
+        lines = sample_lines(500)
+        for name in self.CACHED:
+            getattr(clean_case_data, name).cache_clear()
+        cached = [clean_case_data.gen_record(line) for line in lines]
+        stats = clean_case_data.cache_stats()
+        uncached = {name: getattr(clean_case_data, name).__wrapped__ for name in self.CACHED}
+        with mock.patch.multiple(clean_case_data, **uncached):
+            expected = [clean_case_data.gen_record(line) for line in lines]
+        self.assertEqual(cached, expected)
+        for name, st in stats.items():
+            self.assertGreater(st['hits'], 0, name)
+            self.assertEqual(st['size'], st['misses'], name)
+            self.assertAlmostEqual(st['hit_rate'], st['hits'] / (st['hits'] + st['misses']))
+
+
+class TestCompressed(unittest.TestCase):
+
+    def test_convert_compressed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lines = sample_lines(100)
+            plain = os.path.join(tmpdir, 'export.txt')
+            with open(plain, 'w') as fp:
+                fp.writelines(lines)
+            convert_quietly(plain, os.path.join(tmpdir, 'plain.tsv'))
+            with open(os.path.join(tmpdir, 'plain.tsv')) as fp:
+                expected = fp.read()
+            for ext in ['.gz', '.bz2', '.xz']:
+                infile = os.path.join(tmpdir, 'export.txt' + ext)
+                outfile = os.path.join(tmpdir, 'out.tsv' + ext)
+                with open_text(infile, 'w') as fp:
+                    fp.writelines(lines)
+                convert_quietly(infile, outfile)
+                with open_text(outfile, 'r') as fp:
+                    self.assertEqual(fp.read(), expected)
+
+    def test_unsupported_compression(self):
+        with mock.patch.object(util_io, 'get_compression', return_value='lz4'):
+            self.assertRaises(ValueError, open_text, 'export.txt.lz4')
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.infile = os.path.join(self.tmpdir.name, 'export.txt')
+        lines = sample_lines(300)
+        # bad rows before & after the interruption
+        for i in [5, 250]:
+            lines[i] = '\t'.join(lines[i].split('\t')[:12]) + '\n'
+        with open(self.infile, 'w') as fp:
+            fp.writelines(lines)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _paths(self, name):
+        return os.path.join(self.tmpdir.name, name + '.tsv'), os.path.join(self.tmpdir.name, name + '.rejects.tsv')
+
+    def test_resume(self):
+        expected, expected_rejects = self._paths('full')
+        outfile, rejectfile = self._paths('resumed')
+        write = util_writers.TsvWriter.write
+        written = []
+        def interrupt(writer, payload):
+            if len(written) == 2:
+                raise RuntimeError('interrupted')
+            written.append(payload)
+            write(writer, payload)
+
+        with mock.patch.object(clean_case_data, 'CHUNK_BYTES', 8 * 1024):
+            convert_quietly(self.infile, expected, rejectfile=expected_rejects)
+            with mock.patch.object(util_writers.TsvWriter, 'write', interrupt):
+                with warnings.catch_warnings():
+                    # the interrupted run's files are left open, as after a crash
+                    warnings.simplefilter('ignore', ResourceWarning)
+                    self.assertRaises(RuntimeError, convert_quietly, self.infile, outfile, rejectfile=rejectfile)
+                    gc.collect()
+            self.assertTrue(os.path.exists(clean_case_data.checkpoint_path(outfile)))
+            log = io.StringIO()
+            with contextlib.redirect_stdout(log):
+                clean_case_data.convert(self.infile, outfile, resume=True, rejectfile=rejectfile)
+            self.assertIn('Resuming from record', log.getvalue())
+        for actual, wanted in [(outfile, expected), (rejectfile, expected_rejects)]:
+            with open(actual) as fp, open(wanted) as wfp:
+                self.assertEqual(fp.read(), wfp.read())
+        self.assertFalse(os.path.exists(clean_case_data.checkpoint_path(outfile)))
+
+    def test_not_resumable(self):
+        for fmt, name in [('tsv', 'out.tsv.gz'), ('parquet', 'out.parquet'), ('coded', 'out.coded')]:
+            outfile = os.path.join(self.tmpdir.name, name)
+            self.assertRaises(ValueError, convert_quietly, self.infile, outfile, fmt=fmt, resume=True)
+
+
+class TestQuarantine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.infile = os.path.join(self.tmpdir.name, 'export.txt')
+        self.outfile = os.path.join(self.tmpdir.name, 'out.tsv')
+        self.rejectfile = os.path.join(self.tmpdir.name, 'rejects.tsv')
+        lines = sample_lines(50)
+        # a truncated row, and an unmapped grade
+        lines[3] = '\t'.join(lines[3].split('\t')[:12]) + '\n'
+        lsplit = lines[7].split('\t')
+        lsplit[25:28] = ['Grade Z', 'Blank(s)', 'Blank(s)']
+        lines[7] = '\t'.join(lsplit)
+        with open(self.infile, 'w') as fp:
+            fp.writelines(lines)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_rejects(self):
+        for columnar in [False, True]:
+            convert_quietly(self.infile, self.outfile, columnar=columnar, rejectfile=self.rejectfile)
+            with open(self.rejectfile) as fp:
+                rejects = [line.split('\t')[:3] for line in fp.read().splitlines()[1:]]
+            self.assertEqual(rejects, [
+                ['line', clean_case_data.SHORT_ROW, 'expected 38 columns, found 12'],
+                ['grade,grade_src', 'KeyError', "'Grade Z'"],
+            ])
+            self.assertEqual(len(read_table(self.outfile)), 48)
+
+
+class TestFieldPlan(unittest.TestCase):
+
+    FIELDS = ['grade', 'patient_id', 'diagnosis_year', 't_stage_ajcc']
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.infile = os.path.join(self.tmpdir.name, 'export.txt')
+        self.flat = os.path.join(self.tmpdir.name, 'flat.tsv')
+        write_sample_export(self.infile, 200)
+        convert_quietly(self.infile, self.flat)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write_dic(self, path, variables):
+        with open(path, 'w') as fp:
+            fp.write('[Export Options]\nGZipped=false\n\n[Variables]\n')
+            fp.writelines(f'Var{i}Name={name}\n' for i, name in enumerate(variables))
+            fp.write('\n[Format=Patient ID]\n')
+
+    def test_projection(self):
+        outfile = os.path.join(self.tmpdir.name, 'fields.tsv')
+        convert_quietly(self.infile, outfile, plan=clean_case_data.build_field_plan(self.FIELDS))
+        expected = read_table(self.flat)[['patient_id', 'diagnosis_year', 't_stage_ajcc', 'grade']]
+        self.assertTrue(sorted_text(expected).equals(sorted_text(read_table(outfile))))
+
+    def test_dic_layout(self):
+        # the same export with its columns in reverse order, located by the .dic names
+        reordered = os.path.join(self.tmpdir.name, 'reordered.txt')
+        with open(self.infile) as infp, open(reordered, 'w') as outfp:
+            for line in infp:
+                outfp.write('\t'.join(line.rstrip('\n').split('\t')[::-1]) + '\n')
+        dic = os.path.join(self.tmpdir.name, 'reordered.dic')
+        self._write_dic(dic, clean_case_data.INPUT_VARIABLES[::-1])
+        variables = util_io.read_dic_variables(dic)
+        self.assertEqual(variables, clean_case_data.INPUT_VARIABLES[::-1])
+        for columnar in [False, True]:
+            outfile = os.path.join(self.tmpdir.name, 'dic.tsv')
+            convert_quietly(reordered, outfile, columnar=columnar, plan=clean_case_data.build_field_plan(None, variables))
+            with open(self.flat) as fp1, open(outfile) as fp2:
+                self.assertEqual(fp1.read(), fp2.read())
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, clean_case_data.build_field_plan, ['not_a_field'])
+        variables = [name for name in clean_case_data.INPUT_VARIABLES if name != 'Primary Site']
+        self.assertRaises(ValueError, clean_case_data.build_field_plan, ['primary_type'], variables)
+        clean_case_data.build_field_plan(['diagnosis_year'], variables)
+
+
+class TestIngest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.infile = os.path.join(cls.tmpdir.name, 'export.txt')
+        cls.flat = os.path.join(cls.tmpdir.name, 'flat.tsv')
+        write_sample_export(cls.infile, 300)
+        convert_quietly(cls.infile, cls.flat)
+        with contextlib.redirect_stdout(io.StringIO()):
+            cls.df = clean_case_data.ingest(cls.infile)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_matches_tsv(self):
+        flat = read_table(self.flat)
+        self.assertTrue(flat.dtypes.equals(self.df.dtypes))
+        self.assertTrue(sorted_text(flat).equals(sorted_text(self.df)))
+
+    def test_load_seer_data_rejects(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertRaises(ValueError, helpers.load_seer_data, self.df)
+
+    def test_basic_filtering(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            df = util_funcs.do_basic_filtering(self.df)
+            df = util_funcs.remove_identical_primary_secondary_cases(df)
+        self.assertTrue(df['diagnosis_year'].between(2010, 2020).all())
+        self.assertFalse(df.duplicated(['patient_id', 'cancer_type']).any())
+        self.assertFalse(((df['brain_met'] == True) & (df['cancer_type'] == 'Brain')).any())
+
+
+class TestBenchIngest(unittest.TestCase):
+
+    def test_cold_and_warm(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'export.txt')
+            write_synthetic_export(path, 300, seed=4)
+            clean_case_data.gen_record(open(path).readline())
+            result = bench_ingest.bench_file(path)
+        self.assertEqual(result['rows'], 300)
+        names = list(bench_ingest.BENCHMARKS) + [f'{name} (warm)' for name in bench_ingest.MEMOISED_BENCHMARKS]
+        self.assertEqual(set(result['decoders']), set(names))
+        # the cold gen_record pass starts from empty caches
+        stage = result['cache']['get_stage_ajcc']
+        self.assertEqual(stage['hits'] + stage['misses'], 3 * 300)
+        self.assertGreater(stage['misses'], 0)
+
+    def test_comparison_untimed(self):
+        def result(rates):
+            decoders = {name: {'seconds': 1.0, 'rows_per_sec': rate} for name, rate in rates.items()}
+            return {'results': [{'rows': 10, 'peak_rss_mb': 1.0, 'decoders': decoders}]}
+        before = result({'a': 10.0, 'b': 0, 'c': 10.0})
+        after = result({'a': 20.0, 'b': 10.0, 'c': None})
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            bench_ingest.print_result(after['results'][0])
+            bench_ingest.print_comparison(before, after)
+        self.assertIn('2.00x', log.getvalue())
+
+
+class TestProfiledPlan(unittest.TestCase):
+
+    def test_profiled_plan(self):
+        lines = list(gen_synthetic_lines(50, seed=3))
+        expected = clean_case_data.decode_block(lines, clean_case_data.FULL_PLAN)
+        untimed = [func for _, func, _ in clean_case_data.FULL_PLAN.decoders]
+        clean_case_data.get_stage_ajcc.cache_clear()
+        for columnar in [False, True]:
+            profiler = DecoderProfiler()
+            plan = clean_case_data.profiled_plan(clean_case_data.FULL_PLAN, profiler)
+            if columnar:
+                block = clean_case_data.decode_block(lines, plan)
+            else:
+                rows = [clean_case_data.decode_line(line, plan) for line in lines]
+                block = {field: [row[i] for row in rows] for i, field in enumerate(plan.fields)}
+            for field, values in expected.items():
+                self.assertEqual(list(block[field]), list(values))
+            # rows are counted per row in both modes, calls per distinct input under columnar
+            self.assertEqual(profiler.rows['get_patient_id'], len(lines))
+            self.assertEqual(profiler.calls['get_patient_id'] == len(lines), not columnar)
+            self.assertEqual(profiler.rows['get_t_stage'], len(lines))
+            self.assertEqual(profiler.rows['get_stage_ajcc'], 3 * len(lines))
+            branches = [name for name in profiler.rows if name.startswith('get_stage_ajcc[t:')]
+            self.assertEqual(sum(profiler.rows[name] for name in branches), len(lines))
+            self.assertEqual(sum(profiler.calls[name] for name in branches), profiler.calls['get_t_stage'])
+        # profiling bypasses the stage cache, & the module's decoders & plans are left untimed
+        self.assertEqual(clean_case_data.get_stage_ajcc.cache_info().currsize, 0)
+        self.assertEqual([func for _, func, _ in clean_case_data.FULL_PLAN.decoders], untimed)
+        self.assertIsNone(clean_case_data.FULL_PLAN.profiler)
+        self.assertIs(clean_case_data.get_t_stage, clean_case_data.COLUMN_DECODERS[9][1])
+        self.assertFalse(hasattr(clean_case_data.get_t_stage, '__wrapped__'))
+
+
+class TestPartitioned(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.infile = os.path.join(cls.tmpdir.name, 'export.txt')
+        cls.flat = os.path.join(cls.tmpdir.name, 'flat.tsv')
+        cls.parts = os.path.join(cls.tmpdir.name, 'parts')
+        write_synthetic_export(cls.infile, 300, seed=1)
+        convert_quietly(cls.infile, cls.flat)
+        convert_quietly(cls.infile, cls.parts, partition=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_roundtrip(self):
+        flat = read_table(self.flat)
+        # batched & one file per read_table()
+        for batch_bytes in [util_writers.PARTITION_BATCH_BYTES, 1]:
+            with mock.patch.object(util_writers, 'PARTITION_BATCH_BYTES', batch_bytes):
+                parts = read_partitioned(self.parts)
+            self.assertTrue(flat.dtypes.equals(parts.dtypes))
+            self.assertTrue(sorted_text(flat).equals(sorted_text(parts)))
+
+    def test_select_partitions(self):
+        flat = read_table(self.flat)
+        flat = flat[flat['cancer_group'].isin(['Breast', 'Lung']) & flat['diagnosis_year'].isin([2012, 2015])]
+        parts = read_partitioned(self.parts, cancer_groups=['Breast', 'Lung'], years=[2012, 2015])
+        self.assertTrue(sorted_text(flat).equals(sorted_text(parts)))
+
+    def test_rows_filter(self):
+        rows = RowFilter(year_range=(2012, 2015), exclude_cancer_groups={'Oral'})
+        flat = read_table(self.flat)
+        flat = flat[rows.mask(flat)]
+        # batched & one file per read_table()
+        for batch_bytes in [util_writers.PARTITION_BATCH_BYTES, 1]:
+            with mock.patch.object(util_writers, 'PARTITION_BATCH_BYTES', batch_bytes):
+                parts = read_partitioned(self.parts, columns=['patient_id', 'cancer_group', 'diagnosis_year'], rows=rows)
+            self.assertEqual(list(parts.columns), ['patient_id', 'diagnosis_year', 'cancer_group'])
+            self.assertTrue(sorted_text(flat[list(parts.columns)]).equals(sorted_text(parts)))
+
+
+class TestCoded(unittest.TestCase):
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            infile = os.path.join(tmpdir, 'export.txt')
+            write_synthetic_export(infile, 300, seed=2)
+            convert_quietly(infile, os.path.join(tmpdir, 'flat.tsv'))
+            convert_quietly(infile, os.path.join(tmpdir, 'coded.tsv'), fmt='coded')
+            flat = read_table(os.path.join(tmpdir, 'flat.tsv'))
+            coded = util_writers.read_coded(os.path.join(tmpdir, 'coded.tsv'))
+            self.assertTrue(flat.dtypes.equals(coded.dtypes))
+            self.assertTrue(sorted_text(flat).equals(sorted_text(coded)))
+
+    def test_unsupported_options(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertRaises(ValueError, util_writers.PartitionedWriter, os.path.join(tmpdir, 'parts'), 'coded')
+            argv = ['clean_case_data.py', 'export.txt', os.path.join(tmpdir, 'parts'), '--format', 'coded', '--partition']
+            with mock.patch.object(sys, 'argv', argv), contextlib.redirect_stderr(io.StringIO()):
+                self.assertRaises(SystemExit, clean_case_data.parse_args)
+
+
+class TestSurvivalTables(unittest.TestCase):
+
+    LINES = [
+        'Page\tLung\tsome other table\n',
+        'Age-Standardized Life\tLung\t0 mo-<6 mo\t1,200\t100\t10\t91.5%\t91.5%\t99.0%\t99.0%\t92.4%\t92.4%\t0.8%\t0.8%\t.\t.\n',
+        'Age-Standardized Life\tLung\t6 mo-<12 mo\t1,090\t90\t20\t91.7%\t83.9%\t99.1%\t98.1%\t92.5%\t85.5%\t0.8%\t1.1%\t.\t.\n',
+        'Age-Standardized Life\tLung\t12 mo-<18 mo\t0\t0\t0\t+\t+\t.\t.\t.\t.\t.\t.\t.\t.\n',
+    ]
+
+    def test_clean_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jobs = []
+            for i in range(3):
+                infile = os.path.join(tmpdir, f'export{i}.txt.gz')
+                with open_text(infile, 'w') as fp:
+                    fp.writelines(self.LINES)
+                jobs.append((infile, clean_survival_data.output_path(infile, tmpdir)))
+            results = clean_survival_data.clean_survival_files(jobs, workers=2)
+            self.assertEqual([(infile, outfile) for infile, outfile, _ in results], jobs)
+            self.assertEqual([nrows for _, _, nrows in results], [2, 2, 2])
+            table = clean_survival_data.read_life_table(jobs[0][1])
+            self.assertEqual(table['month'].tolist(), [6, 12])
+            self.assertEqual(table['alive_at_start'].tolist(), [1200, 1090])
+            self.assertEqual(str(table['alive_at_start'].dtype), 'Int64')
+            self.assertEqual(table['observed_cum'].tolist(), [91.5, 83.9])
+            self.assertTrue(table['SE_relative_int'].isna().all())
+
+    def test_runs_without_scripts(self):
+        # run from the repo root (the notebook, the launch config) without scripts/ on the path
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = {key: val for key, val in os.environ.items() if key != 'PYTHONPATH'}
+        subprocess.run([sys.executable, '-c', 'import clean_survival_data'], cwd=root, env=env, check=True)
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.infile = os.path.join(self.tmpdir.name, 'export.txt')
+        lines = list(gen_synthetic_lines(200, seed=8))
+        for i in [10, 150]:
+            lines[i] = '\t'.join(lines[i].split('\t')[:12]) + '\n'
+        with open(self.infile, 'w') as fp:
+            fp.writelines(lines)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_merge_equals_full_run(self):
+        for fmt, ext in [('tsv', '.tsv'), ('parquet', '.parquet')]:
+            full, merged = self._path('full' + ext), self._path('merged' + ext)
+            convert_quietly(self.infile, full, fmt=fmt, rejectfile=self._path('full.rejects.tsv'))
+            for index in range(3):
+                convert_quietly(self.infile, merged, fmt=fmt, rejectfile=self._path('merged.rejects.tsv'), shard=(index, 3))
+            out = clean_case_data.merge_shards(merged, 3, self._path('merged.rejects.tsv'))
+            # records processed, rejects included, as for the full run
+            self.assertEqual(out['records'], 200)
+            self.assertEqual(out['reject_reasons'], {f'line: {clean_case_data.SHORT_ROW}': 2})
+            if fmt == 'tsv':
+                with open(full) as fp1, open(merged) as fp2:
+                    self.assertEqual(fp1.read(), fp2.read())
+            else:
+                self.assertTrue(pd.read_parquet(full).equals(pd.read_parquet(merged)))
+            with open(self._path('full.rejects.tsv')) as fp1, open(self._path('merged.rejects.tsv')) as fp2:
+                self.assertEqual(fp1.read(), fp2.read())
+
+    def test_merge_pending(self):
+        outfile = self._path('out.tsv')
+        convert_quietly(self.infile, outfile, rejectfile=self._path('rejects.tsv'), shard=(0, 2))
+        self.assertRaises(RuntimeError, clean_case_data.merge_shards, outfile, 2)
+
+
+class TestPreflight(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.infile = os.path.join(self.tmpdir.name, 'export.txt')
+        lines = list(gen_synthetic_lines(200, seed=4))
+        # an unmapped SEER grade, read when both NAACCR grades are blank
+        lsplit = lines[10].split('\t')
+        lsplit[25:28] = ['Grade Z', 'Blank(s)', 'Blank(s)']
+        lines[10] = '\t'.join(lsplit)
+        with open(self.infile, 'w') as fp:
+            fp.writelines(lines)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_unmapped(self):
+        unmapped, truncated = clean_case_data.preflight_scan(self.infile)
+        self.assertEqual(truncated, [])
+        self.assertEqual(len(unmapped), 1)
+        self.assertEqual(unmapped[0].field, 'grade,grade_src')
+        self.assertEqual(unmapped[0].values['Grade Recode (thru 2017)'], 'Grade Z')
+        self.assertEqual(unmapped[0].rows, 1)
+
+    def test_truncated(self):
+        plan = clean_case_data.build_field_plan(['diagnosis_year', 'behavior'])
+        unmapped, truncated = clean_case_data.preflight_scan(self.infile, plan, max_distinct=4)
+        # years are refused beyond the limit, exactly 4 behaviors fit
+        self.assertEqual(truncated, ['diagnosis_year'])
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            clean_case_data.print_preflight_report(unmapped, truncated, 4)
+        self.assertIn('diagnosis_year: more than 4 distinct values', log.getvalue())
+
+
+class TestFrameCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = FrameCache(self.tmpdir.name)
+        self.calls = 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _double(self, df, factor):
+        self.calls += 1
+        return df * factor
+
+    def test_stage_hit(self):
+        df = pd.DataFrame({'a': [1, 2, 3]})
+        first = self.cache.stage(df, self._double, 2)
+        second = self.cache.stage(df, self._double, 2)
+        self.assertEqual(self.calls, 1)
+        pd.testing.assert_frame_equal(first, second)
+
+    def test_stage_args_in_key(self):
+        df = pd.DataFrame({'a': [1, 2, 3]})
+        self.cache.stage(df, self._double, 2)
+        self.cache.stage(df, self._double, 3)
+        self.assertEqual(self.calls, 2)
+
+    def test_frame_args_in_key(self):
+        df = pd.DataFrame({'a': [1, 2, 3]})
+        add = lambda df, other: df + other
+        first = self.cache.stage(df, add, pd.DataFrame({'a': [0, 0, 0]}))
+        second = self.cache.stage(df, add, pd.DataFrame({'a': [0, 0, 1]}))
+        self.assertEqual(list(second['a']), [1, 2, 4])
+        self.assertFalse(first.equals(second))
+
+    def test_subset_of_cached_frame(self):
+        count = lambda df: pd.DataFrame({'n': [len(df)]})
+        cached = self.cache.stage(pd.DataFrame({'a': [1, 2, 3, 4]}), self._double, 1)
+        self.assertEqual(self.cache.stage(cached, count)['n'][0], 4)
+        subset = cached[cached['a'] > 2]
+        self.assertEqual(self.cache.stage(subset, count)['n'][0], 2)
+
+    def test_function_without_source_file(self):
+        namespace = {}
+        exec('def triple(df):\n    return df * 3\n', namespace)
+        df = pd.DataFrame({'a': [1, 2]})
+        self.assertEqual(list(self.cache.stage(df, namespace['triple'])['a']), [3, 6])
+
+    def test_local_modules_hashed(self):
+        paths = local_module_files([helpers])
+        self.assertIn(os.path.abspath(util_filters.__file__), paths)
+        self.assertFalse(any(os.path.basename(path) == 'frame.py' for path in paths))
+
+    def test_pipeline_reads_last_entry(self):
+        path = os.path.join(self.tmpdir.name, 'table.tsv')
+        pd.DataFrame({'a': [1, 2, 3]}).to_csv(path, sep='\t', index=False)
+        read = lambda path: pd.read_csv(path, sep='\t')
+        stages = [(self._double, {'factor': 2}, []), (self._double, {'factor': 5}, [])]
+        first = self.cache.pipeline(path, read, stages)
+        self.assertEqual(list(first['a']), [10, 20, 30])
+        # same keys as load() & stage()
+        df = self.cache.load(path, read)
+        df = self.cache.stage(df, self._double, factor=2)
+        self.assertEqual(self.calls, 2)
+        with mock.patch.object(pd, 'read_pickle', wraps=pd.read_pickle) as read_pickle:
+            second = self.cache.pipeline(path, read, stages)
+        self.assertEqual(read_pickle.call_count, 1)
+        self.assertEqual(self.calls, 2)
+        pd.testing.assert_frame_equal(first, second)
+
+    def test_load_basic_table(self):
+        infile = os.path.join(self.tmpdir.name, 'export.txt')
+        cases = os.path.join(self.tmpdir.name, 'cases.tsv')
+        histtypes = os.path.join(self.tmpdir.name, 'histcodes.tsv')
+        write_synthetic_export(infile, 300, seed=14)
+        convert_quietly(infile, cases)
+        with open(histtypes, 'w') as fp:
+            fp.writelines(f'{code}\thist {code}\n' for code in read_table(cases)['hist_type'].unique())
+        cache = FrameCache(os.path.join(self.tmpdir.name, 'cache'))
+        with mock.patch.object(util_funcs, 'HISTTYPES_PATH', histtypes):
+            with contextlib.redirect_stdout(io.StringIO()) as log:
+                first = util_funcs.load_basic_table(cases, ln_basis='pathological', cache=cache)
+            # a rerun is a cache hit: nothing is read or filtered again
+            with mock.patch.object(pd, 'read_csv', side_effect=AssertionError), \
+                 mock.patch.object(util_filters.FilterPipeline, 'run', side_effect=AssertionError):
+                with contextlib.redirect_stdout(io.StringIO()) as relog:
+                    second = util_funcs.load_basic_table(cases, ln_basis='pathological', cache=cache)
+        pd.testing.assert_frame_equal(first, second)
+        self.assertEqual(log.getvalue(), relog.getvalue())
+        self.assertIn('local_ln', second.columns)
+        self.assertFalse((second['GRADE_STD'] == 'T_CELL').any())
+
+
+class TestFilterPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'patient_id': [1, 1, 2, 2, 3, None, 4, 4, 5],
+            'diagnosis_year': [2009, 2012, 2015, 2015, 2011, 2012, 2013, 2013, 2021],
+            'cancer_type': ['Brain', 'Lung', 'Brain', 'Brain', 'Liver', 'Lung', 'Brain', 'Lung', 'Lung'],
+            'brain_met': pd.array([True, False, None, False, True, False, True, None, False], dtype='boolean'),
+        })
+        self.steps = [
+            ('year', util_filters.in_range('diagnosis_year', 2010, 2020)),
+            ('duplicates', util_filters.not_duplicated(['patient_id', 'cancer_type'])),
+            ('mets', util_filters.not_met_to_own_tissue({'brain_met': ['Brain']})),
+        ]
+
+    def test_counts_match_sequential_filtering(self):
+        df = self.df
+        expected = [(df['patient_id'].nunique(), len(df))]
+        df = df[df['diagnosis_year'].between(2010, 2020)]
+        expected.append((df['patient_id'].nunique(), len(df)))
+        df = df[~df.duplicated(['patient_id', 'cancer_type'])]
+        expected.append((df['patient_id'].nunique(), len(df)))
+        df = df[~((df['brain_met'] == True).fillna(False) & (df['cancer_type'] == 'Brain'))]
+        expected.append((df['patient_id'].nunique(), len(df)))
+
+        out, counts = util_filters.FilterPipeline(self.steps).run(self.df)
+        self.assertEqual([count.name for count in counts], ['start', 'year', 'duplicates', 'mets'])
+        self.assertEqual([(count.patients, count.records) for count in counts], expected)
+        removed = [(a[0] - b[0], a[1] - b[1]) for a, b in zip(expected, expected[1:])]
+        self.assertEqual([(count.removed_patients, count.removed_records) for count in counts[1:]], removed)
+        self.assertTrue(out.equals(df))
+
+    def test_run_copies(self):
+        out, _ = util_filters.FilterPipeline(self.steps).run(self.df)
+        out.loc[out.index[0], 'diagnosis_year'] = 0
+        self.assertNotIn(0, self.df['diagnosis_year'].tolist())
+
+
+class TestChunkedCounts(unittest.TestCase):
+
+    def test_matches_whole_table(self):
+        df = pd.DataFrame({
+            'patient_id': [1, 1, 2, 2, 3, None, 4, 4],
+            'year': [2009, 2012, 2015, 2021, 2011, 2012, 2013, 2014],
+            'group': ['a', 'b', 'a', 'a', 'c', 'a', 'b', 'b'],
+        })
+        steps = [
+            ('range', util_filters.in_range('year', 2010, 2020)),
+            ('groups', util_filters.not_in('group', ['b'])),
+        ]
+        # the same steps applied to the whole table at once
+        keep = np.ones(len(df), dtype=bool)
+        expected = [('start', df['patient_id'].nunique(), len(df))]
+        for name, func in steps:
+            keep &= func(df, keep)
+            expected.append((name, df.loc[keep, 'patient_id'].nunique(), int(keep.sum())))
+        chunked = util_filters.ChunkedCounts(steps)
+        masks = [chunked.mask(df.iloc[start:start + 3]) for start in range(0, len(df), 3)]
+        np.testing.assert_array_equal(np.concatenate(masks), keep)
+        counts = chunked.counts()
+        self.assertEqual([(c.name, c.patients, c.records) for c in counts], expected)
+        self.assertEqual([c.removed_records for c in counts], [0, 2, 3])
+
+
+class TestCastCategorical(unittest.TestCase):
+
+    def test_lookup(self):
+        values = pd.Series(['I', None, 'IV', 'I'])
+        actual = helpers.cast_categorical(values, helpers.GSTAGE_TO_FLOAT, dtype=float)
+        np.testing.assert_array_equal(actual, [1.0, np.nan, 4.0, 1.0])
+
+    def test_categorical_codes(self):
+        values = pd.Series(['elevated', 'normal', None], dtype='category')
+        values = values.cat.add_categories(['unused'])
+        actual = helpers.cast_categorical(values, helpers.ELEVATION_TO_BOOL)
+        self.assertEqual(list(actual[:2]), [True, False])
+        self.assertTrue(pd.isna(actual[2]))
+
+    def test_unknown_raises(self):
+        values = pd.Series(['Negative', 'Equivocal'])
+        self.assertRaises(ValueError, helpers.cast_categorical, values, helpers.HER2_TO_FLOAT)
+
         
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,311 @@
+from __future__ import annotations
+from typing import Any, Callable, Optional, Tuple
+from contextlib import redirect_stdout
+import hashlib
+import inspect
+import io
+import os
+import pickle
+import sys
+import sysconfig
+import types
+import weakref
+import pandas as pd
+
+"""
+On-disk cache of processed DataFrames, so notebooks don't redo the same loading,
+filtering & formatting after every kernel restart.
+
+    cache = FrameCache()
+    df = cache.load(INFILE, read_table)
+    df = cache.stage(df, do_basic_filtering)
+    df = cache.stage(df, remove_identical_primary_secondary_cases)
+    df = cache.stage(df, do_basic_formatting, deps=[HISTTYPES_PATH])
+
+or, reading only the last cached frame of the chain (see pipeline()):
+
+    df = cache.pipeline(INFILE, read_table, [
+        (do_basic_filtering, {}, []),
+        (remove_identical_primary_secondary_cases, {}, []),
+        (do_basic_formatting, {}, [HISTTYPES_PATH]),
+    ])
+
+Each result is keyed on the key of its input frame (for load(), the input file),
+the stage function, its arguments, the source of every local module the stage 
+reaches (see code_fingerprint()) and any deps files, so editing the code or the 
+data invalidates the entries built from it. Frames are pickled. What a stage 
+prints is saved and printed again on a cache hit. Least recently used entries 
+are evicted above max_bytes.
+
+A frame the cache returned is known by its key only while it is that exact object 
+(with the same columns & length). Frames derived from it (subsets, copies) are 
+keyed on their content instead. Don't modify a returned frame in place and then 
+stage it: the cache can't tell.
+"""
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'seer_frames')
+CACHE_MAX_BYTES = 10 * 1024**3
+# bytes hashed at each end of an input file (with its size & mtime)
+FINGERPRINT_BYTES = 1024**2
+# module files under these directories are libraries, not hashed into stage keys
+LIBRARY_DIRS = sorted({os.path.abspath(path) for name, path in sysconfig.get_paths().items() if name in ['stdlib', 'platstdlib', 'purelib', 'platlib']})
+
+def file_fingerprint(path: str) -> str:
+    """cheap fingerprint of a (possibly huge) file: path, size, mtime, first & last FINGERPRINT_BYTES."""
+    st = os.stat(path)
+    h = hashlib.sha256(f'{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}'.encode())
+    with open(path, 'rb') as fp:
+        h.update(fp.read(FINGERPRINT_BYTES))
+        if st.st_size > FINGERPRINT_BYTES:
+            fp.seek(max(st.st_size - FINGERPRINT_BYTES, FINGERPRINT_BYTES))
+            h.update(fp.read())
+    return h.hexdigest()
+
+def code_fingerprint(func: Callable) -> str:
+    """
+    hash of func's code and of the source of every local module it reaches: 
+    the module defining func, and recursively the local modules & functions 
+    referenced by each module's globals. library modules (LIBRARY_DIRS) aren't 
+    hashed. a func with no source file (eg defined in a notebook) is hashed by 
+    its source text, or its bytecode if that isn't available either.
+    """
+    func = getattr(func, '__func__', func)  # bound methods
+    h = hashlib.sha256(f'{func.__module__}.{func.__qualname__}'.encode())
+    try:
+        h.update(inspect.getsource(func).encode())
+    except (OSError, TypeError):
+        if hasattr(func, '__code__'):
+            h.update(_code_digest(func.__code__).encode())
+    roots = [sys.modules.get(func.__module__)]
+    if hasattr(func, '__globals__'):
+        roots += _referenced_modules(func.__globals__)
+    for path in local_module_files([mod for mod in roots if mod is not None]):
+        h.update(path.encode())
+        try:
+            with open(path, 'rb') as fp:
+                h.update(fp.read())
+        except OSError:
+            pass  # eg a notebook cell's pseudo file
+    return h.hexdigest()
+
+def local_module_files(modules: list[types.ModuleType]) -> list[str]:
+    """source files of modules and of the local modules they reference, transitively."""
+    seen: dict[str, str] = {}
+    stack = list(modules)
+    while stack:
+        module = stack.pop()
+        if module.__name__ in seen:
+            continue
+        path = getattr(module, '__file__', None)
+        if path is None or _is_library(path):
+            seen[module.__name__] = ''
+            continue
+        seen[module.__name__] = os.path.abspath(path)
+        stack.extend(_referenced_modules(vars(module)))
+    return sorted(path for path in seen.values() if path)
+
+def _referenced_modules(namespace: dict[str, Any]) -> list[types.ModuleType]:
+    """modules in namespace, and the modules defining its functions & classes."""
+    out = []
+    for value in list(namespace.values()):
+        if isinstance(value, types.ModuleType):
+            out.append(value)
+        elif isinstance(value, (types.FunctionType, type)):
+            module = sys.modules.get(getattr(value, '__module__', None) or '')
+            if module is not None:
+                out.append(module)
+    return out
+
+def _is_library(path: str) -> bool:
+    path = os.path.abspath(path)
+    return any(path.startswith(libdir + os.sep) for libdir in LIBRARY_DIRS)
+
+def _code_digest(code: types.CodeType) -> str:
+    """bytecode, names & constants of code (and its nested code), without file names or line numbers."""
+    h = hashlib.sha256(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            h.update(_code_digest(const).encode())
+        else:
+            h.update(repr(const).encode())
+    return h.hexdigest()
+
+def value_fingerprint(value: Any) -> str:
+    """
+    hash of a stage argument. frames & series by content, containers by their 
+    items (sets in sorted order), other values pickled. unpicklable values fall 
+    back to repr().
+    """
+    if isinstance(value, pd.DataFrame):
+        return frame_fingerprint(value)
+    if isinstance(value, pd.Series):
+        return frame_fingerprint(value.to_frame())
+    if isinstance(value, (list, tuple)):
+        parts = [type(value).__name__] + [value_fingerprint(val) for val in value]
+    elif isinstance(value, dict):
+        parts = ['dict'] + [value_fingerprint(key) + value_fingerprint(val) for key, val in value.items()]
+    elif isinstance(value, (set, frozenset)):
+        parts = ['set'] + sorted(value_fingerprint(val) for val in value)
+    else:
+        try:
+            return hashlib.sha256(pickle.dumps(value, protocol=4)).hexdigest()
+        except Exception:
+            return hashlib.sha256(repr(value).encode()).hexdigest()
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """content hash of a frame which didn't come from the cache."""
+    h = hashlib.sha256(repr(list(df.columns)).encode())
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+# (func, kwargs, deps) of a FrameCache.pipeline() stage
+Stage = Tuple[Callable[..., pd.DataFrame], dict[str, Any], list[str]]
+
+# id(frame) -> (weak reference, key, (columns, length)) of each frame the cache returned
+_FRAME_KEYS: dict[int, Tuple[weakref.ref, str, Tuple[Any, int]]] = {}
+
+def _remember_key(df: pd.DataFrame, key: str) -> None:
+    fid = id(df)
+    ref = weakref.ref(df, lambda _: _FRAME_KEYS.pop(fid, None))
+    _FRAME_KEYS[fid] = (ref, key, (tuple(df.columns), len(df)))
+
+def frame_key(df: pd.DataFrame) -> str:
+    """key of df if the cache returned this very frame (unchanged in shape), else its content hash."""
+    entry = _FRAME_KEYS.get(id(df))
+    if entry is not None:
+        ref, key, shape = entry
+        if ref() is df and shape == (tuple(df.columns), len(df)):
+            return key
+    return frame_fingerprint(df)
+
+
+class FrameCache:
+
+    def __init__(self, root: str=CACHE_DIR, max_bytes: int=CACHE_MAX_BYTES) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def load(self, path: str, loader: Callable[..., pd.DataFrame], *args: Any, **kwargs: Any) -> pd.DataFrame:
+        """loader(path, *args, **kwargs), cached on the file's fingerprint."""
+        key = self._key(file_fingerprint(path), loader, args, kwargs, [])
+        return self._get_or_run(key, loader, (path, *args), kwargs)
+
+    def stage(
+        self,
+        df: pd.DataFrame,
+        func: Callable[..., pd.DataFrame],
+        *args: Any,
+        deps: Optional[list[str]]=None,
+        **kwargs: Any,
+        ) -> pd.DataFrame:
+        """
+        func(df, *args, **kwargs), cached on df's key & func.
+        deps: data files func reads, which are fingerprinted into the key.
+        """
+        key = self._key(frame_key(df), func, args, kwargs, deps or [])
+        return self._get_or_run(key, func, (df, *args), kwargs)
+
+    def pipeline(self, path: str, loader: Callable[..., pd.DataFrame], stages: list[Stage]) -> pd.DataFrame:
+        """
+        load(path, loader) then stage() each of stages in turn, with the same keys. 
+        a key only depends on the keys before it, so the whole chain is keyed up 
+        front and only the last cached frame is read: earlier stages just print their 
+        saved output. the stages after it are run (and cached).
+        """
+        keys = [self._key(file_fingerprint(path), loader, (), {}, [])]
+        for func, kwargs, deps in stages:
+            keys.append(self._key(keys[-1], func, (), kwargs, deps))
+        start = max([i for i, key in enumerate(keys) if os.path.exists(self._paths(key)[0])], default=0)
+        for key in keys[:start]:
+            self._print_log(key)
+        if start == 0:
+            df = self._get_or_run(keys[0], loader, (path,), {})
+        else:
+            df = self._read(keys[start])
+        for key, (func, kwargs, _) in zip(keys[start + 1:], stages[start:]):
+            df = self._get_or_run(key, func, (df,), kwargs)
+        return df
+
+    def clear(self) -> None:
+        for name in os.listdir(self.root):
+            os.remove(os.path.join(self.root, name))
+
+    def _key(self, parent: str, func: Callable, args: tuple, kwargs: dict, deps: list[str]) -> str:
+        h = hashlib.sha256(parent.encode())
+        h.update(code_fingerprint(func).encode())
+        h.update(value_fingerprint(args).encode())
+        h.update(value_fingerprint(sorted(kwargs.items())).encode())
+        for path in deps:
+            h.update(file_fingerprint(path).encode())
+        return h.hexdigest()
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        base = os.path.join(self.root, key)
+        return base + '.pkl', base + '.log'
+
+    def _print_log(self, key: str) -> None:
+        """prints what the stage of key printed when it ran."""
+        _, log_path = self._paths(key)
+        if os.path.exists(log_path):
+            with open(log_path, 'r') as fp:
+                sys.stdout.write(fp.read())
+            os.utime(log_path)
+
+    def _read(self, key: str) -> pd.DataFrame:
+        frame_path, _ = self._paths(key)
+        df = pd.read_pickle(frame_path)
+        self._print_log(key)
+        os.utime(frame_path)  # most recently used
+        _remember_key(df, key)
+        return df
+
+    def _get_or_run(self, key: str, func: Callable, args: tuple, kwargs: dict) -> pd.DataFrame:
+        frame_path, log_path = self._paths(key)
+        if os.path.exists(frame_path):
+            return self._read(key)
+
+        log = _Tee(sys.stdout)
+        with redirect_stdout(log):
+            df = func(*args, **kwargs)
+        # write then rename so an interrupted save never leaves a partial entry
+        df.to_pickle(frame_path + '.tmp')
+        os.replace(frame_path + '.tmp', frame_path)
+        with open(log_path, 'w') as fp:
+            fp.write(log.getvalue())
+        self._evict()
+        _remember_key(df, key)
+        return df
+
+    def _evict(self) -> None:
+        """removes least recently used entries until the cache is under max_bytes."""
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith('.pkl'):
+                path = os.path.join(self.root, name)
+                log_path = path[:-len('.pkl')] + '.log'
+                size = os.path.getsize(path) + (os.path.getsize(log_path) if os.path.exists(log_path) else 0)
+                entries.append((os.path.getmtime(path), size, path, log_path))
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, path, log_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            if os.path.exists(log_path):
+                os.remove(log_path)
+            total -= size
+
+
+class _Tee(io.StringIO):
+    """keeps a copy of what is written while still passing it through."""
+
+    def __init__(self, stream: Any) -> None:
+        super().__init__()
+        self.stream = stream
+
+    def write(self, text: str) -> int:
+        self.stream.write(text)
+        return super().write(text)
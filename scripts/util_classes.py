@@ -1,14 +1,29 @@
 
 from __future__ import annotations
-from typing import Optional, Any
+from typing import Optional, Any, Callable, Iterable, Iterator, get_type_hints, get_args
 from dataclasses import dataclass, fields
-from functools import cached_property
+from functools import cached_property, lru_cache
+from itertools import groupby
+from operator import attrgetter
+from bisect import insort
+from enum import Enum
 from util_enums import Grade, RegionalNodes, Behavior, Source
 from util_consts import SEP_CHAR, ISEP_CHAR, NA_CHAR
+from util_io import open_text
 
 ### RECORD LEVEL ###
 
-@dataclass
+def format_value(val: Any) -> str:
+    """text form of a SeerRecord field value as written to the cleaned tsv."""
+    if isinstance(val, Source):
+        val = val.value
+    elif isinstance(val, Behavior):
+        val = val.name
+    elif isinstance(val, Grade | RegionalNodes):
+        val = None if val in [Grade.NA, RegionalNodes.NA] else val.name 
+    return str(val) if val is not None else NA_CHAR
+
+@dataclass(slots=True)
 class SeerRecord:
     patient_id: int 
     patient_death_year: Optional[int]
@@ -45,35 +60,123 @@ class SeerRecord:
     distant_ln: Optional[bool]
 
     def tostr(self) -> str:
-        flist = [getattr(self, f.name) for f in fields(SeerRecord)]
-        for idx, val in enumerate(flist):
-            if isinstance(val, Source):
-                flist[idx] = val.value
-            elif isinstance(val, Behavior):
-                flist[idx] = val.name
-            elif isinstance(val, Grade | RegionalNodes):
-                flist[idx] = None if val in [Grade.NA, RegionalNodes.NA] else val.name 
-        flist = [str(x) if x is not None else NA_CHAR for x in flist]
-        return SEP_CHAR.join(flist)
+        return make_serializer()(self)
     
     @classmethod
     def fromstr(cls, line: str) -> SeerRecord:
+        """parses a line of the cleaned tsv (as written by tostr()) back to a typed record."""
+        return make_parser()(line.rstrip('\n').split(SEP_CHAR))
+
+
+
+def field_types(cls: type=SeerRecord) -> dict[str, type]:
+    """
+    base type of each record field from its annotation (Optional[] removed). 
+    enum fields return their enum class. 
+    """
+    hints = get_type_hints(cls)
+    ftypes = {}
+    for f in fields(cls):
+        args = [a for a in get_args(hints[f.name]) if a is not type(None)]
+        ftypes[f.name] = args[0] if args else hints[f.name]
+    return ftypes
+
+@lru_cache(maxsize=None)
+def make_serializer(outfields: Optional[tuple[str, ...]]=None, cls: type=SeerRecord) -> Callable[[Any], str]:
+    """
+    tsv serialiser for records of cls (outfields, default all fields), generated once per schema.
+    same text as SEP_CHAR.join([format_value(getattr(rec, f)) for f in outfields]), but 
+    without the per-field fields() / isinstance() dispatch.
+    """
+    ftypes = field_types(cls)
+    outfields = outfields or tuple(ftypes.keys())
+    namespace: dict[str, Any] = {'SEP_CHAR': SEP_CHAR, 'NA_CHAR': NA_CHAR, 'format_value': format_value}
+    exprs = []
+    for i, fname in enumerate(outfields):
+        ftype = ftypes[fname]
+        if isinstance(ftype, type) and issubclass(ftype, Enum):
+            # enum member -> text table. anything else (None, raw str) falls back to format_value
+            namespace[f'TEXT{i}'] = {member: format_value(member) for member in ftype}
+            exprs.append(f'TEXT{i}.get(rec.{fname}) or format_value(rec.{fname})')
+        else:
+            exprs.append(f'NA_CHAR if rec.{fname} is None else str(rec.{fname})')
+    src = 'def serialize(rec):\n    return SEP_CHAR.join((\n' + ''.join([f'        {e},\n' for e in exprs]) + '    ))\n'
+    exec(src, namespace)
+    return namespace['serialize']
+
+
+def _parse_int(text: str) -> Optional[int]:
+    return None if text == NA_CHAR else int(text)
+
+def _parse_float(text: str) -> Optional[float]:
+    return None if text == NA_CHAR else float(text)
+
+def _parse_bool(text: str) -> Optional[bool]:
+    return None if text == NA_CHAR else BOOL_LUT[text]
+
+def _parse_str(text: str) -> Optional[str]:
+    return None if text == NA_CHAR else text
+
+BOOL_LUT = {'True': True, 'False': False}
+PARSERS = {int: _parse_int, float: _parse_float, bool: _parse_bool, str: _parse_str}
+
+def enum_lut(enum: type[Enum]) -> dict[str, Any]:
+    """
+    tsv text -> value for an enum field. O(1) inverse of format_value().
+    only enums with alias names (Grade.B_CELL etc) get extra entries: an alias 
+    is kept as text, as written by ingest, since as a member it would collapse 
+    onto the canonical name (T_CELL). any other text raises, including member 
+    names the tsv never holds (eg 'CLINICAL' for Source.CLINICAL's 'C').
+    """
+    lut: dict[str, Any] = {format_value(member): member for member in enum}
+    for name, member in enum.__members__.items():
+        if member.name != name:
+            lut[name] = name
+    lut.setdefault(NA_CHAR, None)
+    return lut
 
-        # INT_FIELDS = [
-        #     'patient_id', 'patient_death_year', 'diagnosis_year', 'num_malignant_tumors', 
-        #     'num_benign_tumors', 'hist_type', 'primary_site'
-        # ]
-        # FLOAT_FIELDS = ['psa']
-        # BOOL_FIELDS = ['brain_met', 'bone_met', 'lung_met', 'liver_met', 'distant_ln']
+def _make_enum_parser(enum: type[Enum]) -> Callable[[str], Any]:
+    lut = enum_lut(enum)
+    def parse(text: str) -> Any:
+        try:
+            return lut[text]
+        except KeyError:
+            raise ValueError(f'{text!r} is not a {enum.__name__}')
+    return parse
 
-        lsplit = line.strip().split(SEP_CHAR)
-        flist = [(f.name, f.type) for f in fields(SeerRecord)]
-        typecorrect_values = []
-        for (fname, ftype), val in zip(flist, lsplit):
-            # str -> int
-            print()
-        return SeerRecord(*typecorrect_values)
+@lru_cache(maxsize=None)
+def make_parser(cls: type=SeerRecord) -> Callable[[list[str]], Any]:
+    """
+    parser from split cleaned tsv fields to a record of cls, generated once per schema. 
+    inverse of make_serializer(): NA_CHAR becomes None (or the enum's NA member).
+    """
+    ftypes = field_types(cls)
+    namespace: dict[str, Any] = {'cls': cls}
+    args = []
+    for i, (fname, ftype) in enumerate(ftypes.items()):
+        if isinstance(ftype, type) and issubclass(ftype, Enum):
+            namespace[f'P{i}'] = _make_enum_parser(ftype)
+        else:
+            namespace[f'P{i}'] = PARSERS[ftype]
+        args.append(f'        P{i}(lsplit[{i}]),\n')
+    src = 'def parse(lsplit):\n    return cls(\n' + ''.join(args) + '    )\n'
+    exec(src, namespace)
+    return namespace['parse']
 
+def iter_records(path: str) -> Iterator[SeerRecord]:
+    """streams the SeerRecords of a cleaned tsv (optionally compressed) one line at a time."""
+    parse = make_parser()
+    header = SEP_CHAR.join([f.name for f in fields(SeerRecord)])
+    with open_text(path, 'r') as fp:
+        first = fp.readline().rstrip('\n')
+        if not first:
+            return
+        if first != header:
+            if first.split(SEP_CHAR)[0] == 'patient_id':
+                raise ValueError(f'{path} does not have the full SeerRecord schema')
+            yield parse(first.split(SEP_CHAR))
+        for line in fp:
+            yield parse(line.rstrip('\n').split(SEP_CHAR))
 
 
 
@@ -127,9 +230,8 @@ class Patient:
         self.num_malignant_tumors = max(self.num_malignant_tumors, record.num_malignant_tumors)
         self.num_benign_tumors = max(self.num_benign_tumors, record.num_benign_tumors)
         
-        # update records
-        self.records.append(record)
-        self.records.sort(key=lambda x: x.diagnosis_year)
+        # update records (kept in diagnosis order. ties keep arrival order)
+        insort(self.records, record, key=attrgetter('diagnosis_year'))
 
     def clean(self) -> None:
         cleaned_records = []
@@ -182,10 +284,26 @@ class Patient:
             't_stages': ISEP_CHAR.join([r.t_stage_ajcc if r.t_stage_ajcc is not None else NA_CHAR for r in self.records]),
             'n_stages': ISEP_CHAR.join([r.n_stage_ajcc if r.n_stage_ajcc is not None else NA_CHAR for r in self.records]),
             'g_stages': ISEP_CHAR.join([r.g_stage_ajcc if r.g_stage_ajcc is not None else NA_CHAR for r in self.records]),
-            'grades': ISEP_CHAR.join([r.grade.name if r.grade.name != Grade.NA else NA_CHAR for r in self.records]),
-            'grades': ISEP_CHAR.join([r.grade.name if r.grade.name != Grade.NA else NA_CHAR for r in self.records]),
+            'grades': ISEP_CHAR.join([format_value(r.grade) for r in self.records]),
             'hist_types': ISEP_CHAR.join([str(r.hist_type) for r in self.records]),
-            'regnodes': ISEP_CHAR.join([r.regional_nodes.name if r.regional_nodes.name != RegionalNodes.NA else NA_CHAR for r in self.records]),
+            'regnodes': ISEP_CHAR.join([format_value(r.regional_nodes) for r in self.records]),
         }
 
 
+def iter_patients(records: Iterable[SeerRecord], clean: bool=False) -> Iterator[Patient]:
+    """
+    groups a stream of records into Patients, one patient in memory at a time. 
+    records must be sorted by patient_id, as in the SEER export / ingest output. 
+    clean: truncate each patient's records after the first brain met (Patient.clean()).
+    """
+    last = None
+    for pid, precords in groupby(records, key=attrgetter('patient_id')):
+        if last is not None and pid < last:
+            raise ValueError(f'records are not sorted by patient_id: {pid} after {last}')
+        last = pid
+        patient = Patient(pid)
+        for record in precords:
+            patient.update(record)
+        if clean:
+            patient.clean()
+        yield patient
@@ -0,0 +1,177 @@
+from __future__ import annotations
+from typing import Any, Callable, Iterable, Optional, Tuple
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+
+"""
+Row filter steps, and the records & patients left after each of them.
+
+Each step returns a keep mask over all rows. FilterPipeline ANDs them in order,
+counting the records & patients left after each step from the running mask
+(patients via a per-patient record count, rather than nunique() on a filtered copy).
+Only the final mask is used to take rows, so the frame is copied once.
+ChunkedCounts gives the same counts for steps applied one chunk at a time.
+
+    pipeline = FilterPipeline([
+        ('diagnosis_year in [2010, 2020]', in_range('diagnosis_year', 2010, 2020)),
+        ('duplicated patient_id', not_duplicated(['patient_id'], keep=False)),
+    ])
+    df, counts = pipeline.run(df)
+"""
+
+# step(df, alive) -> bool array over all rows of df, True where the step keeps the row.
+# alive: rows kept by the previous steps. only steps which depend on the other
+# remaining rows (eg duplicates) use it.
+StepFunc = Callable[[pd.DataFrame, np.ndarray], np.ndarray]
+
+@dataclass
+class StepCounts:
+    name: str
+    patients: int
+    records: int
+    removed_patients: int
+    removed_records: int
+
+
+class FilterPipeline:
+
+    def __init__(self, steps: Optional[list[Tuple[str, StepFunc]]]=None) -> None:
+        self.steps = list(steps or [])
+
+    def add(self, name: str, func: StepFunc) -> FilterPipeline:
+        self.steps.append((name, func))
+        return self
+
+    def mask(self, df: pd.DataFrame) -> Tuple[np.ndarray, list[StepCounts]]:
+        """
+        the combined keep mask, and the counts before any step ('start') then
+        after each step.
+        """
+        codes, _ = pd.factorize(df['patient_id'])
+        npatients = int(codes.max()) + 1 if len(codes) > 0 else 0
+        has_id = codes >= 0
+
+        def _patients(alive: np.ndarray) -> int:
+            # NA patient_id isn't a patient, as for nunique()
+            return int(np.count_nonzero(np.bincount(codes[alive & has_id], minlength=npatients)))
+
+        alive = np.ones(len(df), dtype=bool)
+        patients, records = _patients(alive), len(df)
+        counts = [StepCounts('start', patients, records, 0, 0)]
+        for name, func in self.steps:
+            alive &= func(df, alive)
+            ipatients, irecords = patients, records
+            patients, records = _patients(alive), int(np.count_nonzero(alive))
+            counts.append(StepCounts(name, patients, records, ipatients - patients, irecords - records))
+        return alive, counts
+
+    def run(self, df: pd.DataFrame) -> Tuple[pd.DataFrame, list[StepCounts]]:
+        """the rows of df kept by every step (a new frame), and the counts of mask()."""
+        keep, counts = self.mask(df)
+        # take() rather than df[keep]: a new frame, not flagged as a view of df
+        return df.take(np.flatnonzero(keep)), counts
+
+class ChunkedCounts:
+    """
+    the counts FilterPipeline.mask() would report for a whole table, from steps 
+    applied to it one chunk at a time (eg by RowFilter while the table is read). 
+    only for steps which look at each row on its own (not not_duplicated()). 
+    patients are distinct patient_ids over all chunks (0 if chunks have none): for 
+    each chunk, the ids & the number of steps each survived are kept until counts().
+    """
+
+    def __init__(self, steps: list[Tuple[str, StepFunc]]) -> None:
+        self.steps = steps
+        self.records = np.zeros(len(steps) + 1, dtype=np.int64)
+        self._ids: list[np.ndarray] = []
+        self._survived: list[np.ndarray] = []
+
+    def mask(self, df: pd.DataFrame) -> np.ndarray:
+        """the combined keep mask of a chunk, whose rows are added to the counts."""
+        alive = np.ones(len(df), dtype=bool)
+        survived = np.zeros(len(df), dtype=np.int8)
+        self.records[0] += len(df)
+        for i, (_, func) in enumerate(self.steps, 1):
+            alive &= func(df, alive)
+            survived += alive
+            self.records[i] += np.count_nonzero(alive)
+        if 'patient_id' in df:
+            codes, uniques = pd.factorize(df['patient_id'])
+            has_id = codes >= 0
+            best = np.full(len(uniques), -1, dtype=np.int8)
+            np.maximum.at(best, codes[has_id], survived[has_id])
+            self._ids.append(np.asarray(uniques))
+            self._survived.append(best)
+        return alive
+
+    def counts(self) -> list[StepCounts]:
+        """as FilterPipeline.mask(): the counts before any step ('start') then after each step."""
+        patients = np.zeros(len(self.steps) + 1, dtype=np.int64)
+        if self._ids:
+            codes, uniques = pd.factorize(np.concatenate(self._ids))
+            best = np.full(len(uniques), -1, dtype=np.int8)
+            np.maximum.at(best, codes, np.concatenate(self._survived))
+            patients = np.array([np.count_nonzero(best >= i) for i in range(len(self.steps) + 1)])
+        names = ['start'] + [name for name, _ in self.steps]
+        counts = []
+        for i, name in enumerate(names):
+            removed_patients = int(patients[i - 1] - patients[i]) if i > 0 else 0
+            removed_records = int(self.records[i - 1] - self.records[i]) if i > 0 else 0
+            counts.append(StepCounts(name, int(patients[i]), int(self.records[i]), removed_patients, removed_records))
+        return counts
+
+
+#############
+### STEPS ###
+#############
+
+def in_range(field: str, lo: Any, hi: Any) -> StepFunc:
+    """keeps lo <= field <= hi (inclusive). NA is removed."""
+    def step(df: pd.DataFrame, alive: np.ndarray) -> np.ndarray:
+        values = df[field]
+        return ((values >= lo) & (values <= hi)).fillna(False).to_numpy(dtype=bool)
+    return step
+
+def only_in(field: str, values: Iterable[Any]) -> StepFunc:
+    """keeps rows whose field is one of values. NA is removed."""
+    values = list(values)
+    def step(df: pd.DataFrame, alive: np.ndarray) -> np.ndarray:
+        return df[field].isin(values).to_numpy(dtype=bool)
+    return step
+
+def not_in(field: str, values: Iterable[Any]) -> StepFunc:
+    """removes rows whose field is one of values."""
+    values = list(values)
+    def step(df: pd.DataFrame, alive: np.ndarray) -> np.ndarray:
+        return ~df[field].isin(values).to_numpy(dtype=bool)
+    return step
+
+def not_na(fields: list[str]) -> StepFunc:
+    """removes rows with a missing value in any of fields (as dropna(subset=fields))."""
+    def step(df: pd.DataFrame, alive: np.ndarray) -> np.ndarray:
+        return df[fields].notna().all(axis=1).to_numpy(dtype=bool)
+    return step
+
+def not_duplicated(subset: list[str], keep: str | bool='first') -> StepFunc:
+    """removes duplicates (as DataFrame.duplicated()) among the rows still alive."""
+    def step(df: pd.DataFrame, alive: np.ndarray) -> np.ndarray:
+        rows = np.flatnonzero(alive)
+        dups = df[subset].iloc[rows].duplicated(subset, keep=keep).to_numpy(dtype=bool)
+        out = np.ones(len(df), dtype=bool)
+        out[rows[dups]] = False
+        return out
+    return step
+
+def not_met_to_own_tissue(met_map: dict[str, list[str]]) -> StepFunc:
+    """
+    removes records marked as a metastasis to their own primary tissue, eg brain_met
+    for a Brain cancer_type. met_map: met field -> cancer_types. NA is not a met.
+    """
+    def step(df: pd.DataFrame, alive: np.ndarray) -> np.ndarray:
+        out = np.ones(len(df), dtype=bool)
+        for met, tissues in met_map.items():
+            is_met = (df[met] == True).fillna(False).to_numpy(dtype=bool)
+            out &= ~(is_met & df['cancer_type'].isin(tissues).to_numpy(dtype=bool))
+        return out
+    return step
@@ -8,7 +8,9 @@ import seaborn as sns
 from typing import Optional, Tuple
 from scipy.stats.contingency import odds_ratio, relative_risk
 
+from util_cache import FrameCache
 from util_consts import ISEP_CHAR
+from util_filters import FilterPipeline, in_range, not_duplicated, not_met_to_own_tissue, not_na
 import settings as s
 
 HISTTYPES_PATH = '/home/grace/work/SEER/data/histology/histcodes.tsv'
@@ -84,7 +86,7 @@ def _format_ln_status_pathological(df: pd.DataFrame) -> pd.DataFrame:
         POS_NODES:      True
         POS_ASPIRATION: False
     """
-    df['local_ln'] = np.nan
+    df['local_ln'] = pd.Series(np.nan, index=df.index, dtype=object)  # NA, True or False
     df.loc[df['regional_nodes']=='NEG', 'local_ln'] = False
     df.loc[df['regional_nodes'].isin(['POS_NODES', 'POS_ASPIRATION']), 'local_ln'] = True
     return df
@@ -120,40 +122,37 @@ def format_regional_nodes_bins(df: pd.DataFrame) -> pd.DataFrame:
     return df 
 
 def do_basic_filtering(df: pd.DataFrame, filter_mets: Optional[str]=None) -> pd.DataFrame:
+    MET_FIELDS = ['brain_met', 'bone_met', 'lung_met', 'liver_met', 'other_met']
+    pipeline = FilterPipeline([
+        ('year', in_range('diagnosis_year', 2010, 2020)),
+        ('duplicates', not_duplicated(['patient_id', 'cancer_type'])),
+    ])
+    if filter_mets == 'all':
+        pipeline.add('mets', not_na(MET_FIELDS))
+    elif filter_mets == 'brain':
+        pipeline.add('mets', not_na(['brain_met']))
+    df, counts = pipeline.run(df)
+    start, year, dups = counts[:3]
+
     print(f"Beginning")
-    print(f"- {df['patient_id'].nunique()} patients, {df.shape[0]} records.")
-    
-    df = df.loc[df['diagnosis_year'] >= 2010]
-    df = df.loc[df['diagnosis_year'] <= 2020]
+    print(f"- {start.patients} patients, {start.records} records.")
     print()
     print(f"Filtered records not in range (2010, 2020)")
-    print(f"- {df['patient_id'].nunique()} patients, {df.shape[0]} records.")
-    
-    # print("Removing records with non 'MALIGNANT' behavior...", end='\r')
-    # irecords = df.shape[0]
-    # df = df[df['behavior']=='MALIGNANT']
-    # print(f"Removing records with non 'MALIGNANT' behavior... removed {irecords - df.shape[0]} records")
-
-    df = df[~df.duplicated(subset=['patient_id', 'cancer_type'])]
+    print(f"- {year.patients} patients, {year.records} records.")
     print()
     print(f"Removed patients with multiple records of same cancer_type.")
-    print(f"- {df['patient_id'].nunique()} patients, {df.shape[0]} records.")
+    print(f"- {dups.patients} patients, {dups.records} records.")
     
     if filter_mets == 'all':
-        MET_FIELDS = ['brain_met', 'bone_met', 'lung_met', 'liver_met', 'other_met']
         print('Removing records where any of the following fields have missing values:')
         print(MET_FIELDS)
-        irecords = df.shape[0]
-        df = df.dropna(subset=MET_FIELDS)
-        print(f'- removed {irecords - df.shape[0]} records')
+        print(f'- removed {counts[3].removed_records} records')
     
     elif filter_mets == 'brain':
         print('Removing records where brain_met value is missing')
-        irecords = df.shape[0]
-        df = df.dropna(subset=['brain_met'])
-        print(f'- removed {irecords - df.shape[0]} records')
+        print(f'- removed {counts[3].removed_records} records')
 
-    return df.copy()
+    return df
 
 def select_valid(
     df: pd.DataFrame, 
@@ -196,14 +195,12 @@ def remove_identical_primary_secondary_cases(df: pd.DataFrame) -> pd.DataFrame:
         'liver_met': ['Liver'], 
     }
 
-    for met, tissues in MET_MAP.items():
-        mask = (df[met]==True) & (df['cancer_type'].isin(tissues))
-        df = df[~mask]
+    df, counts = FilterPipeline([('mets', not_met_to_own_tissue(MET_MAP))]).run(df)
     
     print()
     print(f"Removed MET records where primary tissue is identical to secondary tissue.")
-    print(f"- {df['patient_id'].nunique()} patients, {df.shape[0]} records.")
-    return df.copy()
+    print(f"- {counts[-1].patients} patients, {counts[-1].records} records.")
+    return df
 
 def do_basic_formatting(df: pd.DataFrame) -> pd.DataFrame:
     # mets: any_met
@@ -274,6 +271,25 @@ def do_basic_formatting(df: pd.DataFrame) -> pd.DataFrame:
 
     return df 
 
+def read_clean_table(path: str) -> pd.DataFrame:
+    """the cleaned case table (clean_case_data.py output), as the notebooks read it."""
+    return pd.read_csv(path, header=0, sep='\t', na_values='.')
+
+def load_basic_table(path: str, ln_basis: Optional[str]=None, cache: Optional[FrameCache]=None) -> pd.DataFrame:
+    """
+    the cleaned case table at path after do_basic_filtering(), 
+    remove_identical_primary_secondary_cases(), do_basic_formatting() and, if 
+    ln_basis is given, format_ln_status(basis=ln_basis). each stage is cached 
+    (default FrameCache()), so a rerun with the same input & code reloads the 
+    result rather than recomputing it.
+    """
+    cache = cache or FrameCache()
+    return cache.pipeline(path, read_clean_table, [
+        (do_basic_filtering, {}, []),
+        (remove_identical_primary_secondary_cases, {}, []),
+        (do_basic_formatting, {}, [HISTTYPES_PATH]),
+    ] + ([(format_ln_status, {'basis': ln_basis}, [])] if ln_basis is not None else []))
+
 def format_nstage_twolevel(df: pd.DataFrame) -> pd.DataFrame:
     print('Mapping NSTAGE field to two levels: N0, N1')
     THE_MAP = {
@@ -0,0 +1,130 @@
+from __future__ import annotations
+from typing import IO, Iterator, Optional
+from itertools import islice
+import os
+import re
+import queue
+import threading
+
+"""
+Text file access for SEER exports and cleaned tables.
+Files are transparently (de)compressed based on their extension
+(.gz, .bz2, .xz, .zst). zstd requires the zstandard package.
+"""
+
+# lines handed from the reader thread to the parser at a time
+READER_BATCH_LINES = 10_000
+# max batches buffered ahead of the parser
+READER_QUEUE_SIZE = 8
+
+COMPRESSED_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.zst': 'zstd',
+}
+
+def get_compression(path: str) -> Optional[str]:
+    ext = os.path.splitext(path)[1].lower()
+    return COMPRESSED_EXTENSIONS.get(ext)
+
+def is_compressed(path: str) -> bool:
+    return get_compression(path) is not None
+
+def open_text(path: str, mode: str='r') -> IO[str]:
+    """opens path in text mode ('r', 'w' or 'a'), compressing / decompressing by file extension."""
+    comp = get_compression(path)
+    if comp is None:
+        return open(path, mode)
+    tmode = mode + 't'
+    if comp == 'gzip':
+        import gzip
+        return gzip.open(path, tmode)
+    elif comp == 'bz2':
+        import bz2
+        return bz2.open(path, tmode)
+    elif comp == 'xz':
+        import lzma
+        return lzma.open(path, tmode)
+    elif comp == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f'reading / writing {path} requires the zstandard package')
+        return zstandard.open(path, tmode)
+    raise ValueError(f'unsupported compression {comp} for {path}')
+
+def read_dic_variables(path: str) -> list[str]:
+    """
+    column names of a SEER*Stat export, in order, from the [Variables] section of 
+    its .dic file (lines like 'Var0Name=Patient ID').
+    """
+    with open(path, 'r') as fp:
+        lines = [ln.strip() for ln in fp.readlines()]
+    if '[Variables]' not in lines:
+        raise ValueError(f'no [Variables] section in {path}')
+    lines = lines[lines.index('[Variables]') + 1:]
+    variables = {}
+    for line in lines:
+        if line.startswith('['):  # next section
+            break
+        m = re.match(r'Var(\d+)Name=(.*)', line)
+        if m is not None:
+            variables[int(m.group(1))] = m.group(2).strip()
+    return [variables[idx] for idx in sorted(variables)]
+
+
+class ThreadedLineReader:
+    """
+    Iterates the lines of path. Reading & decompression run in a background
+    thread which keeps up to READER_QUEUE_SIZE batches of lines ahead of the consumer.
+    """
+
+    _DONE = object()
+
+    def __init__(self, path: str, batch_lines: int=READER_BATCH_LINES, queue_size: int=READER_QUEUE_SIZE) -> None:
+        self.path = path
+        self.batch_lines = batch_lines
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self) -> None:
+        try:
+            with open_text(self.path, 'r') as fp:
+                batch = list(islice(fp, self.batch_lines))
+                while batch and not self.stop.is_set():
+                    self._put(batch)
+                    batch = list(islice(fp, self.batch_lines))
+        except Exception as e:
+            self._put(e)
+        self._put(self._DONE)
+
+    def _put(self, item: object) -> None:
+        # don't block forever if the consumer has gone away
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            item = self.queue.get()
+            if item is self._DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+
+    def close(self) -> None:
+        self.stop.set()
+        self.thread.join()
+
+    def __enter__(self) -> ThreadedLineReader:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,77 @@
+from __future__ import annotations
+from typing import Any, Callable, Optional
+from collections import Counter, defaultdict
+from functools import wraps
+from time import perf_counter
+import json
+
+"""
+Call counts & time spent in the ingest decoders (clean_case_data.py --profile).
+Decoders are only wrapped in a profiled copy of the field plan (see
+clean_case_data.profiled_plan()), so a normal run pays nothing.
+Times are inclusive: a decoder which calls another (eg get_t_stage -> get_stage_ajcc)
+includes the time of both.
+calls counts invocations, rows the export rows they decoded. these differ under 
+--columnar, where a decoder is called once per distinct input & weight is that input's row count.
+"""
+
+class DecoderProfiler:
+
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+        self.rows: Counter = Counter()
+        # rows decoded by the current call
+        self.weight = 1
+        self.seconds: defaultdict[str, float] = defaultdict(float)
+        self.wall: Optional[float] = None
+
+    def wrap(self, func: Callable, name: Optional[str]=None, branch: Optional[Callable[..., str]]=None) -> Callable:
+        """
+        returns func timed under name (default func.__name__).
+        if branch is given, each call is also timed under 'name[branch(*args)]'.
+        """
+        name = name or func.__name__
+        calls, rows, seconds = self.calls, self.rows, self.seconds
+
+        @wraps(func)
+        def timed(*args: Any) -> Any:
+            start = perf_counter()
+            try:
+                return func(*args)
+            finally:
+                elapsed = perf_counter() - start
+                calls[name] += 1
+                rows[name] += self.weight
+                seconds[name] += elapsed
+                if branch is not None:
+                    key = f'{name}[{branch(*args)}]'
+                    calls[key] += 1
+                    rows[key] += self.weight
+                    seconds[key] += elapsed
+        return timed
+
+    def report(self) -> dict[str, Any]:
+        decoders = {}
+        for name in sorted(self.seconds, key=self.seconds.get, reverse=True):  # type: ignore
+            ncalls, secs = self.calls[name], self.seconds[name]
+            decoders[name] = {
+                'calls': ncalls,
+                'rows': self.rows[name],
+                'seconds': secs,
+                'us_per_call': secs / ncalls * 1e6 if ncalls > 0 else 0.0,
+            }
+        return {'wall_seconds': self.wall, 'decoders': decoders}
+
+    def print_table(self) -> None:
+        report = self.report()
+        wall = report['wall_seconds']
+        print()
+        print('Decoder profile' + (f' ({wall:.2f}s total)' if wall else ''))
+        print(f"{'decoder':<32} {'calls':>12} {'rows':>12} {'seconds':>10} {'us/call':>9} {'% total':>8}")
+        for name, st in report['decoders'].items():
+            share = f"{st['seconds'] / wall * 100:.1f}" if wall else '-'
+            print(f"{name:<32} {st['calls']:>12} {st['rows']:>12} {st['seconds']:>10.3f} {st['us_per_call']:>9.2f} {share:>8}")
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as fp:
+            json.dump(self.report(), fp, indent=2)
@@ -0,0 +1,748 @@
+from __future__ import annotations
+from typing import Any, Iterable, Optional, Tuple
+from dataclasses import dataclass, fields, field as dc_field
+from enum import Enum
+from urllib.parse import quote, unquote
+import io
+import os
+import numpy as np
+import pandas as pd
+
+from util_classes import SeerRecord, format_value, field_types
+from util_consts import SEP_CHAR, NA_CHAR
+from util_io import open_text, is_compressed
+from util_filters import ChunkedCounts, StepFunc, in_range, not_in, only_in
+
+"""
+Output writers for the cleaned case table.
+
+A 'block' is a dict of SeerRecord field name -> column of field values (numpy
+object array), as produced by clean_case_data.decode_block() or records_to_block().
+Blocks may hold a subset of the fields (clean_case_data.py --fields).
+Each writer has a static encode(block) which may run in a worker process, and
+write(payload) which appends the encoded block to the output file.
+"""
+
+def records_to_block(records: list[SeerRecord]) -> dict[str, np.ndarray]:
+    block = {}
+    for f in fields(SeerRecord):
+        values = np.empty(len(records), dtype=object)
+        values[:] = [getattr(rec, f.name) for rec in records]
+        block[f.name] = values
+    return block
+
+def factorize_text(values: np.ndarray) -> Tuple[np.ndarray, list[str]]:
+    """
+    returns (codes, texts) where texts are the distinct formatted values of a
+    block column. NA values (None or formatted as NA_CHAR) have code -1.
+    """
+    codes, uniques = pd.factorize(values)
+    if len(uniques) == 0:
+        return codes, []
+    texts = np.array([format_value(val) for val in uniques], dtype=object)
+    # distinct values can share a text (eg Grade.G1 & 'G1')
+    tcodes, utexts = pd.factorize(np.where(texts == NA_CHAR, None, texts))
+    codes = np.where(codes == -1, -1, tcodes[codes])
+    return codes, list(utexts)
+
+
+#################
+### DATAFRAME ###
+#################
+
+# narrower dtypes for fields whose values are known to fit
+COMPACT_DTYPES = {
+    'patient_id': 'Int32',
+    'patient_death_year': 'Int16',
+    'diagnosis_year': 'Int16',
+    'followup_year': 'Int16',
+    'regional_nodes_examined': 'Int16',
+    'regional_nodes_positive': 'Int16',
+    'num_malignant_tumors': 'Int16',
+    'num_benign_tumors': 'Int16',
+    'hist_type': 'Int16',
+    'psa': 'float32',
+}
+
+def table_dtypes(outfields: Optional[list[str]]=None) -> dict[str, str]:
+    """
+    pandas dtype of each field in a DataFrame of the cleaned table.
+    ints, floats & bools are nullable (ints as narrow as COMPACT_DTYPES allows). 
+    str & enum fields are categories of their tsv text.
+    """
+    types = field_types()
+    dtypes = {}
+    for fname in outfields if outfields is not None else types.keys():
+        ftype = types[fname]
+        if fname in COMPACT_DTYPES:
+            dtypes[fname] = COMPACT_DTYPES[fname]
+        elif ftype is bool:
+            dtypes[fname] = 'boolean'
+        elif ftype is int:
+            dtypes[fname] = 'Int64'
+        elif ftype is float:
+            dtypes[fname] = 'float64'
+        else:
+            dtypes[fname] = 'category'
+    return dtypes
+
+def blocks_to_frame(blocks: list[dict[str, np.ndarray]], outfields: list[str]) -> pd.DataFrame:
+    """concatenates decoded blocks into a DataFrame typed by table_dtypes()."""
+    columns = {}
+    for fname, dtype in table_dtypes(outfields).items():
+        if blocks:
+            values = np.concatenate([block[fname] for block in blocks])
+        else:
+            values = np.empty(0, dtype=object)
+        if dtype == 'category':
+            codes, texts = factorize_text(values)
+            columns[fname] = pd.Categorical.from_codes(codes, categories=texts)
+        elif dtype.startswith('float'):
+            columns[fname] = np.where(values == None, np.nan, values).astype(dtype)
+        else:
+            columns[fname] = pd.array(values, dtype=dtype)
+    return pd.DataFrame(columns)
+
+def read_table(
+    source: Any, 
+    columns: Optional[list[str]]=None, 
+    rows: Optional[RowFilter]=None,
+    typed: bool=True,
+    ) -> pd.DataFrame:
+    """
+    reads a cleaned tsv (path or text buffer, with header) typed by table_dtypes().
+    columns: subset to read (default all). columns which aren't SeerRecord fields 
+    are read as pandas infers them.
+    rows: only keep the rows this filter accepts. the table is then parsed 
+    READ_CHUNK_ROWS at a time, so rejected rows are never all held in memory.
+    typed: False reads every column as pandas infers it, for tables SeerRecord 
+    didn't write which share some of its field names (eg the analysis tables).
+    """
+    types = field_types() if typed else {}
+    if isinstance(source, str):
+        with open_text(source, 'r') as fp:
+            header = fp.readline().rstrip('\n').split(SEP_CHAR)
+    else:
+        header = source.readline().rstrip('\n').split(SEP_CHAR)
+        source.seek(0)
+    usecols = header if columns is None else [col for col in header if col in columns]
+    # filter columns are read even if not wanted in the output
+    readcols = usecols if rows is None else [col for col in header if col in usecols or col in rows.columns()]
+    known = [col for col in readcols if col in types]
+    dtypes = table_dtypes(known)
+    csv_args: dict[str, Any] = dict(
+        sep=SEP_CHAR, 
+        header=0, 
+        usecols=readcols, 
+        dtype={col: _parse_dtype(dtype) for col, dtype in dtypes.items()}, 
+        na_values={col: [NA_CHAR] for col in known},
+        # pandas' default NA strings only for the columns it infers
+        keep_default_na=len(known) < len(readcols),
+    )
+    if rows is None:
+        df = pd.read_csv(source, **csv_args)
+        _cast_parsed(df, dtypes)
+        return df[usecols]
+    chunks = []
+    with pd.read_csv(source, chunksize=READ_CHUNK_ROWS, **csv_args) as reader:
+        for chunk in reader:
+            _cast_parsed(chunk, dtypes)
+            chunks.append(chunk.loc[rows.mask(chunk), usecols])
+    return concat_frames(chunks, usecols)
+
+def concat_frames(frames: list[pd.DataFrame], columns: list[str]) -> pd.DataFrame:
+    """
+    concatenates frames read separately (eg chunks of a table). category columns 
+    stay categories, over the union of each frame's (sorted) categories.
+    """
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    cats = {}
+    for col in columns:
+        if isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            # a frame whose column is all NA has no categories (of object dtype)
+            union = set().union(*[frame[col].cat.categories for frame in frames])
+            cats[col] = pd.CategoricalDtype(sorted(union))
+    return pd.concat([frame.astype(cats) if cats else frame for frame in frames])
+
+def _parse_dtype(dtype: str) -> str:
+    """
+    dtype read_csv parses a table_dtypes() column as. its nullable int & boolean 
+    parsing is several times slower than parsing floats & categories, which 
+    _cast_parsed() then converts.
+    """
+    if dtype.startswith('Int'):
+        return 'float64'
+    if dtype == 'boolean':
+        return 'category'
+    return dtype
+
+def _cast_parsed(df: pd.DataFrame, dtypes: dict[str, str]) -> None:
+    """converts columns read as _parse_dtype() to their table_dtypes(), in place."""
+    for col, dtype in dtypes.items():
+        if dtype == _parse_dtype(dtype):
+            continue
+        if dtype == 'boolean':
+            cat = df[col].array
+            lut = np.array([BOOL_TEXT[text] for text in cat.categories] + [False])
+            df[col] = pd.arrays.BooleanArray(lut[cat.codes], cat.codes == -1)
+        else:
+            df[col] = df[col].astype(dtype)
+
+BOOL_TEXT = {'True': True, 'False': False}
+READ_CHUNK_ROWS = 200_000
+
+@dataclass
+class RowFilter:
+    """
+    rows of the cleaned table to keep while reading (read_table(), read_partitioned()).
+    None / empty: no constraint. conditions on columns a table doesn't have are skipped.
+    """
+    year_range: Optional[Tuple[int, int]] = None  # inclusive diagnosis_year bounds
+    years: Optional[set[int]] = None
+    cancer_groups: Optional[set[str]] = None
+    exclude_cancer_groups: set[str] = dc_field(default_factory=set)
+    exclude_hist_groups: set[str] = dc_field(default_factory=set)
+    # set by count_rows()
+    counts: Optional[ChunkedCounts] = dc_field(default=None, repr=False, compare=False)
+
+    def columns(self) -> list[str]:
+        """fields the filter reads."""
+        cols = ['patient_id'] if self.counts is not None else []
+        if self.year_range is not None or self.years is not None:
+            cols.append('diagnosis_year')
+        if self.cancer_groups is not None or self.exclude_cancer_groups:
+            cols.append('cancer_group')
+        if self.exclude_hist_groups:
+            cols.append('hist_group')
+        return cols
+
+    def steps(self) -> list[Tuple[str, StepFunc]]:
+        """
+        the conditions as FilterPipeline steps, in the order they're applied & counted. 
+        NA years are rejected by year_range, NA groups aren't excluded.
+        """
+        steps = []
+        if self.cancer_groups is not None:
+            groups = sorted(self.cancer_groups)
+            steps.append((f"where 'cancer_group' not in {groups}.", _if_present('cancer_group', only_in('cancer_group', groups))))
+        if self.years is not None:
+            years = sorted(self.years)
+            steps.append((f"where 'diagnosis_year' not in {years}.", _if_present('diagnosis_year', only_in('diagnosis_year', years))))
+        if self.exclude_cancer_groups:
+            groups = sorted(self.exclude_cancer_groups)
+            steps.append((f"where 'cancer_group' in {groups}.", _if_present('cancer_group', not_in('cancer_group', groups))))
+        if self.exclude_hist_groups:
+            groups = sorted(self.exclude_hist_groups)
+            steps.append((f"where 'hist_group' in {groups}.", _if_present('hist_group', not_in('hist_group', groups))))
+        if self.year_range is not None:
+            lo, hi = self.year_range
+            steps.append((f"where 'diagnosis_year' not in range [{lo}, {hi}].", _if_present('diagnosis_year', in_range('diagnosis_year', lo, hi))))
+        return steps
+
+    def count_rows(self) -> ChunkedCounts:
+        """
+        counts the rows mask() is given & keeps from now on, per step (eg over the 
+        chunks of a table as it's read). partitions skipped by accepts() aren't seen.
+        """
+        self.counts = ChunkedCounts(self.steps())
+        return self.counts
+
+    def accepts(self, values: dict[str, Any]) -> bool:
+        """whether a row with these field values is kept. fields not in values aren't checked."""
+        if 'diagnosis_year' in values:
+            year = values['diagnosis_year']
+            if self.year_range is not None and (year is None or not self.year_range[0] <= year <= self.year_range[1]):
+                return False
+            if self.years is not None and year not in self.years:
+                return False
+        if 'cancer_group' in values:
+            group = values['cancer_group']
+            if self.cancer_groups is not None and group not in self.cancer_groups:
+                return False
+            if group in self.exclude_cancer_groups:
+                return False
+        if 'hist_group' in values and values['hist_group'] in self.exclude_hist_groups:
+            return False
+        return True
+
+    def mask(self, df: pd.DataFrame) -> np.ndarray:
+        """bool array of the rows of df which are kept."""
+        if self.counts is not None:
+            return self.counts.mask(df)
+        keep = np.ones(len(df), dtype=bool)
+        for _, func in self.steps():
+            keep &= func(df, keep)
+        return keep
+
+def _if_present(field: str, step: StepFunc) -> StepFunc:
+    """step, or keep every row if df has no field."""
+    def wrapped(df: pd.DataFrame, alive: np.ndarray) -> np.ndarray:
+        return step(df, alive) if field in df else np.ones(len(df), dtype=bool)
+    return wrapped
+
+
+###########
+### TSV ###
+###########
+
+def tsv_header(outfields: Optional[list[str]]=None) -> str:
+    outfields = outfields or [f.name for f in fields(SeerRecord)]
+    return SEP_CHAR.join(outfields) + '\n'
+
+def block_to_tsv(block: dict[str, np.ndarray]) -> str:
+    """serialises a block to tsv text identical to SeerRecord.tostr() per row."""
+    if len(block) == 0 or len(next(iter(block.values()))) == 0:
+        return ''
+    return _join_rows([text_column(values) for values in block.values()])
+
+def text_column(values: np.ndarray) -> np.ndarray:
+    """tsv text of each value in a block column."""
+    # code -1 (NA) indexes the trailing NA_CHAR
+    codes, texts = factorize_text(values)
+    return np.array(texts + [NA_CHAR], dtype=object)[codes]
+
+def _join_rows(textcols: list[np.ndarray]) -> str:
+    return '\n'.join([SEP_CHAR.join(row) for row in zip(*textcols)]) + '\n'
+
+class TsvWriter:
+    """
+    compressed if path ends in .gz, .bz2, .xz or .zst.
+    given an offset, an existing uncompressed file is truncated there and appended to.
+    """
+
+    def __init__(self, path: str, offset: Optional[int]=None, outfields: Optional[list[str]]=None) -> None:
+        if offset is None:
+            self.fp = open_text(path, 'w')
+            self.fp.write(tsv_header(outfields))
+        elif not self.resumable(path):
+            raise ValueError(f'compressed output cannot be resumed: {path}')
+        else:
+            self.fp = open(path, 'r+')
+            self.fp.seek(offset)
+            self.fp.truncate()
+
+    @staticmethod
+    def resumable(path: str) -> bool:
+        return not is_compressed(path)
+
+    @staticmethod
+    def encode(block: dict[str, np.ndarray]) -> str:
+        return block_to_tsv(block)
+
+    def write(self, payload: str) -> None:
+        self.fp.write(payload)
+
+    def tell(self) -> int:
+        self.fp.flush()
+        return self.fp.tell()
+
+    def close(self) -> None:
+        self.fp.close()
+
+
+class RejectWriter:
+    """
+    tsv of rows which failed to convert: field, exception, message, then the raw row.
+    given an offset, an existing file is truncated there and appended to.
+    """
+
+    HEADER = ['field', 'exception', 'message']
+
+    def __init__(self, path: str, offset: Optional[int]=None) -> None:
+        if offset is None:
+            self.fp = open(path, 'w')
+            self.fp.write(SEP_CHAR.join(self.HEADER) + SEP_CHAR + 'row\n')
+        else:
+            self.fp = open(path, 'r+')
+            self.fp.seek(offset)
+            self.fp.truncate()
+
+    def write(self, rejects: list[Tuple[str, str, str, str]]) -> None:
+        for field, error, message, line in rejects:
+            message = ' '.join(message.split())
+            self.fp.write(SEP_CHAR.join([field, error, message, line]) + '\n')
+
+    def tell(self) -> int:
+        self.fp.flush()
+        return self.fp.tell()
+
+    def close(self) -> None:
+        self.fp.close()
+
+
+###############
+### PARQUET ###
+###############
+
+def arrow_schema(outfields: Optional[list[str]]=None) -> Any:
+    """
+    arrow schema typed from the SeerRecord field annotations. all fields nullable. 
+    str & enum fields are dictionary encoded (enums as their tsv text).
+    """
+    import pyarrow as pa
+    types = field_types()
+    pa_fields = []
+    for fname in outfields or types.keys():
+        ftype = types[fname]
+        if ftype is bool:
+            pa_type = pa.bool_()
+        elif ftype is int:
+            pa_type = pa.int32()
+        elif ftype is float:
+            pa_type = pa.float64()
+        elif ftype is str or issubclass(ftype, Enum):
+            pa_type = pa.dictionary(pa.int32(), pa.string())
+        else:
+            raise NotImplementedError(f'no arrow type for field {fname}: {ftype}')
+        pa_fields.append(pa.field(fname, pa_type, nullable=True))
+    return pa.schema(pa_fields)
+
+def block_to_arrow(block: dict[str, np.ndarray]) -> Any:
+    """converts a block to an arrow RecordBatch using arrow_schema()."""
+    import pyarrow as pa
+    schema = arrow_schema(list(block.keys()))
+    arrays = []
+    for pa_field in schema:
+        values = block[pa_field.name]
+        if pa.types.is_dictionary(pa_field.type):
+            codes, texts = factorize_text(values)
+            indices = pa.array(codes, type=pa.int32(), mask=(codes == -1))
+            arrays.append(pa.DictionaryArray.from_arrays(indices, pa.array(texts, type=pa.string())))
+        else:
+            arrays.append(pa.array(values, type=pa_field.type, from_pandas=True))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+class ParquetWriter:
+    """writes each encoded block as a parquet row group."""
+
+    def __init__(self, path: str, offset: Optional[int]=None, outfields: Optional[list[str]]=None) -> None:
+        import pyarrow.parquet as pq
+        if offset is not None:
+            raise ValueError('parquet output cannot be resumed')
+        self.writer = pq.ParquetWriter(path, arrow_schema(outfields))
+
+    @staticmethod
+    def resumable(path: str) -> bool:
+        return False
+
+    @staticmethod
+    def encode(block: dict[str, np.ndarray]) -> Any:
+        return block_to_arrow(block)
+
+    def write(self, payload: Any) -> None:
+        if payload.num_rows > 0:
+            self.writer.write_batch(payload)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+#############
+### CODED ###
+#############
+
+"""
+Dictionary encoded tsv: str & enum fields (table_dtypes() 'category') are written as 
+integer codes, and the text of each code goes in a code table per field at 
+PATH.codes/FIELD.txt (line i holds the text of code i). NA is code -1. 
+Other fields are written as in the tsv. read_coded() loads the codes straight 
+into pandas Categoricals without parsing any of the strings.
+"""
+
+CODES_SUFFIX = '.codes'
+
+def coded_fields(outfields: Optional[list[str]]=None) -> list[str]:
+    return [fname for fname, dtype in table_dtypes(outfields).items() if dtype == 'category']
+
+def code_table_path(path: str, field: str) -> str:
+    return os.path.join(path + CODES_SUFFIX, f'{field}.txt')
+
+class CodedWriter:
+    """
+    codes are assigned in order of first appearance across blocks. the code tables 
+    are written on close(), so the output is only readable once the run completes.
+    """
+
+    def __init__(self, path: str, offset: Optional[int]=None, outfields: Optional[list[str]]=None) -> None:
+        if offset is not None:
+            raise ValueError('coded output cannot be resumed')
+        self.path = path
+        self.fields = outfields or [f.name for f in fields(SeerRecord)]
+        self.tables: dict[str, dict[str, int]] = {field: {} for field in coded_fields(self.fields)}
+        self.fp = open_text(path, 'w')
+        self.fp.write(tsv_header(self.fields))
+
+    @staticmethod
+    def resumable(path: str) -> bool:
+        return False
+
+    @staticmethod
+    def encode(block: dict[str, np.ndarray]) -> Tuple[int, list[Any]]:
+        """(num rows, columns). columns are (block codes, texts) for coded fields, else their tsv text."""
+        nrows = len(next(iter(block.values()))) if block else 0
+        coded = set(coded_fields(list(block.keys())))
+        columns = [
+            factorize_text(values) if field in coded else text_column(values)
+            for field, values in block.items()
+        ]
+        return nrows, columns
+
+    def write(self, payload: Tuple[int, list[Any]]) -> None:
+        nrows, columns = payload
+        if nrows == 0:
+            return
+        textcols = []
+        for field, column in zip(self.fields, columns):
+            if field not in self.tables:
+                textcols.append(column)
+                continue
+            # block codes -> file codes. block code -1 (NA) indexes the trailing -1
+            table = self.tables[field]
+            codes, texts = column
+            lut = np.array([table.setdefault(text, len(table)) for text in texts] + [-1])
+            textcols.append(lut[codes].astype(str))
+        self.fp.write(_join_rows(textcols))
+
+    def close(self) -> None:
+        self.fp.close()
+        os.makedirs(self.path + CODES_SUFFIX, exist_ok=True)
+        for field, table in self.tables.items():
+            with open(code_table_path(self.path, field), 'w') as fp:
+                fp.writelines([text + '\n' for text in table])
+
+def read_coded(path: str, columns: Optional[list[str]]=None) -> pd.DataFrame:
+    """
+    reads a CodedWriter table into a DataFrame typed by table_dtypes(). 
+    columns: subset of fields to read (default all).
+    """
+    with open_text(path, 'r') as fp:
+        header = fp.readline().rstrip('\n').split(SEP_CHAR)
+    columns = header if columns is None else [field for field in header if field in columns]
+    dtypes = table_dtypes(columns)
+    parse = {field: 'int32' if dtype == 'category' else _parse_dtype(dtype) for field, dtype in dtypes.items()}
+    df = pd.read_csv(
+        path, 
+        sep=SEP_CHAR, 
+        header=0, 
+        usecols=columns, 
+        dtype=parse, 
+        na_values=[NA_CHAR], 
+        keep_default_na=False,
+    )
+    _cast_parsed(df, {field: dtype for field, dtype in dtypes.items() if dtype != 'category'})
+    for field, dtype in dtypes.items():
+        if dtype == 'category':
+            with open(code_table_path(path, field), 'r') as fp:
+                texts = fp.read().splitlines()
+            df[field] = pd.Categorical.from_codes(df[field].to_numpy(), categories=texts)
+    return df[columns]
+
+
+WRITERS = {
+    'tsv': TsvWriter,
+    'parquet': ParquetWriter,
+    'coded': CodedWriter,
+}
+
+
+###################
+### PARTITIONED ###
+###################
+
+"""
+Hive style dataset: one file per partition at
+    PATH/cancer_group=Breast/diagnosis_year=2015/part-0.tsv
+Partition values are url-quoted in directory names and the partition fields are
+not repeated inside the files. read_partitioned() only opens the partitions asked for.
+"""
+
+PARTITION_FIELDS = ['cancer_group', 'diagnosis_year']
+PARTITION_NA = '__HIVE_DEFAULT_PARTITION__'
+PARTITION_FILE = 'part-0'
+# tsv partitions read per read_csv call (see _read_tsv_partitions())
+PARTITION_BATCH_BYTES = 32 * 1024**2
+
+def partition_dir(key: Tuple[Any, ...]) -> str:
+    parts = []
+    for field, value in zip(PARTITION_FIELDS, key):
+        text = PARTITION_NA if value is None else quote(format_value(value), safe='')
+        parts.append(f'{field}={text}')
+    return os.path.join(*parts)
+
+def split_partitions(block: dict[str, np.ndarray]) -> dict[Tuple[Any, ...], dict[str, np.ndarray]]:
+    """splits a block by its PARTITION_FIELDS values. sub-blocks don't hold the partition fields."""
+    if len(block) == 0 or len(next(iter(block.values()))) == 0:
+        return {}
+    keys = pd.DataFrame({field: block[field] for field in PARTITION_FIELDS})
+    groups = keys.groupby(PARTITION_FIELDS, sort=False, dropna=False).indices
+    out = {}
+    for key, idx in groups.items():
+        key = tuple(None if pd.isna(val) else val for val in key)
+        out[key] = {field: values[idx] for field, values in block.items() if field not in PARTITION_FIELDS}
+    return out
+
+class PartitionedWriter:
+    """
+    writes each partition of the output with its own fmt writer (see WRITERS), 
+    created when the partition is first seen. path is a directory, which must be 
+    empty or not exist.
+    """
+
+    def __init__(self, path: str, fmt: str, outfields: Optional[list[str]]=None) -> None:
+        if fmt == 'coded':
+            raise ValueError('coded output cannot be partitioned')
+        if os.path.isdir(path) and os.listdir(path):
+            raise FileExistsError(f'partitioned output directory is not empty: {path}')
+        allfields = outfields or [f.name for f in fields(SeerRecord)]
+        missing = [field for field in PARTITION_FIELDS if field not in allfields]
+        if missing:
+            raise ValueError(f"partitioned output needs fields {', '.join(missing)}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.fmt = fmt
+        self.outfields = [field for field in allfields if field not in PARTITION_FIELDS]
+        self.writers: dict[str, Any] = {}
+
+    @staticmethod
+    def resumable(path: str) -> bool:
+        return False
+
+    @staticmethod
+    def encode(block: dict[str, np.ndarray], fmt: str) -> dict[str, Any]:
+        """{partition dir: payload of its rows, encoded by the fmt writer}"""
+        encode = WRITERS[fmt].encode
+        return {partition_dir(key): encode(sub) for key, sub in split_partitions(block).items()}
+
+    def write(self, payload: dict[str, Any]) -> None:
+        for pdir, part in payload.items():
+            if pdir not in self.writers:
+                os.makedirs(os.path.join(self.path, pdir), exist_ok=True)
+                path = os.path.join(self.path, pdir, f'{PARTITION_FILE}.{self.fmt}')
+                self.writers[pdir] = WRITERS[self.fmt](path, None, self.outfields)
+            self.writers[pdir].write(part)
+
+    def close(self) -> None:
+        for writer in self.writers.values():
+            writer.close()
+
+def list_partitions(path: str) -> list[Tuple[dict[str, Any], str]]:
+    """(partition values, file) of each partition file under a PartitionedWriter directory."""
+    types = field_types()
+    out = []
+    for root, _, files in os.walk(path):
+        rel = os.path.relpath(root, path)
+        parts = rel.split(os.sep) if rel != '.' else []
+        if len(parts) != len(PARTITION_FIELDS):
+            continue
+        values = {}
+        for part, field in zip(parts, PARTITION_FIELDS):
+            name, _, text = part.partition('=')
+            if name != field:
+                raise ValueError(f'unexpected partition directory {os.path.join(path, rel)}')
+            values[field] = None if text == PARTITION_NA else types[field](unquote(text))
+        for fname in sorted(files):
+            if fname.startswith(PARTITION_FILE):
+                out.append((values, os.path.join(root, fname)))
+    return sorted(out, key=lambda item: item[1])
+
+def read_partitioned(
+    path: str, 
+    cancer_groups: Optional[Iterable[str]]=None, 
+    years: Optional[Iterable[int]]=None,
+    columns: Optional[list[str]]=None,
+    rows: Optional[RowFilter]=None,
+    ) -> pd.DataFrame:
+    """
+    reads a PartitionedWriter directory into one DataFrame, opening only the partitions 
+    whose cancer_group is in cancer_groups and diagnosis_year in years (None: any), 
+    and which rows accepts. only columns are read (default all), and rows is applied 
+    to each partition as it is read.
+    tsv partitions are parsed in batches (see _read_tsv_partitions()), typed as 
+    read_table() types an unpartitioned tsv; categories are unioned across batches. 
+    partition fields are restored from the paths.
+    """
+    wanted = {
+        'cancer_group': set(cancer_groups) if cancer_groups is not None else None,
+        'diagnosis_year': set(years) if years is not None else None,
+    }
+    selected = [
+        (values, fpath) for values, fpath in list_partitions(path)
+        if all(wanted[field] is None or values[field] in wanted[field] for field in PARTITION_FIELDS)
+        and (rows is None or rows.accepts(values))
+    ]
+    outcols = [f.name for f in fields(SeerRecord) if columns is None or f.name in columns]
+    if not selected:
+        return pd.DataFrame(columns=outcols)
+    # partition files don't hold the partition fields, so rows only filters the others
+    readcols = [col for col in outcols if col not in PARTITION_FIELDS]
+    if rows is not None:
+        readcols += [col for col in rows.columns() if col not in readcols and col not in PARTITION_FIELDS]
+    if all(fpath.endswith('.parquet') for _, fpath in selected):
+        frames = [pd.read_parquet(fpath, columns=readcols) for _, fpath in selected]
+        if rows is not None:
+            frames = [frame[rows.mask(frame)] for frame in frames]
+        counts = [len(frame) for frame in frames]
+    else:
+        frames, counts = _read_tsv_partitions([fpath for _, fpath in selected], readcols, rows)
+    df = concat_frames(frames, readcols).reset_index(drop=True)
+    dtypes = table_dtypes(PARTITION_FIELDS)
+    for field in PARTITION_FIELDS:
+        column = np.repeat(np.array([values[field] for values, _ in selected], dtype=object), counts)
+        df[field] = pd.Series(column, index=df.index, dtype=dtypes[field])
+    order = [col for col in outcols if col in df.columns]
+    return df[order]
+
+def _read_tsv_partitions(
+    paths: list[str], 
+    columns: Optional[list[str]]=None, 
+    rows: Optional[RowFilter]=None,
+    ) -> Tuple[list[pd.DataFrame], list[int]]:
+    """
+    the partition files parsed in batches of up to PARTITION_BATCH_BYTES, and the 
+    row count of each file after rows. small partitions are parsed together (a 
+    read_csv call per file is slow), a file bigger than the batch size is read on 
+    its own by read_table(), chunk by chunk. rows is applied to each batch or chunk 
+    as it is parsed. the files must share the first file's header.
+    """
+    batches: list[list[str]] = []
+    size = 0
+    for fpath in paths:
+        fsize = os.path.getsize(fpath)
+        if not batches or size + fsize > PARTITION_BATCH_BYTES:
+            batches.append([])
+            size = 0
+        batches[-1].append(fpath)
+        size += fsize
+
+    header = None
+    frames, counts = [], []
+    for batch in batches:
+        buf = io.StringIO()
+        nlines = []
+        for fpath in batch:
+            with open_text(fpath, 'r') as fp:
+                fheader = fp.readline()
+                if header is None:
+                    header = fheader
+                elif fheader != header:
+                    raise ValueError(f'{fpath} has different columns to {paths[0]}')
+                if len(batch) > 1:
+                    if not nlines:
+                        buf.write(header)
+                    body = fp.read()
+                    if body and not body.endswith('\n'):
+                        body += '\n'
+                    buf.write(body)
+                    nlines.append(body.count('\n'))
+        if len(batch) == 1:
+            frames.append(read_table(batch[0], columns, rows))
+            counts.append(len(frames[-1]))
+            continue
+        buf.seek(0)
+        df = read_table(buf, columns)
+        keep = rows.mask(df) if rows is not None else np.ones(len(df), dtype=bool)
+        # nlines are of each file's rows, so these are dropped once the batch is parsed
+        counts += [int(part.sum()) for part in np.split(keep, np.cumsum(nlines)[:-1])]
+        frames.append(df[keep])
+    return frames, counts
@@ -0,0 +1,185 @@
+
+import argparse
+import random
+from typing import Iterator
+
+from util_io import open_text
+from util_maps import (
+    TSTAGE_AJCC,
+    TSTAGE_AJCC7th_AJCC_MAP,
+    TSTAGE_SEER_AJCC_MAP,
+    TSTAGE_EOD_AJCC_MAP,
+    NSTAGE_AJCC,
+    NSTAGE_SEER_AJCC_MAP,
+    NSTAGE_EOD_AJCC_MAP,
+    GSTAGE_AJCC,
+    GSTAGE_SEER_AJCC_MAP,
+    GSTAGE_EOD_AJCC_MAP,
+    GRADE_SEER_STD_MAP,
+    GRADE_NAACCR_STD_MAP,
+    CANCERTYPE_CANCERGROUP_MAP,
+    PRIMARYCODE_PRIMARYSITE_MAP,
+    PRIMARYCODE_PRIMARYSITE_RANGES,
+)
+
+"""
+Writes a synthetic SEER*Stat case listing export in the 38 column layout
+clean_case_data.py expects (see DATA_FIELDS there). Values are drawn from the
+keys of util_maps, so every row converts. Patients have 1+ contiguous records.
+"""
+
+AGE_BINS = ['00 years', '01-04 years', '45-49 years', '60-64 years', '90+ years']
+BEHAVIORS = ['Malignant', 'Malignant', 'Borderline malignancy', 'Benign', 'In situ']
+YES_NO = ['Yes', 'No', 'Unknown']
+HIST_TYPES = [8000, 8140, 8070, 8500, 9590]
+HIST_CATEGORIES = ['814-838: adenomas and adenocarcinomas', '805-808: squamous cell neoplasms']
+PSA_VALUES = [
+    'Blank(s)', 'Not documented; not assessed; unknown', 'Test ordered, results not in chart',
+    '0.1 or less nanograms/milliliter (ng/ml)', '98.0 ng/ml or greater', '5.3', '12.0',
+]
+DISTANT_LN = ['None; no lymph node metastases', 'Yes; distant lymph node metastases', 'Not applicable', 'Unknown', 'Blank(s)']
+BREAST_SUBTYPES = ['HR+/HER2- (Luminal A)', 'Recode not available', 'Unknown', 'HR-/HER2+ (HER2 enriched)']
+OTHER_METS = [
+    'Yes; distant mets in known site(s) other than bone, brain, liver, lung, dist LN',
+    'generalized metastases such as carinomatosis', 'None; no other metastases', 'Unknown', 'Blank(s)',
+]
+BLANK = 'Blank(s)'
+
+# sorted once so draws are reproducible for a seed
+T_AJCC = sorted(TSTAGE_AJCC)
+T_AJCC7 = sorted(TSTAGE_AJCC | set(TSTAGE_AJCC7th_AJCC_MAP))
+N_AJCC = sorted(NSTAGE_AJCC)
+G_AJCC = sorted(GSTAGE_AJCC)
+T_EOD = sorted(TSTAGE_AJCC | set(TSTAGE_EOD_AJCC_MAP))
+N_EOD = sorted(NSTAGE_AJCC | set(NSTAGE_EOD_AJCC_MAP))
+G_EOD = sorted(GSTAGE_AJCC | set(GSTAGE_EOD_AJCC_MAP))
+G_SEER = sorted(GSTAGE_AJCC | set(GSTAGE_SEER_AJCC_MAP))
+GRADE_SEER = sorted(GRADE_SEER_STD_MAP)
+GRADE_NAACCR = sorted(GRADE_NAACCR_STD_MAP) + ['S', '8']
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Write a synthetic SEER*Stat case listing export.')
+    parser.add_argument('outfile', help='path to write. .gz/.bz2/.xz/.zst are compressed.')
+    parser.add_argument('rows', type=int, help='number of rows (records)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_synthetic_export(args.outfile, args.rows, args.seed)
+
+def write_synthetic_export(path: str, nrows: int, seed: int=0) -> None:
+    with open_text(path, 'w') as fp:
+        for line in gen_synthetic_lines(nrows, seed):
+            fp.write(line)
+
+def gen_synthetic_lines(nrows: int, seed: int=0) -> Iterator[str]:
+    rng = random.Random(seed)
+    sites = _primary_code_sites()
+    codes = list(sites.keys())
+    tstages = _seer_stage_choices(TSTAGE_AJCC, TSTAGE_SEER_AJCC_MAP, 'T')
+    nstages = _seer_stage_choices(NSTAGE_AJCC, NSTAGE_SEER_AJCC_MAP, 'N')
+    pid = 1000
+    for _ in range(nrows):
+        # ~40% of records belong to the previous patient
+        if rng.random() < 0.6:
+            pid += rng.randint(1, 5)
+        code = rng.choice(codes)
+        site = rng.choice(sites[code])
+        year = rng.randint(2010, 2020)
+        row = [
+            str(pid),
+            str(rng.randint(1, 3)),
+            rng.choice(AGE_BINS),
+            str(year),
+            rng.choice(['Alive at last contact', str(min(2021, year + rng.randint(0, 5)))]),
+            site,
+            rng.choice(BEHAVIORS),
+            rng.choice(['Yes', 'No', 'No', 'Unknown', BLANK]),
+        ]
+        row += _gen_stages(rng, year, tstages, nstages)
+        row += [
+            rng.choice(['1', '2', 'Unknown']),
+            rng.choice(['0', '1', 'Unknown']),
+            str(rng.choice(HIST_TYPES)),
+            str(rng.choice([0, 3, 12, 90, 95, 98, 99])),
+            str(rng.choice([0, 1, 4, 95, 97, 98, 99])),
+        ]
+        row += _gen_grades(rng, year, site)
+        row += [
+            str(code),
+            rng.choice(HIST_CATEGORIES),
+            rng.choice(PSA_VALUES),
+            rng.choice(YES_NO),
+            rng.choice(YES_NO),
+            rng.choice(YES_NO),
+            rng.choice(DISTANT_LN),
+            rng.choice(BREAST_SUBTYPES),
+            str(min(2021, year + rng.randint(0, 6))),
+            rng.choice(OTHER_METS),
+        ]
+        yield '\t'.join(row) + '\n'
+
+def _pick(rng: random.Random, values: list[str], na: list[str]) -> str:
+    """a value, or an NA code 20% of the time."""
+    return rng.choice(na) if rng.random() < 0.2 else rng.choice(values)
+
+def _gen_stages(rng: random.Random, year: int, tstages: list[str], nstages: list[str]) -> list[str]:
+    """T/N/G columns [8-19]. only the staging system used in the diagnosis year is filled."""
+    t6 = n6 = g6 = t7 = n7 = g7 = BLANK
+    ts = ns = gs = BLANK
+    te = ne = ge = BLANK
+    if year <= 2015:
+        t6 = _pick(rng, T_AJCC, ['NA', 'UNK Stage'])
+        t7 = _pick(rng, T_AJCC7, ['NA'])
+        n6 = _pick(rng, N_AJCC, ['NA'])
+        n7 = _pick(rng, N_AJCC, ['NA'])
+        g6 = _pick(rng, G_AJCC, ['NA', 'UNK Stage'])
+        g7 = _pick(rng, G_AJCC, ['NA'])
+    elif year <= 2017:
+        ts = rng.choice(['c', 'p', '']) + _pick(rng, tstages, ['Not applicable', '99'])
+        ns = rng.choice(['c', 'p', '']) + _pick(rng, nstages, ['Not applicable', '99'])
+        gs = _pick(rng, G_SEER, ['Not applicable', '99'])
+        if ts.startswith(('cN', 'pN', 'c9', 'p9')):
+            ts = BLANK
+        if ns.startswith(('cN', 'pN', 'c9', 'p9')):
+            ns = BLANK
+    else:
+        te = _pick(rng, T_EOD, ['88', '99', 'DMS code 90 (invalid inputs)'])
+        ne = _pick(rng, N_EOD, ['88', '99'])
+        ge = _pick(rng, G_EOD, ['88', '99'])
+    return [t6, n6, t7, n7, ts, ns, te, ne, g6, g7, gs, ge]
+
+def _gen_grades(rng: random.Random, year: int, site: str) -> list[str]:
+    """grade columns [25-27]. NAACCR grades are only recorded from 2018."""
+    naaccr = GRADE_NAACCR
+    if site == 'Breast':
+        naaccr = naaccr + ['M']
+    if site == 'Prostate':
+        naaccr = naaccr + ['E']
+    clinical = _pick(rng, naaccr, [BLANK])
+    pathological = _pick(rng, naaccr, [BLANK])
+    if year < 2018:
+        clinical = pathological = BLANK
+    return [_pick(rng, GRADE_SEER, ['Unknown']), clinical, pathological]
+
+def _primary_code_sites() -> dict[int, list[str]]:
+    """primary site code -> sites (CANCERTYPE_CANCERGROUP_MAP keys) it can be recorded with."""
+    out = {}
+    for code in range(0, 810):
+        ptype = PRIMARYCODE_PRIMARYSITE_MAP.get(code)
+        if ptype is None:
+            for low, high, site in PRIMARYCODE_PRIMARYSITE_RANGES:
+                if low <= code <= high:
+                    ptype = site
+        if ptype is None:
+            ptype = 'NHL - Extranodal'
+        sites = [p.strip() for p in ptype.split('|') if p.strip() in CANCERTYPE_CANCERGROUP_MAP]
+        if sites:
+            out[code] = sites
+    return out
+
+def _seer_stage_choices(ajcc: set[str], seer_map: dict[str, str], prefix: str) -> list[str]:
+    """SEER combined stage values (without c/p prefix) which convert to AJCC."""
+    candidates = {s[1:].upper() for s in ajcc} | set(seer_map)
+    return sorted([s for s in candidates if (prefix + s.lower()) in ajcc or s in seer_map])
+
+if __name__ == '__main__':
+    main()